@@ -0,0 +1,228 @@
+import disktools
+import re
+import threading
+
+from errno import ENOSPC
+
+from locks import synchronized
+
+"""
+Free space bitmap:
+One bit per block of the disk, stored in the BITMAP_BLOCKS blocks from
+BITMAP_START. Bit i is bit (i % 8) of byte (i // 8), 1 means the block
+is in use. Bits past the end of the disk are always 1.
+"""
+# Matches a byte of the bitmap that has at least one free block.
+NOT_FULL = re.compile(b'[^\xff]')
+
+def count_zero_bits(data):
+    '''Counts the free blocks in a run of bitmap bytes.'''
+    return 8 * len(data) - bin(int.from_bytes(bytes(data), 'little')).count('1')
+
+
+class Allocator(object):
+    '''Allocates metadata and data blocks from the on-disk bitmap.
+        The whole bitmap is kept in memory. Changed bitmap blocks are
+        written back to disk (anything with read_block and write_block)
+        at the end of every allocate and free, the free counters are
+        written to the superblock by flush. The counters are only trusted
+        when the superblock says the disk was unmounted cleanly.
+    '''
+
+    def __init__(self, superblock, disk=disktools):
+        self.superblock = superblock
+        self.disk = disk
+        self.block_size = superblock['block_size']
+        self.num_blocks = superblock['num_blocks']
+        self.bitmap_start = superblock['bitmap_start']
+        self.inode_start = superblock['inode_start']
+        self.data_start = superblock['data_start']
+
+        self.bitmap = bytearray()
+        for i in range(superblock['bitmap_blocks']):
+            self.bitmap += disk.read_block(self.bitmap_start + i)
+        # bitmap blocks that need writing back.
+        self.dirty = set()
+        # where the next allocation without a hint starts looking.
+        self.cursor = self.data_start
+        # taken by allocate, free and flush, so threads can share it.
+        self.lock = threading.Lock()
+
+        if superblock['clean']:
+            self.free_blocks = superblock['free_blocks']
+            self.free_inodes = superblock['free_inodes']
+        else:
+            self.count()
+
+    def count(self):
+        '''Recounts the free blocks and metadata blocks from the bitmap.'''
+        self.free_blocks = self.count_free(self.data_start, self.num_blocks)
+        self.free_inodes = self.count_free(self.inode_start, self.data_start)
+
+    def is_free(self, block_num):
+        return not self.bitmap[block_num >> 3] & (1 << (block_num & 7))
+
+    def count_free(self, lo, hi):
+        '''Counts the free blocks in [lo, hi).'''
+        free = 0
+        while lo < hi and lo & 7:
+            free += self.is_free(lo)
+            lo += 1
+        while hi > lo and hi & 7:
+            hi -= 1
+            free += self.is_free(hi)
+        return free + count_zero_bits(self.bitmap[lo >> 3:hi >> 3])
+
+    def mark(self, start, count, used):
+        '''Sets the bits of count blocks from start.'''
+        end = start + count
+        block_num = start
+        while block_num < end:
+            if not block_num & 7 and block_num + 8 <= end:
+                # whole bytes at once.
+                length = (end - block_num) >> 3
+                self.bitmap[block_num >> 3:(block_num >> 3) + length] = (
+                    (b'\xff' if used else b'\x00') * length)
+                block_num += length * 8
+                continue
+            if used:
+                self.bitmap[block_num >> 3] |= 1 << (block_num & 7)
+            else:
+                self.bitmap[block_num >> 3] &= ~(1 << (block_num & 7)) & 0xff
+            block_num += 1
+        first = (start >> 3) // self.block_size
+        last = ((start + count - 1) >> 3) // self.block_size
+        self.dirty.update(range(first, last + 1))
+
+    def find_free(self, pos, lo, hi):
+        '''Finds the first free block in [pos, hi), then in [lo, pos).
+            Return: the block number, or -1 if there is none.
+        '''
+        for start, stop in ((pos, hi), (lo, pos)):
+            block_num = start
+            # check bit by bit up to a byte boundary.
+            while block_num < stop and block_num & 7:
+                if self.is_free(block_num):
+                    return block_num
+                block_num += 1
+            if block_num >= stop:
+                continue
+            # then skip whole bytes of used blocks at once.
+            match = NOT_FULL.search(self.bitmap, block_num >> 3, (stop + 7) >> 3)
+            if match is None:
+                continue
+            byte = self.bitmap[match.start()]
+            # lowest zero bit of the byte.
+            block_num = match.start() * 8 + ((~byte & (byte + 1)).bit_length() - 1)
+            if block_num < stop:
+                return block_num
+        return -1
+
+    def find_run(self, count, pos, lo, hi):
+        '''Finds a run of at least count free blocks, starting at a byte
+            boundary. Return: the first block of the run, or -1.
+        '''
+        run = re.compile(b'\x00{%d}' % ((count + 7) // 8))
+        for start, stop in ((pos, hi), (lo, pos)):
+            match = run.search(self.bitmap, (start + 7) >> 3, stop >> 3)
+            if match is not None:
+                return match.start() * 8
+        return -1
+
+    def run_length(self, start, limit, hi):
+        '''Counts the free blocks from start, up to limit blocks.'''
+        length = 0
+        block_num = start
+        while length < limit and block_num < hi:
+            if (not block_num & 7 and limit - length >= 8 and block_num + 8 <= hi
+                    and self.bitmap[block_num >> 3] == 0):
+                length += 8
+                block_num += 8
+            elif self.is_free(block_num):
+                length += 1
+                block_num += 1
+            else:
+                break
+        return length
+
+    @synchronized
+    def allocate(self, count, hint=0):
+        '''Allocates count data blocks, as close to block hint as possible.
+            Return: a list of (start, length) runs of blocks, which is a
+            single run whenever there is a large enough gap.
+        '''
+        if count > self.free_blocks:
+            raise IOError(ENOSPC, 'No space left on device')
+        lo, hi = self.data_start, self.num_blocks
+        pos = hint if lo <= hint < hi else self.cursor
+        if count > 1 and self.run_length(pos, count, hi) < count:
+            start = self.find_run(count, pos, lo, hi)
+            if start != -1:
+                pos = start
+
+        runs = []
+        self.free_blocks -= count
+        while count > 0:
+            start = self.find_free(pos, lo, hi)
+            length = self.run_length(start, count, hi)
+            self.mark(start, length, True)
+            runs.append((start, length))
+            count -= length
+            pos = start + length
+        self.cursor = pos if pos < hi else lo
+        self.write_dirty()
+        return runs
+
+    @synchronized
+    def allocate_inode(self):
+        '''Allocates a metadata block.'''
+        block_num = self.find_free(self.inode_start, self.inode_start,
+                                   self.data_start)
+        if block_num == -1:
+            raise IOError(ENOSPC, 'No space left on device')
+        self.mark(block_num, 1, True)
+        self.free_inodes -= 1
+        self.write_dirty()
+        return block_num
+
+    @synchronized
+    def free(self, start, count=1):
+        '''Releases count blocks from start.'''
+        if start < self.data_start:
+            self.free_inodes += count
+        else:
+            self.free_blocks += count
+        self.mark(start, count, False)
+        self.write_dirty()
+
+    def rebuild(self, runs):
+        '''Replaces the bitmap with one where only the (start, length)
+            runs of blocks, the superblock, the bitmap itself and the bits
+            past the end of the disk are in use.
+        '''
+        bitmap_end = len(self.bitmap) * 8
+        self.bitmap[:] = bytes(len(self.bitmap))
+        self.mark(0, self.inode_start, True)
+        self.mark(self.num_blocks, bitmap_end - self.num_blocks, True)
+        for start, length in runs:
+            self.mark(start, length, True)
+        self.dirty.update(range(len(self.bitmap) // self.block_size))
+        self.write_dirty()
+        self.count()
+
+    def write_dirty(self):
+        for i in sorted(self.dirty):
+            self.disk.write_block(self.bitmap_start + i,
+                self.bitmap[i * self.block_size:(i + 1) * self.block_size])
+        self.dirty.clear()
+
+    @synchronized
+    def flush(self, clean=False):
+        '''Writes the bitmap and the free counters to disk, and whether
+            the file system is being unmounted cleanly.
+        '''
+        self.write_dirty()
+        self.superblock['free_blocks'] = self.free_blocks
+        self.superblock['free_inodes'] = self.free_inodes
+        self.superblock['clean'] = 1 if clean else 0
+        self.disk.write_block(0, disktools.encode_superblock(self.superblock))
@@ -0,0 +1,11 @@
+"""
+In-process benchmarks of the file systems.
+The file systems are driven through their Operations methods, the same
+way FUSE calls them, so no mount is needed. Small runs against a
+temporary image made with format.py.
+
+Run the benchmarks and save the results:
+python3 -m bench run --output before.json
+Compare two runs:
+python3 -m bench compare before.json after.json
+"""
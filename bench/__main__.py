@@ -0,0 +1,145 @@
+from __future__ import print_function, absolute_import, division
+
+import argparse
+import json
+import platform
+import sys
+
+from bench.stress import stress
+from bench.targets import TARGETS
+from bench.workloads import run
+
+# metric -> True if a larger value is better.
+METRICS = [
+    ('mb_per_second', True),
+    ('ops_per_second', True),
+    ('p50_us', False),
+    ('p99_us', False)]
+IO_METRICS = ['reads', 'writes', 'read_calls', 'write_calls', 'flushes']
+
+
+def run_benchmarks(args):
+    report = dict(
+        scale=args.scale,
+        python=platform.python_version(),
+        targets={})
+    for name in args.targets:
+        target = TARGETS[name](block_size=args.block_size,
+                               num_blocks=args.num_blocks,
+                               cache_blocks=args.cache_blocks)
+        try:
+            results = run(target, args.only, args.scale)
+            report['targets'][name] = dict(geometry=target.geometry(),
+                                           results=results)
+        finally:
+            target.close()
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 0
+
+def run_stress(args):
+    '''Return: 1 if the stress test found a problem.'''
+    failed = 0
+    for name in args.targets:
+        target = TARGETS[name](threaded=True)
+        try:
+            result = stress(target, args.threads, args.seconds, args.seed)
+        finally:
+            target.close()
+        print('%s: %d ops from %d threads in %.1f s, %d problems'
+              % (name, result['ops'], result['threads'], result['seconds'],
+                 len(result['problems'])))
+        for problem in result['problems']:
+            print('  ' + problem)
+        failed = failed or bool(result['problems'])
+    return 1 if failed else 0
+
+def change(old, new):
+    if old == 0:
+        return 0 if new == 0 else float('inf')
+    return (new - old) / old * 100
+
+def compare(args):
+    '''Prints the change of every metric between two runs.
+        Return: 1 if a metric got worse by more than the threshold.
+    '''
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    if old['scale'] != new['scale']:
+        print('warning: runs have different scales, %s and %s'
+              % (old['scale'], new['scale']), file=sys.stderr)
+
+    regressions = 0
+    row = '%-8s %-22s %-14s %14s %14s %9s'
+    print(row % ('target', 'workload', 'metric', 'old', 'new', 'change'))
+    for target in sorted(set(old['targets']) & set(new['targets'])):
+        old_results = old['targets'][target]['results']
+        new_results = new['targets'][target]['results']
+        for workload in sorted(set(old_results) & set(new_results)):
+            before = old_results[workload]
+            after = new_results[workload]
+            metrics = [(name, before[name], after[name], larger_is_better)
+                       for name, larger_is_better in METRICS]
+            # less block I/O is better.
+            metrics += [(name, before['io'].get(name, 0), after['io'].get(name, 0), False)
+                        for name in IO_METRICS if name in before['io']]
+            for name, old_value, new_value, larger_is_better in metrics:
+                percent = change(old_value, new_value)
+                worse = -percent if larger_is_better else percent
+                flag = ''
+                if worse > args.threshold:
+                    flag = ' worse'
+                    regressions += 1
+                print(row % (target, workload, name, '%.1f' % old_value,
+                             '%.1f' % new_value, '%+.1f%%' % percent) + flag)
+    return 1 if regressions else 0
+
+def main():
+    parser = argparse.ArgumentParser(prog='python3 -m bench')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run_parser = commands.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('targets', nargs='*', metavar='target',
+                            help='one of %s, all of them by default'
+                            % ', '.join(sorted(TARGETS)))
+    run_parser.add_argument('--only', help='run the workloads with this in their name')
+    run_parser.add_argument('--scale', type=float, default=1)
+    run_parser.add_argument('--block-size', type=int, default=4096)
+    run_parser.add_argument('--num-blocks', type=int, default=16384)
+    run_parser.add_argument('--cache-blocks', type=int, default=1024)
+    run_parser.add_argument('--output', '-o')
+    run_parser.set_defaults(function=run_benchmarks)
+
+    stress_parser = commands.add_parser(
+        'stress', help='check the threaded mode from several threads at once')
+    stress_parser.add_argument('targets', nargs='*', metavar='target')
+    stress_parser.add_argument('--threads', type=int, default=8)
+    stress_parser.add_argument('--seconds', type=float, default=5)
+    stress_parser.add_argument('--seed', type=int, default=0)
+    stress_parser.set_defaults(function=run_stress)
+
+    compare_parser = commands.add_parser('compare', help='compare two runs')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=10,
+                                help='percent a metric may get worse by')
+    compare_parser.set_defaults(function=compare)
+
+    args = parser.parse_args()
+    if args.command in ('run', 'stress'):
+        for name in args.targets:
+            if name not in TARGETS:
+                parser.error('unknown target %s' % name)
+        args.targets = args.targets or sorted(TARGETS)
+    return args.function(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+from __future__ import print_function, absolute_import, division
+
+import random
+import threading
+
+from errno import ENOENT
+from timeit import default_timer as timer
+
+from fusecompat import FuseOSError
+
+from bench.workloads import KiB
+
+"""
+Stress test of the threaded mode:
+Every thread owns one file and a few scratch names. It writes, reads back,
+truncates and fsyncs its file at random while creating and removing its
+scratch files and directories and listing the root, all against the
+same mounted file system. Each thread keeps a copy of what its file
+should hold and checks every read against it. At the end the files are
+checked again, after a remount if the target can, and the free space is
+checked against the directory tree.
+"""
+MAX_SIZE = 256 * KiB
+
+
+class Worker(threading.Thread):
+
+    def __init__(self, target, number, deadline, seed):
+        threading.Thread.__init__(self)
+        self.target = target
+        self.path = '/stress%03d' % number
+        self.scratch = '/scratch%03d' % number
+        self.deadline = deadline
+        self.choose = random.Random(seed)
+        self.expected = bytearray()
+        self.fh = 0
+        self.ops = 0
+        self.errors = []
+
+    def call(self, op, *args):
+        self.ops += 1
+        return self.target.fs(op, *args)
+
+    def check(self, offset, size):
+        data = self.call('read', self.path, size, offset, self.fh)
+        if bytes(data) != bytes(self.expected[offset:offset + size]):
+            self.errors.append('%s: read %d bytes at %d does not match'
+                               % (self.path, size, offset))
+
+    def step(self):
+        choose = self.choose
+        action = choose.random()
+        if action < 0.4:
+            offset = choose.randrange(MAX_SIZE)
+            size = min(choose.randrange(1, 32 * KiB), MAX_SIZE - offset)
+            data = bytes(bytearray([choose.randrange(256)])) * size
+            self.call('write', self.path, data, offset, self.fh)
+            if offset > len(self.expected):
+                self.expected.extend(bytearray(offset - len(self.expected)))
+            self.expected[offset:offset + size] = data
+        elif action < 0.7:
+            offset = choose.randrange(MAX_SIZE)
+            self.check(offset, choose.randrange(1, 64 * KiB))
+        elif action < 0.75:
+            length = choose.randrange(MAX_SIZE)
+            self.call('truncate', self.path, length, self.fh)
+            del self.expected[length:]
+            self.expected.extend(bytearray(length - len(self.expected)))
+        elif action < 0.85:
+            fh = self.call('create', self.scratch, 0o644)
+            self.call('write', self.scratch, b'x' * choose.randrange(1, 8 * KiB), 0, fh)
+            self.call('release', self.scratch, fh)
+            self.call('unlink', self.scratch)
+        elif action < 0.9:
+            self.call('mkdir', self.scratch, 0o755)
+            self.call('rmdir', self.scratch)
+        elif action < 0.97:
+            names = self.call('readdir', '/', 0)
+            if self.path[1:] not in names:
+                self.errors.append('%s missing from readdir' % self.path)
+        else:
+            self.call('fsync', self.path, 0, self.fh)
+        size = self.call('getattr', self.path, self.fh)['st_size']
+        if size != len(self.expected):
+            self.errors.append('%s: size %d, expected %d'
+                               % (self.path, size, len(self.expected)))
+
+    def run(self):
+        try:
+            self.fh = self.call('create', self.path, 0o644)
+            while timer() < self.deadline and not self.errors:
+                self.step()
+            self.call('release', self.path, self.fh)
+        except Exception as e:
+            self.errors.append('%s: %r' % (self.path, e))
+
+
+def stress(target, threads=8, seconds=5, seed=0):
+    '''Hammers target from several threads at once.
+        Return: a summary with the problems that were found.
+    '''
+    start = timer()
+    workers = [Worker(target, i, start + seconds, seed + i) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = timer() - start
+
+    problems = []
+    for worker in workers:
+        problems.extend(worker.errors)
+    if target.can_remount:
+        target.remount()
+    for worker in workers:
+        found = len(worker.errors)
+        worker.check(0, MAX_SIZE + 1)
+        problems.extend(worker.errors[found:])
+        try:
+            target.fs('getattr', worker.scratch)
+            problems.append('%s was not removed' % worker.scratch)
+        except FuseOSError as e:
+            if e.errno != ENOENT:
+                raise
+    problems.extend(target.check())
+
+    ops = sum(worker.ops for worker in workers)
+    return dict(
+        threads=threads,
+        seconds=elapsed,
+        ops=ops,
+        ops_per_second=ops / elapsed,
+        problems=problems)
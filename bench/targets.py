@@ -0,0 +1,147 @@
+from __future__ import print_function, absolute_import, division
+
+import os
+import shutil
+import stat
+import tempfile
+
+from collections import Counter
+
+import disktools
+import format
+
+from cache import CACHE_BLOCKS
+from memory import Memory
+from small import Small
+
+
+class SmallTarget(object):
+    '''Small mounted on a temporary image.
+        The image replaces disktools.DISK_NAME until close is called.
+    '''
+    name = 'small'
+    can_remount = True
+
+    def __init__(self, block_size=4096, num_blocks=16384, inode_count=None,
+                 cache_blocks=CACHE_BLOCKS, threaded=False):
+        self.directory = tempfile.mkdtemp(prefix='bench-')
+        self.disk_name = disktools.DISK_NAME
+        disktools.close_device()
+        disktools.DISK_NAME = os.path.join(self.directory, 'disk')
+        format.make_filesystem(block_size, num_blocks, inode_count)
+        disktools.close_device()
+        self.cache_blocks = cache_blocks
+        self.threaded = threaded
+        self.mount()
+        # I/O of the devices closed by remounts.
+        self.past_io = Counter()
+
+    def geometry(self):
+        superblock = self.fs.allocator.superblock
+        return dict(
+            block_size=superblock['block_size'],
+            num_blocks=superblock['num_blocks'],
+            inode_count=superblock['inode_count'],
+            journal_blocks=superblock['journal_blocks'],
+            cache_blocks=self.cache_blocks)
+
+    def io(self):
+        '''Block I/O of the image so far.'''
+        io = Counter(self.past_io)
+        io.update(disktools.get_device().stats())
+        return io
+
+    def capacity(self):
+        '''Bytes in the data region.'''
+        return (self.fs.allocator.num_blocks - self.fs.data_start) * self.fs.block_size
+
+    def used_fraction(self):
+        allocator = self.fs.allocator
+        return 1 - allocator.free_blocks / (allocator.num_blocks - self.fs.data_start)
+
+    def sync(self):
+        self.fs('fsync', '/', 0, 0)
+
+    def unmount(self):
+        self.fs('destroy', '/')
+        self.past_io.update(disktools.get_device().stats())
+        disktools.close_device()
+        self.fs = None
+
+    def mount(self):
+        self.fs = Small(self.cache_blocks, threaded=self.threaded)
+
+    def remount(self):
+        self.unmount()
+        self.mount()
+
+    def drop_caches(self):
+        '''Remounts, so that reads start from an empty block cache.'''
+        self.remount()
+
+    def check(self):
+        '''Walks the directory tree and checks that the free counters
+            match the blocks the files use.
+            Return: a list of problems found.
+        '''
+        fs = self.fs
+        used = set()
+        files = 0
+        stack = [fs.root]
+        if fs.dedup is not None:
+            # the dedup index is in no directory.
+            stack.append(fs.dedup.inode)
+        while stack:
+            inode = stack.pop()
+            files += 1
+            used.update(inode.extents.physical_blocks())
+            used.update(inode.extents.overflow)
+            if stat.S_ISDIR(inode.mode):
+                for name, block_num in fs.list_directory(inode):
+                    stack.append(fs.load_inode(block_num))
+        allocator = fs.allocator
+        problems = []
+        free_blocks = allocator.num_blocks - fs.data_start - len(used)
+        if free_blocks != allocator.free_blocks:
+            problems.append('%d free blocks counted, %d found'
+                            % (allocator.free_blocks, free_blocks))
+        free_inodes = allocator.superblock['inode_count'] - files
+        if free_inodes != allocator.free_inodes:
+            problems.append('%d free inodes counted, %d found'
+                            % (allocator.free_inodes, free_inodes))
+        return problems
+
+    def close(self):
+        self.unmount()
+        disktools.DISK_NAME = self.disk_name
+        shutil.rmtree(self.directory)
+
+
+class MemoryTarget(object):
+    '''Memory, which has no disk, so there is no block I/O to count.'''
+    name = 'memory'
+    can_remount = False
+
+    def __init__(self, threaded=False, **geometry):
+        self.fs = Memory(threaded)
+
+    def geometry(self):
+        return {}
+
+    def io(self):
+        return {}
+
+    def sync(self):
+        pass
+
+    def drop_caches(self):
+        pass
+
+    def check(self):
+        return []
+
+    def close(self):
+        pass
+
+
+TARGETS = dict((target.name, target) for target in (SmallTarget, MemoryTarget))
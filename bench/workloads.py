@@ -0,0 +1,188 @@
+from __future__ import print_function, absolute_import, division
+
+import os
+import random
+
+from collections import Counter
+from timeit import default_timer as timer
+
+KiB = 1024
+MiB = 1024 * KiB
+
+CHUNK_SIZES = (4 * KiB, 64 * KiB, 1 * MiB)
+FILL_LEVELS = (0, 0.5, 0.9)
+
+
+class Recorder(object):
+    '''Times the operations of one workload on a target, and counts the
+        bytes and block I/O they moved. Only calls made through the
+        recorder are measured, so setup and clean up are left out.
+    '''
+
+    def __init__(self, target):
+        self.target = target
+        self.latencies = []
+        self.sync_seconds = 0
+        self.bytes = 0
+        self.io = Counter()
+
+    def __call__(self, op, *args):
+        '''Calls op on the file system the way FUSE does, and times it.'''
+        return self.measure(self.target.fs, op, *args)
+
+    def measure(self, function, *args):
+        before = self.target.io()
+        start = timer()
+        result = function(*args)
+        self.latencies.append(timer() - start)
+        self.count_io(before)
+        return result
+
+    def sync(self):
+        '''Times the commit of what the workload wrote.'''
+        before = self.target.io()
+        start = timer()
+        self.target.sync()
+        self.sync_seconds += timer() - start
+        self.count_io(before)
+
+    def count_io(self, before):
+        for name, value in self.target.io().items():
+            self.io[name] += value - before[name]
+
+    def untimed(self, op, *args):
+        return self.target.fs(op, *args)
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        seconds = sum(latencies) + self.sync_seconds
+        ops = len(latencies)
+        return dict(
+            ops=ops,
+            bytes=self.bytes,
+            seconds=seconds,
+            ops_per_second=ops / seconds if seconds else 0,
+            mb_per_second=self.bytes / MiB / seconds if seconds else 0,
+            p50_us=percentile(latencies, 0.5) * 1e6,
+            p99_us=percentile(latencies, 0.99) * 1e6,
+            io=dict(self.io))
+
+
+def percentile(latencies, fraction):
+    '''Returns the fraction percentile of sorted latencies.'''
+    if not latencies:
+        return 0
+    return latencies[int(round(fraction * (len(latencies) - 1)))]
+
+def write_file(rec, path, size, chunk=MiB):
+    fh = rec.untimed('create', path, 0o644)
+    data = os.urandom(chunk)
+    for offset in range(0, size, chunk):
+        rec.untimed('write', path, data[:size - offset], offset, fh)
+    rec.untimed('release', path, fh)
+    rec.target.sync()
+    rec.target.drop_caches()
+
+def seq_write(rec, chunk, total):
+    fh = rec.untimed('create', '/seq', 0o644)
+    data = os.urandom(chunk)
+    for offset in range(0, total, chunk):
+        rec.bytes += rec('write', '/seq', data, offset, fh)
+    rec('release', '/seq', fh)
+    rec.sync()
+    rec.untimed('unlink', '/seq')
+
+def seq_read(rec, chunk, total):
+    write_file(rec, '/seq', total)
+    fh = rec.untimed('open', '/seq', os.O_RDONLY)
+    for offset in range(0, total, chunk):
+        rec.bytes += len(rec('read', '/seq', chunk, offset, fh))
+    rec.untimed('release', '/seq', fh)
+    rec.untimed('unlink', '/seq')
+
+def random_read(rec, total, count, size=4 * KiB):
+    write_file(rec, '/random', total)
+    fh = rec.untimed('open', '/random', os.O_RDONLY)
+    choose = random.Random(0)
+    for _ in range(count):
+        offset = choose.randrange(total // size) * size
+        rec.bytes += len(rec('read', '/random', size, offset, fh))
+    rec.untimed('release', '/random', fh)
+    rec.untimed('unlink', '/random')
+
+def create_unlink(rec, count):
+    for i in range(count):
+        path = '/f%06d' % i
+        rec.untimed('release', path, rec('create', path, 0o644))
+    for i in range(count):
+        rec('unlink', '/f%06d' % i)
+    rec.sync()
+
+def readdir(rec, count, repeat):
+    for i in range(count):
+        path = '/f%06d' % i
+        rec.untimed('release', path, rec.untimed('create', path, 0o644))
+    rec.target.sync()
+    for _ in range(repeat):
+        rec('readdir', '/', 0)
+    for i in range(count):
+        rec.untimed('unlink', '/f%06d' % i)
+
+def truncate_grow(rec, step, count):
+    rec.untimed('release', '/grow', rec.untimed('create', '/grow', 0o644))
+    for i in range(1, count + 1):
+        rec('truncate', '/grow', i * step)
+    rec.sync()
+    rec.untimed('unlink', '/grow')
+
+def mount_time(rec, fill, file_size=8 * MiB):
+    '''Times a mount of the image with fill of its data space in use.'''
+    target = rec.target
+    files = 0
+    while True:
+        size = min(file_size, int((fill - target.used_fraction()) * target.capacity()))
+        if size < target.fs.block_size:
+            break
+        write_file(rec, '/fill%06d' % files, size)
+        files += 1
+    target.unmount()
+    rec.measure(target.mount)
+    for i in range(files):
+        rec.untimed('unlink', '/fill%06d' % i)
+
+def workloads(scale=1):
+    '''Returns the (name, function, arguments) of every workload.
+        scale multiplies the amount of data and the number of files.
+    '''
+    total = int(8 * MiB * scale)
+    files = int(1000 * scale)
+    items = []
+    for chunk in CHUNK_SIZES:
+        items.append(('seq_write_%dk' % (chunk // KiB), seq_write, (chunk, total)))
+    for chunk in CHUNK_SIZES:
+        items.append(('seq_read_%dk' % (chunk // KiB), seq_read, (chunk, total)))
+    items.append(('random_read_4k', random_read, (total, files)))
+    items.append(('create_unlink_%d' % files, create_unlink, (files,)))
+    items.append(('readdir_%d' % files, readdir, (files, 20)))
+    items.append(('truncate_grow', truncate_grow, (total // 64, 64)))
+    for fill in FILL_LEVELS:
+        items.append(('mount_fill_%d' % int(fill * 100), mount_time, (fill,)))
+    return items
+
+# workloads that need a target that can be remounted.
+REMOUNT_WORKLOADS = (mount_time,)
+
+def run(target, name_filter=None, scale=1):
+    '''Runs the workloads on target.
+        Return: a dict of workload name -> summary.
+    '''
+    results = {}
+    for name, function, args in workloads(scale):
+        if name_filter and name_filter not in name:
+            continue
+        if function in REMOUNT_WORKLOADS and not target.can_remount:
+            continue
+        rec = Recorder(target)
+        function(rec, *args)
+        results[name] = rec.summary()
+    return results
@@ -0,0 +1,249 @@
+import threading
+
+from errno import ENOSPC
+
+from collections import OrderedDict
+
+from locks import synchronized
+
+CACHE_BLOCKS = 1024
+
+
+class BlockCache(object):
+    '''Write-back LRU cache of disk blocks.
+        Sits between the file system and a device with read_block and
+        write_block (a disktools.BlockDevice, or the disktools module).
+        Written blocks stay in memory until flush is called or they are
+        evicted to make room.
+        With a journal, dirty metadata blocks (every block below
+        metadata_end, and blocks written with metadata=True) are never
+        evicted; flush commits them through the journal after the data
+        blocks have been written. A commit must fit in the journal, so
+        once it is full the operations that had ended when the running
+        ones began are committed on their own, see pin.
+    '''
+
+    def __init__(self, device, capacity=CACHE_BLOCKS, journal=None, metadata_end=0):
+        self.device = device
+        self.capacity = max(1, capacity)
+        self.block_size = device.block_size
+        self.journal = journal
+        self.metadata_end = metadata_end
+        # block number -> bytearray, least recently used first.
+        self.blocks = OrderedDict()
+        self.dirty = set()
+        # the dirty blocks that are metadata.
+        self.metadata = set()
+        # most metadata blocks a commit can hold.
+        self.journal_capacity = journal.capacity() if journal is not None else 0
+        # metadata first written since no operation was running, and the
+        # copies from then of the other metadata blocks changed since.
+        self.fresh = set()
+        self.before = {}
+        # taken by every public method, so threads can share the cache.
+        self.lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writebacks = 0
+        self.prefetched = 0
+        self.early_commits = 0
+
+    @synchronized
+    def get(self, block_num):
+        '''Returns the cached buffer of block_num, reading it on a miss.
+            The buffer must not be changed by the caller.
+        '''
+        block = self.blocks.get(block_num)
+        if block is not None:
+            self.hits += 1
+            self.blocks.move_to_end(block_num)
+            return block
+        self.misses += 1
+        block = self.device.read_block(block_num)
+        self.insert(block_num, block)
+        return block
+
+    def read_block(self, block_num):
+        '''Reads block_num block.
+            Return: a bytearray of block_size
+        '''
+        return bytearray(self.get(block_num))
+
+    @synchronized
+    def read_blocks(self, block_nums):
+        '''Reads several blocks, fetching all the misses from the device
+            in one vectored read.
+            Return: a bytearray of the blocks, in the order of block_nums.
+        '''
+        block_size = self.block_size
+        data = bytearray(len(block_nums) * block_size)
+        missing = []
+        for i, block_num in enumerate(block_nums):
+            block = self.blocks.get(block_num)
+            if block is None:
+                missing.append(i)
+            else:
+                self.hits += 1
+                self.blocks.move_to_end(block_num)
+                data[i * block_size:(i + 1) * block_size] = block
+
+        if missing:
+            self.misses += len(missing)
+            fetched = self.device.read_blocks([block_nums[i] for i in missing])
+            for j, i in enumerate(missing):
+                block = fetched[j * block_size:(j + 1) * block_size]
+                data[i * block_size:(i + 1) * block_size] = block
+                if block_nums[i] not in self.blocks:
+                    self.insert(block_nums[i], block)
+        return data
+
+    @synchronized
+    def prefetch(self, block_nums):
+        '''Reads the blocks of block_nums that are not cached into the
+            cache, in one vectored read. They count as neither hits nor
+            misses.
+        '''
+        block_size = self.block_size
+        missing = [block_num for block_num in block_nums if block_num not in self.blocks]
+        if not missing:
+            return
+        self.prefetched += len(missing)
+        fetched = self.device.read_blocks(missing)
+        for j, block_num in enumerate(missing):
+            self.insert(block_num, fetched[j * block_size:(j + 1) * block_size])
+
+    @synchronized
+    def write_blocks(self, blocks):
+        '''Writes a dict of block number -> whole block data to the cache.'''
+        for block_num in sorted(blocks):
+            self.write_block(block_num, blocks[block_num])
+
+    @synchronized
+    def write_block(self, block_num, data, metadata=False):
+        '''Writes data to the block_num block in the cache.'''
+        if len(data) > self.block_size:
+            raise IOError('Data is larger than a block')
+        if self.journal is not None and (metadata or block_num < self.metadata_end):
+            self.pin(block_num)
+        if len(data) == self.block_size:
+            block = bytearray(data)
+            if block_num in self.blocks:
+                self.blocks[block_num] = block
+                self.blocks.move_to_end(block_num)
+            else:
+                self.insert(block_num, block)
+        else:
+            block = self.get(block_num)
+            block[0:len(data)] = data
+        self.dirty.add(block_num)
+
+    def pin(self, block_num):
+        '''Keeps block_num, about to be written, for the next commit.
+            If the journal cannot take another block, the metadata as it
+            was when no operation was running is committed first.
+        '''
+        if block_num in self.metadata:
+            if block_num not in self.fresh and block_num not in self.before:
+                self.before[block_num] = bytes(self.blocks[block_num])
+            return
+        if len(self.metadata) >= self.journal_capacity:
+            self.commit_settled()
+        self.metadata.add(block_num)
+        self.fresh.add(block_num)
+
+    def commit_settled(self):
+        settled = self.metadata - self.fresh
+        if not settled:
+            raise IOError(ENOSPC, 'Operation changes more metadata blocks than fit in the journal')
+        self.early_commits += 1
+        self.write_data()
+        self.journal.commit(dict((block_num, self.before.get(block_num, self.blocks[block_num]))
+                                 for block_num in settled))
+        # blocks changed since then wait for the next commit.
+        self.dirty.difference_update(settled.difference(self.before))
+        self.metadata = self.fresh.union(self.before)
+        self.fresh = set(self.metadata)
+        self.before.clear()
+
+    @synchronized
+    def settle(self):
+        '''Called when no operation is running: the metadata waiting on a
+            commit is that of whole operations.
+        '''
+        self.fresh.clear()
+        self.before.clear()
+
+    def fits(self, count):
+        '''Return: True if count more metadata blocks can be committed
+            with those of the running operations.
+        '''
+        return self.journal is None or len(self.fresh) + count <= self.journal_capacity
+
+    def group_full(self):
+        '''Return: True once half the journal is waiting on a commit.'''
+        return self.journal is not None and 2 * len(self.metadata) >= self.journal_capacity
+
+    def insert(self, block_num, block):
+        self.blocks[block_num] = block
+        while len(self.blocks) > self.capacity:
+            for old_num in self.blocks:
+                if old_num not in self.metadata and old_num != block_num:
+                    break
+            else:
+                # every other block is metadata waiting for a commit.
+                break
+            old_block = self.blocks.pop(old_num)
+            self.evictions += 1
+            if old_num in self.dirty:
+                self.dirty.discard(old_num)
+                self.writebacks += 1
+                if self.journal is not None:
+                    self.journal.revoke((old_num,))
+                self.device.write_block(old_num, old_block)
+
+    @synchronized
+    def flush(self):
+        '''Writes every dirty block back to the device, merging blocks
+            that are next to each other into single writes. Dirty metadata
+            is then committed through the journal as one group.
+        '''
+        self.write_data()
+        if self.metadata:
+            self.writebacks += len(self.metadata)
+            self.journal.commit(
+                dict((block_num, self.blocks[block_num]) for block_num in self.metadata))
+        self.dirty.clear()
+        self.metadata.clear()
+        self.fresh.clear()
+        self.before.clear()
+
+    def write_data(self):
+        '''Writes the dirty blocks that are not metadata back to the device.'''
+        data = dict((block_num, self.blocks[block_num])
+                    for block_num in self.dirty if block_num not in self.metadata)
+        self.writebacks += len(data)
+        if self.journal is not None:
+            self.journal.revoke(data)
+        self.device.write_blocks(data)
+        self.dirty.difference_update(data)
+
+    @synchronized
+    def sync(self):
+        '''Flushes the cache and makes the device durable.'''
+        self.flush()
+        self.device.flush()
+
+    def stats(self):
+        return dict(
+            capacity=self.capacity,
+            cached=len(self.blocks),
+            dirty=len(self.dirty),
+            pinned=len(self.metadata),
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            writebacks=self.writebacks,
+            prefetched=self.prefetched,
+            early_commits=self.early_commits)
@@ -0,0 +1,51 @@
+import lzma
+import zlib
+
+"""
+Compression:
+With compression on, the data of a regular file is stored in clusters of
+CLUSTER_SIZE bytes (CLUSTER_SIZE // BLOCK_SIZE blocks, at least one),
+each starting at a multiple of the cluster size. A cluster is compressed
+on its own, so a read only decompresses the clusters it covers.
+
+A cluster that compresses into fewer blocks than it holds is stored in
+one run of blocks, as an extent of its own (see extents):
+LOGICAL # first logical block of the cluster
+PHYSICAL # first block of the compressed data
+LENGTH # COMPRESSED, LZMA if lzma was used rather than zlib, and the
+       # number of bytes of compressed data.
+It covers the whole cluster, which reads as zeros past the data. Other
+clusters are stored as plain blocks, and clusters of zeros as holes.
+"""
+CLUSTER_SIZE = 64 * 1024
+METHODS = ('zlib', 'lzma')
+
+# flags in the LENGTH of an extent.
+COMPRESSED = 1 << 31
+LZMA = 1 << 30
+SIZE_MASK = LZMA - 1
+
+
+def cluster_blocks(block_size):
+    '''Number of logical blocks in a cluster.'''
+    return max(1, CLUSTER_SIZE // block_size)
+
+def compress(data, method):
+    if method == 'lzma':
+        return lzma.compress(bytes(data), format=lzma.FORMAT_RAW,
+                             filters=[dict(id=lzma.FILTER_LZMA2, preset=6)])
+    return zlib.compress(bytes(data), 6)
+
+def decompress(data, method):
+    if method == 'lzma':
+        return lzma.decompress(bytes(data), format=lzma.FORMAT_RAW,
+                               filters=[dict(id=lzma.FILTER_LZMA2, preset=6)])
+    return zlib.decompress(bytes(data))
+
+def pack_length(size, method):
+    '''Returns the LENGTH of a compressed cluster of size bytes.'''
+    return COMPRESSED | (LZMA if method == 'lzma' else 0) | size
+
+def unpack_length(length):
+    '''Return: the size in bytes and method of a compressed cluster.'''
+    return length & SIZE_MASK, 'lzma' if length & LZMA else 'zlib'
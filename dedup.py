@@ -0,0 +1,261 @@
+from __future__ import print_function, absolute_import, division
+
+import hashlib
+import struct
+import threading
+
+from errno import ENOSPC
+
+from locks import synchronized
+
+"""
+Deduplication:
+On a disk formatted with --dedup every block of a regular file that is
+written is hashed, and a block whose contents are already stored is
+mapped to the stored copy instead of being written again. A block that
+more than one file block is mapped to is shared, and is copied on write:
+writing to it maps the file block to a new block and drops a reference.
+Releasing a block (unlink, truncate, punching a hole) drops a reference,
+and the block is only freed with its last one.
+
+The index of stored blocks is the data of an index file, which is in no
+directory; its metadata block is DEDUP_INDEX in the superblock. Like a
+directory (see directory) the data is a hash table of BUCKETS blocks,
+always a power of two, and the entry of a digest lives in bucket
+DIGEST % BUCKETS. Each bucket block holds entries one after the other:
+BLOCK # PTR_SIZE bytes, the data block, 0 ends the bucket
+REFS # 4 bytes, number of file blocks mapped to it
+DIGEST # DIGEST_SIZE bytes, blake2b of the contents
+When an entry does not fit in its bucket the number of buckets is doubled.
+An operation may change every bucket, and all of them must fit in one
+commit of the journal, so the table takes at most half of it: when it
+cannot double the blocks mapped once leave the index instead. Data
+blocks that are not in the index belong to one file block.
+"""
+DIGEST_SIZE = 16
+POINTER_FORMATS = {4: '>II', 8: '>QI'}
+
+_structs = {}
+
+def entry_struct(ptr_size):
+    '''Returns the precompiled Struct of an entry header.'''
+    if ptr_size not in _structs:
+        _structs[ptr_size] = struct.Struct(POINTER_FORMATS[ptr_size])
+    return _structs[ptr_size]
+
+def block_digest(block):
+    return hashlib.blake2b(block, digest_size=DIGEST_SIZE).digest()
+
+def bucket_of(digest, buckets):
+    '''Returns the bucket of digest in a table of buckets.'''
+    return int.from_bytes(digest[:4], 'big') & (buckets - 1)
+
+def unpack_entries(block, ptr_size):
+    '''Returns the (block, refs, digest) entries of a bucket block.'''
+    header = entry_struct(ptr_size)
+    entries = []
+    start = 0
+    while start + header.size + DIGEST_SIZE <= len(block):
+        physical, refs = header.unpack_from(block, start)
+        if physical == 0:
+            break
+        start += header.size
+        entries.append((physical, refs, bytes(block[start:start + DIGEST_SIZE])))
+        start += DIGEST_SIZE
+    return entries
+
+def pack_entries(entries, block_size, ptr_size):
+    '''Packs (block, refs, digest) entries into a bucket block.
+        Return: the block, or None if the entries do not fit.
+    '''
+    pack = entry_struct(ptr_size).pack
+    block = bytearray()
+    for physical, refs, digest in entries:
+        block += pack(physical, refs)
+        block += digest
+    if len(block) > block_size:
+        return None
+    return block.ljust(block_size, b'\x00')
+
+
+class DedupIndex(object):
+    '''The index of the stored blocks of a mounted Small. The whole index
+        is kept in memory, changes are written to the bucket they belong
+        to straight away, as metadata. Writers hold lock while they look
+        blocks up and change their mapping.
+    '''
+
+    def __init__(self, fs, block_num, entries=None):
+        self.fs = fs
+        self.inode = fs.load_inode(block_num)
+        # digest -> data block, and data block -> [refs, digest].
+        self.blocks = {}
+        self.entries = {}
+        self.lock = threading.RLock()
+        # file blocks mapped to a stored copy rather than written.
+        self.shared_writes = 0
+        if entries is None:
+            entries = self.read_table()
+        for physical, refs, digest in entries:
+            self.blocks[digest] = physical
+            self.entries[physical] = [refs, digest]
+
+    def bucket_count(self):
+        return self.inode.size // self.fs.block_size
+
+    def read_bucket(self, bucket):
+        physical = self.inode.extents.lookup(bucket)
+        if not self.fs.data_start <= physical < self.fs.allocator.num_blocks:
+            return []
+        return unpack_entries(self.fs.disk.get(physical), self.fs.ptr_size)
+
+    def read_table(self):
+        entries = []
+        for bucket in range(self.bucket_count()):
+            entries += self.read_bucket(bucket)
+        return entries
+
+    @synchronized
+    def digest_of(self, physical):
+        '''Return: the digest of an indexed block, or None.'''
+        entry = self.entries.get(physical)
+        return entry[1] if entry is not None else None
+
+    @synchronized
+    def refs(self, physical):
+        '''Return: the number of file blocks mapped to physical.'''
+        entry = self.entries.get(physical)
+        return entry[0] if entry is not None else 1
+
+    @synchronized
+    def share(self, digest):
+        '''Takes a reference to the stored copy of digest.
+            Return: its block, or 0 if there is none.
+        '''
+        physical = self.blocks.get(digest, 0)
+        if physical:
+            self.shared_writes += 1
+            self.entries[physical][0] += 1
+            self.save(digest)
+        return physical
+
+    @synchronized
+    def add(self, digest, physical):
+        '''Indexes physical, which holds digest and is mapped once.'''
+        self.blocks[digest] = physical
+        self.entries[physical] = [1, digest]
+        self.save(digest)
+
+    @synchronized
+    def claim(self, physical):
+        '''Takes physical out of the index if no other file block is
+            mapped to it, so that it can be written in place.
+            Return: False if it is shared.
+        '''
+        entry = self.entries.get(physical)
+        if entry is None:
+            return True
+        if entry[0] > 1:
+            return False
+        del self.entries[physical]
+        del self.blocks[entry[1]]
+        self.save(entry[1])
+        return True
+
+    @synchronized
+    def release(self, physical):
+        '''Drops a reference to physical.
+            Return: True if it is no longer used and can be freed.
+        '''
+        entry = self.entries.get(physical)
+        if entry is None:
+            return True
+        entry[0] -= 1
+        if entry[0] == 0:
+            del self.entries[physical]
+            del self.blocks[entry[1]]
+        self.save(entry[1])
+        return entry[0] == 0
+
+    @synchronized
+    def extend(self, entries):
+        '''Adds (block, refs, digest) entries of blocks that are not
+            indexed, writing the table once.
+        '''
+        for physical, refs, digest in entries:
+            self.blocks[digest] = physical
+            self.entries[physical] = [refs, digest]
+        self.write_table(max(1, self.bucket_count()))
+
+    @synchronized
+    def move(self, physical, target):
+        '''Points the entry of physical, if there is one, at target.'''
+        entry = self.entries.pop(physical, None)
+        if entry is not None:
+            self.entries[target] = entry
+            self.blocks[entry[1]] = target
+            self.save(entry[1])
+
+    def save(self, digest):
+        '''Writes the bucket of digest, doubling the table when it is full
+            and there is room for it in the journal.
+        '''
+        buckets = self.bucket_count()
+        if buckets:
+            bucket = bucket_of(digest, buckets)
+            entries = [entry for entry in self.read_bucket(bucket) if entry[2] != digest]
+            physical = self.blocks.get(digest)
+            if physical is not None:
+                entries.append((physical, self.entries[physical][0], digest))
+            block = pack_entries(entries, self.fs.block_size, self.fs.ptr_size)
+            if block is not None:
+                self.fs.disk.write_block(self.inode.extents.lookup(bucket), block,
+                                         metadata=True)
+                return
+        self.write_table(buckets * 2 if buckets and self.fits(buckets * 2) else max(buckets, 1))
+
+    def fits(self, buckets):
+        '''Return: True if a table of buckets leaves as much room again in
+            the journal, for the other blocks of an operation.
+        '''
+        return self.fs.disk.fits(2 * buckets + len(self.inode.extents.overflow) + 4)
+
+    @synchronized
+    def write_table(self, buckets=1):
+        '''Writes every entry into a table of at least buckets buckets.'''
+        fs = self.fs
+        while True:
+            table = [[] for i in range(buckets)]
+            for physical, (refs, digest) in self.entries.items():
+                table[bucket_of(digest, buckets)].append((physical, refs, digest))
+            blocks = [pack_entries(entries, fs.block_size, fs.ptr_size) for entries in table]
+            if None not in blocks:
+                break
+            if self.fits(buckets * 2):
+                buckets *= 2
+                continue
+            # only shared blocks have to be indexed.
+            unshared = [physical for physical, entry in self.entries.items() if entry[0] == 1]
+            if not unshared:
+                raise IOError(ENOSPC, 'The dedup index does not fit in the journal')
+            for physical in unshared:
+                del self.blocks[self.entries.pop(physical)[1]]
+
+        extent_map = self.inode.extents
+        for logical, physical, length in extent_map.runs(0, buckets):
+            if physical == 0:
+                fs.allocate_blocks(extent_map, logical, length)
+        for physical, length in extent_map.truncate(buckets):
+            fs.allocator.free(physical, length)
+        for bucket, block in enumerate(blocks):
+            fs.disk.write_block(extent_map.lookup(bucket), block, metadata=True)
+        self.inode.size = buckets * fs.block_size
+        fs.write_inode(self.inode)
+
+    @synchronized
+    def stats(self):
+        refs = sum(entry[0] for entry in self.entries.values())
+        return dict(indexed=len(self.entries),
+                    shared=sum(1 for entry in self.entries.values() if entry[0] > 1),
+                    blocks_saved=refs - len(self.entries),
+                    shared_writes=self.shared_writes)
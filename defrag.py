@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+from __future__ import print_function, absolute_import, division
+
+import json
+import threading
+
+from errno import ENOSPC
+from stat import S_ISDIR
+
+import disktools
+
+from extents import ExtentMap
+
+"""
+Defragmenter:
+A file is fragmented when its data is spread over several runs of blocks
+on disk. Its score is (fragments - 1) / (blocks - 1): 0 when the data is
+in one run, 1 when no two blocks are next to each other.
+
+relocate copies the data of a file into a single run of free blocks,
+taken as close to the start of the data region as there is room, so
+that free space is compacted towards the end of the disk as files are
+moved. The new block map and the release of the old blocks are one
+operation, so the journal commits them together: after a crash the file
+has either its old blocks or its new ones. Compressed clusters stay where
+they are, only the plain blocks of a file are moved, and a file with
+blocks shared with other files (see dedup) is left alone.
+
+It runs offline on an image, or while mounted in a background thread
+that moves at most RATE blocks per second and rescans every INTERVAL
+seconds (small.py --defrag).
+"""
+# blocks copied per read and write.
+BATCH = 256
+# blocks moved per second by the background thread.
+RATE = 1024
+# seconds between scans of the background thread.
+INTERVAL = 30
+
+
+def fragments(extent_map):
+    '''Number of runs of blocks the data of a file is in on disk.'''
+    count = 0
+    end = None
+    for physical, length in extent_map.physical_runs():
+        if physical != end:
+            count += 1
+        end = physical + length
+    return count
+
+def score(extent_map):
+    blocks = extent_map.mapped()
+    if blocks < 2:
+        return 0.0
+    return (fragments(extent_map) - 1) / (blocks - 1)
+
+
+class Defragmenter(object):
+    '''Measures and reduces the fragmentation of a mounted Small.'''
+
+    def __init__(self, fs):
+        self.fs = fs
+        # metadata block -> fragments of the files that could not be
+        # improved, skipped until they change.
+        self.stuck = {}
+        self.moved = 0
+        self.relocated = 0
+
+    def files(self):
+        '''Return: every file, (metadata block, Inode).'''
+        fs = self.fs
+        files = []
+        with fs.tree_lock():
+            for block_num in range(fs.inode_start, fs.data_start):
+                if fs.allocator.is_free(block_num):
+                    continue
+                # files that are not loaded are decoded just for the scan,
+                # step loads the ones that are moved.
+                inode = fs.inodes.get(block_num) or fs.read_inode(block_num)
+                # files unlinked while open are about to go, the dedup
+                # index changes under its own lock.
+                if inode.nlink and (fs.dedup is None or inode is not fs.dedup.inode):
+                    files.append((block_num, inode))
+        return files
+
+    def free_space(self):
+        '''Return: the number of runs of free data blocks and the longest.'''
+        allocator = self.fs.allocator
+        runs = longest = 0
+        block_num, end = self.fs.data_start, allocator.num_blocks
+        while block_num < end:
+            start = allocator.find_free(block_num, block_num, end)
+            if start == -1:
+                break
+            length = allocator.run_length(start, end - start, end)
+            runs += 1
+            longest = max(longest, length)
+            block_num = start + length
+        return runs, longest
+
+    def report(self):
+        '''Return: fragmentation statistics of the file system.'''
+        files = self.files()
+        scores = [score(inode.extents) for block_num, inode in files
+                  if inode.extents.mapped() > 1]
+        free_runs, longest_free = self.free_space()
+        return dict(
+            files=len(files),
+            fragmented=sum(1 for value in scores if value > 0),
+            blocks=sum(inode.extents.mapped() for block_num, inode in files),
+            fragments=sum(fragments(inode.extents) for block_num, inode in files),
+            mean_score=sum(scores) / len(scores) if scores else 0.0,
+            worst_score=max(scores) if scores else 0.0,
+            free_runs=free_runs,
+            longest_free_run=longest_free,
+            relocated=self.relocated,
+            blocks_moved=self.moved)
+
+    def candidates(self, threshold=0.0):
+        '''Return: the metadata blocks of the files scoring above
+            threshold, the most fragmented first.
+        '''
+        found = []
+        for block_num, inode in self.files():
+            extent_map = inode.extents
+            count = fragments(extent_map)
+            if count > 1 and score(extent_map) > threshold and \
+                    self.stuck.get(block_num) != count:
+                found.append((count, block_num))
+        found.sort(reverse=True)
+        return [block_num for count, block_num in found]
+
+    def relocate(self, inode):
+        '''Moves the data of inode into one run of blocks. The caller holds
+            the lock of the file.
+            Return: the number of blocks moved, 0 if there was no room.
+        '''
+        fs = self.fs
+        fs.flush_buffer(inode)
+        if fs.dedup is None:
+            return self.move(inode)
+        # no block of the file may be shared while it is moved.
+        with fs.dedup.lock:
+            if any(fs.dedup.refs(physical) > 1 for physical in inode.extents.physical_blocks()):
+                self.stuck[inode.block_num] = fragments(inode.extents)
+                return 0
+            return self.move(inode)
+
+    def move(self, inode):
+        fs = self.fs
+        old = inode.extents
+        count = old.mapped()
+        before = fragments(ExtentMap(old.extents()))
+        if before < 2:
+            # only compressed clusters are apart.
+            self.stuck[inode.block_num] = fragments(old)
+            return 0
+        try:
+            runs = fs.allocator.allocate(count, fs.data_start)
+        except IOError as e:
+            if e.errno != ENOSPC:
+                raise
+            runs = []
+        if not runs or len(runs) >= before:
+            for physical, length in runs:
+                fs.allocator.free(physical, length)
+            self.stuck[inode.block_num] = fragments(old)
+            return 0
+
+        # (logical, old physical, new physical, length) pieces.
+        pieces = []
+        targets = iter(runs)
+        target, room = next(targets)
+        for logical, physical, length in old.extents():
+            while length:
+                if not room:
+                    target, room = next(targets)
+                step = min(length, room)
+                pieces.append((logical, physical, target, step))
+                logical += step
+                physical += step
+                target += step
+                room -= step
+                length -= step
+
+        # directory buckets stay journaled like any other directory write.
+        metadata = S_ISDIR(inode.mode)
+        new = ExtentMap(overflow=old.overflow, block_size=old.block_size)
+        new.clusters = old.clusters
+        for logical, physical, target, length in pieces:
+            for start in range(0, length, BATCH):
+                step = min(BATCH, length - start)
+                data = fs.disk.read_blocks(list(range(physical + start, physical + start + step)))
+                for i in range(step):
+                    fs.disk.write_block(target + start + i,
+                        data[i * fs.block_size:(i + 1) * fs.block_size], metadata=metadata)
+                    if fs.dedup is not None:
+                        fs.dedup.move(physical + start + i, target + start + i)
+            new.add(logical, target, length)
+        inode.extents = new
+        fs.write_inode(inode)
+        for physical, length in zip(old.physical, old.length):
+            fs.allocator.free(physical, length)
+
+        self.stuck.pop(inode.block_num, None)
+        self.relocated += 1
+        self.moved += count
+        return count
+
+    def step(self, block_num):
+        '''Relocates the file at block_num if it is still there.
+            Return: the number of blocks moved.
+        '''
+        fs = self.fs
+        with fs.tree_lock():
+            if fs.allocator.is_free(block_num):
+                return 0
+            inode = fs.load_inode(block_num)
+        with fs.file_lock(inode):
+            if fs.allocator.is_free(block_num) or fs.inodes.get(block_num) is not inode:
+                # unlinked in between.
+                return 0
+            moved = self.relocate(inode)
+        fs.end_operation()
+        return moved
+
+    def defragment(self, threshold=0.0):
+        '''Relocates every file scoring above threshold.
+            Return: the number of blocks moved.
+        '''
+        moved = 0
+        for block_num in self.candidates(threshold):
+            moved += self.step(block_num)
+        return moved
+
+
+class DefragThread(threading.Thread):
+    '''Defragments a mounted Small in the background, moving at most rate
+        blocks per second, until stop is called.
+    '''
+
+    def __init__(self, fs, rate=RATE, interval=INTERVAL, threshold=0.0):
+        threading.Thread.__init__(self, name='defrag')
+        self.daemon = True
+        self.defragmenter = Defragmenter(fs)
+        self.rate = rate
+        self.interval = interval
+        self.threshold = threshold
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            for block_num in self.defragmenter.candidates(self.threshold):
+                moved = self.defragmenter.step(block_num)
+                if self.stopped.wait(moved / self.rate):
+                    return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def print_report(name, report):
+    print('%s: %d files, %d fragmented, %d fragments over %d blocks, mean score %.3f, '
+          'free space in %d runs (longest %d)'
+          % (name, report['files'], report['fragmented'], report['fragments'],
+             report['blocks'], report['mean_score'], report['free_runs'],
+             report['longest_free_run']))
+
+if __name__ == '__main__':
+    import argparse
+    from small import Small
+    parser = argparse.ArgumentParser(description='Defragment an unmounted Small disk image.')
+    parser.add_argument('disk', nargs='?', default=disktools.DISK_NAME)
+    parser.add_argument('--threshold', type=float, default=0.0,
+                        help='only move files scoring above this, 0 to 1')
+    parser.add_argument('--dry-run', action='store_true', help='only report')
+    parser.add_argument('--json', action='store_true', help='print the reports as JSON')
+    args = parser.parse_args()
+
+    disktools.DISK_NAME = args.disk
+    fs = Small()
+    defragmenter = Defragmenter(fs)
+    reports = dict(before=defragmenter.report())
+    if not args.dry_run:
+        defragmenter.defragment(args.threshold)
+        reports['after'] = defragmenter.report()
+    fs.destroy('/')
+    disktools.close_device()
+
+    if args.json:
+        print(json.dumps(reports, indent=2, sort_keys=True))
+    else:
+        for name in ('before', 'after'):
+            if name in reports:
+                print_report(name, reports[name])
@@ -0,0 +1,63 @@
+import struct
+import zlib
+
+"""
+Directory entries:
+A directory's data is a hash table of BUCKETS blocks, where BUCKETS is
+SIZE / BLOCK_SIZE and always a power of two. An entry for name lives in
+bucket crc32(name) % BUCKETS. Each bucket block holds entries one after
+the other:
+INODE # PTR_SIZE bytes, metadata block of the file, 0 ends the bucket
+NAME_LENGTH # 1 byte
+NAME # NAME_LENGTH bytes, utf-8
+When an entry does not fit in its bucket the number of buckets is doubled
+and every entry is moved to its new bucket.
+"""
+MAX_NAME_LENGTH = 255
+POINTER_FORMATS = {4: '>IB', 8: '>QB'}
+
+_structs = {}
+
+def entry_struct(ptr_size):
+    '''Returns the precompiled Struct of an entry header.'''
+    if ptr_size not in _structs:
+        _structs[ptr_size] = struct.Struct(POINTER_FORMATS[ptr_size])
+    return _structs[ptr_size]
+
+def name_max(block_size, ptr_size):
+    '''Longest name that fits in a bucket on its own.'''
+    return min(MAX_NAME_LENGTH, block_size - entry_struct(ptr_size).size)
+
+def bucket_of(name, buckets):
+    '''Returns the bucket of an encoded name in a table of buckets.'''
+    return zlib.crc32(name) & (buckets - 1)
+
+def entry_size(name, ptr_size):
+    return entry_struct(ptr_size).size + len(name)
+
+def unpack_entries(block, ptr_size):
+    '''Returns the (name, inode) entries of a bucket block, names encoded.'''
+    header = entry_struct(ptr_size)
+    entries = []
+    start = 0
+    while start + header.size <= len(block):
+        ino, length = header.unpack_from(block, start)
+        if ino == 0:
+            break
+        start += header.size
+        entries.append((bytes(block[start:start + length]), ino))
+        start += length
+    return entries
+
+def pack_entries(entries, block_size, ptr_size):
+    '''Packs (name, inode) entries into a bucket block.
+        Return: the block, or None if the entries do not fit.
+    '''
+    pack = entry_struct(ptr_size).pack
+    block = bytearray()
+    for name, ino in entries:
+        block += pack(ino, len(name))
+        block += name
+    if len(block) > block_size:
+        return None
+    return block.ljust(block_size, b'\x00')
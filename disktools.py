@@ -1,38 +1,313 @@
 from __future__ import print_function, division
 import io
+import mmap
 import os
 
-NUM_BLOCKS = 16
-BLOCK_SIZE = 64
+NUM_BLOCKS = 256
+BLOCK_SIZE = 512
+MIN_BLOCK_SIZE = 128
 DISK_NAME = 'my-disk'
 
-def low_level_format():
-    '''Creates the file system space on disk.
+"""
+Superblock (always at byte 0 of the image, block 0):
+MAGIC # 4 bytes
+BLOCK_SIZE # 4 bytes
+NUM_BLOCKS # 8 bytes
+PTR_SIZE # 1 byte, width of block pointers, 4 or 8 bytes
+BITMAP_START # 8 bytes, first free space bitmap block
+BITMAP_BLOCKS # 8 bytes, number of bitmap blocks
+JOURNAL_START # 8 bytes, first journal block
+JOURNAL_BLOCKS # 8 bytes, number of journal blocks
+INODE_START # 8 bytes, first metadata block
+INODE_COUNT # 8 bytes, number of metadata blocks
+DATA_START # 8 bytes, first data block
+FREE_BLOCKS # 8 bytes, number of free data blocks
+FREE_INODES # 8 bytes, number of free metadata blocks
+CLEAN # 1 byte, 1 if the file system was unmounted cleanly
+DEDUP_INDEX # 8 bytes, metadata block of the dedup index (see dedup), 0
+            # if the disk was formatted without deduplication
+= 98 bytes.
+Disks formatted before DEDUP_INDEX was added read it as 0.
+"""
+SUPERBLOCK_MAGIC = b'SMFS'
+SUPERBLOCK_FIELDS = [
+    ('block_size', 4),
+    ('num_blocks', 8),
+    ('ptr_size', 1),
+    ('bitmap_start', 8),
+    ('bitmap_blocks', 8),
+    ('journal_start', 8),
+    ('journal_blocks', 8),
+    ('inode_start', 8),
+    ('inode_count', 8),
+    ('data_start', 8),
+    ('free_blocks', 8),
+    ('free_inodes', 8),
+    ('clean', 1),
+    ('dedup_index', 8)]
+SUPERBLOCK_SIZE = 4 + sum(size for name, size in SUPERBLOCK_FIELDS)
+
+class BlockDevice(object):
+    '''A disk image that is opened once and kept open.
+        Blocks are served as memoryview slices over an mmap of the image.
+        If the image cannot be mapped, pread/pwrite are used instead.
+    '''
+
+    def __init__(self, disk_name=DISK_NAME, block_size=None, use_mmap=True):
+        self.disk_name = disk_name
+        self.fd = os.open(disk_name, os.O_RDWR)
+        if block_size is None:
+            # take the block size from the superblock if there is one.
+            superblock = decode_superblock(os.pread(self.fd, SUPERBLOCK_SIZE, 0))
+            block_size = superblock['block_size'] if superblock else BLOCK_SIZE
+        self.block_size = block_size
+        size = os.fstat(self.fd).st_size
+        self.num_blocks = size // block_size
+        self.map = None
+        self.view = None
+        if use_mmap and size > 0:
+            try:
+                self.map = mmap.mmap(self.fd, size)
+                self.view = memoryview(self.map)
+            except (mmap.error, ValueError, OSError):
+                self.map = None
+
+        # blocks moved and calls made, see stats.
+        self.reads = 0
+        self.writes = 0
+        self.read_calls = 0
+        self.write_calls = 0
+        self.flushes = 0
+
+    def check(self, block_num):
+        if block_num < 0 or block_num >= self.num_blocks:
+            raise IOError('Block number out of range')
+
+    def block(self, block_num):
+        '''Returns block_num block as a memoryview.
+            With mmap this is a zero-copy slice of the image, so writes
+            through it go straight to the disk.
+        '''
+        self.check(block_num)
+        start = block_num * self.block_size
+        if self.view is not None:
+            return self.view[start:start + self.block_size]
+        return memoryview(bytearray(os.pread(self.fd, self.block_size, start)))
+
+    def read_block(self, block_num):
+        '''Reads block_num block.
+            Return: a bytearray of block_size
+        '''
+        self.check(block_num)
+        self.reads += 1
+        self.read_calls += 1
+        start = block_num * self.block_size
+        if self.view is not None:
+            return bytearray(self.view[start:start + self.block_size])
+        return bytearray(os.pread(self.fd, self.block_size, start))
+
+    def write_block(self, block_num, data):
+        '''Writes data to the block_num block.'''
+        self.check(block_num)
+        if len(data) > self.block_size:
+            raise IOError('Data is larger than a block')
+        self.writes += 1
+        self.write_calls += 1
+        start = block_num * self.block_size
+        if self.view is not None:
+            self.view[start:start + len(data)] = data
+        else:
+            os.pwrite(self.fd, bytes(data), start)
+
+    def read_blocks(self, block_nums):
+        '''Reads several blocks with as few calls as possible.
+            Blocks that are next to each other on disk are read together,
+            with a single preadv when there is no mmap.
+            Return: a bytearray of the blocks, in the order of block_nums.
+        '''
+        block_size = self.block_size
+        data = bytearray(len(block_nums) * block_size)
+        view = memoryview(data)
+        for block_num, positions in block_runs(block_nums):
+            self.check(block_num + len(positions) - 1)
+            self.reads += len(positions)
+            self.read_calls += 1
+            start = block_num * block_size
+            end = start + len(positions) * block_size
+            if positions == list(range(positions[0], positions[-1] + 1)):
+                # the run also lands in one piece of data.
+                buffers = [view[positions[0] * block_size:
+                                (positions[-1] + 1) * block_size]]
+            else:
+                buffers = [view[i * block_size:(i + 1) * block_size]
+                           for i in positions]
+            if self.view is not None:
+                source = self.view[start:end]
+                offset = 0
+                for buffer in buffers:
+                    buffer[:] = source[offset:offset + len(buffer)]
+                    offset += len(buffer)
+            elif hasattr(os, 'preadv'):
+                os.preadv(self.fd, buffers, start)
+            else:
+                for buffer in buffers:
+                    buffer[:] = os.pread(self.fd, len(buffer), start)
+                    start += len(buffer)
+        return data
+
+    def write_blocks(self, blocks):
+        '''Writes a dict of block number -> block data, merging blocks that
+            are next to each other on disk into a single write.
+        '''
+        block_size = self.block_size
+        for block_num, positions in block_runs(sorted(blocks)):
+            block_nums = range(block_num, block_num + len(positions))
+            self.check(block_nums[-1])
+            buffers = [blocks[i] for i in block_nums]
+            for buffer in buffers:
+                if len(buffer) != block_size:
+                    raise IOError('Vectored writes must be whole blocks')
+            self.writes += len(buffers)
+            self.write_calls += 1
+            start = block_num * block_size
+            if self.view is not None:
+                self.view[start:start + len(buffers) * block_size] = b''.join(buffers)
+            elif hasattr(os, 'pwritev'):
+                os.pwritev(self.fd, buffers, start)
+            else:
+                os.pwrite(self.fd, b''.join(buffers), start)
+
+    def flush(self):
+        '''Forces written blocks out to the image file.'''
+        self.flushes += 1
+        if self.map is not None:
+            self.map.flush()
+        os.fsync(self.fd)
+
+    def stats(self):
+        return dict(
+            reads=self.reads,
+            writes=self.writes,
+            read_calls=self.read_calls,
+            write_calls=self.write_calls,
+            flushes=self.flushes)
+
+    def close(self):
+        if self.fd is None:
+            return
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # a caller still holds a block view; the map is closed
+                # when that view is garbage collected.
+                pass
+            self.map = None
+        os.close(self.fd)
+        self.fd = None
+
+
+def block_runs(block_nums):
+    '''Groups block numbers into runs of consecutive blocks.
+        Return: a list of (first block, positions) where positions are the
+        indexes in block_nums of the blocks of the run, in disk order.
+    '''
+    order = sorted(range(len(block_nums)), key=block_nums.__getitem__)
+    runs = []
+    for i in order:
+        if runs and block_nums[runs[-1][1][-1]] + 1 == block_nums[i]:
+            runs[-1][1].append(i)
+        else:
+            runs.append((block_nums[i], [i]))
+    return runs
+
+
+# The device used by the module level functions below.
+default_device = None
+
+def get_device():
+    '''Returns the default BlockDevice, opening DISK_NAME on first use.'''
+    global default_device
+    if default_device is None:
+        default_device = BlockDevice(DISK_NAME)
+    return default_device
+
+def close_device():
+    '''Closes the default BlockDevice. It is reopened on next use.'''
+    global default_device
+    if default_device is not None:
+        default_device.close()
+        default_device = None
+
+def pointer_size(num_blocks):
+    '''Number of bytes needed for a block pointer on a disk of num_blocks.'''
+    return 4 if num_blocks <= 2 ** 32 else 8
+
+def encode_superblock(superblock):
+    '''Packs a superblock dict into a bytearray of SUPERBLOCK_SIZE.'''
+    data = bytearray(SUPERBLOCK_MAGIC)
+    for name, size in SUPERBLOCK_FIELDS:
+        data += int_to_bytes(superblock.get(name, 0), size)
+    return data
+
+def decode_superblock(data):
+    '''Unpacks a superblock. Returns None if data has no valid superblock.'''
+    if bytes(data[0:4]) != SUPERBLOCK_MAGIC:
+        return None
+    superblock = {}
+    start = 4
+    for name, size in SUPERBLOCK_FIELDS:
+        superblock[name] = bytes_to_int(data[start:start + size])
+        start += size
+    return superblock
+
+def read_superblock():
+    '''Reads the superblock of the default device.'''
+    return decode_superblock(read_block(0))
+
+def write_superblock(superblock):
+    '''Writes the superblock of the default device.'''
+    write_block(0, encode_superblock(superblock))
+
+def low_level_format(block_size=BLOCK_SIZE, num_blocks=NUM_BLOCKS):
+    '''Creates the file system space on disk and writes the disk geometry
+        to the superblock.
         Warning: calling this erases any existing data in the file system.
     '''
+    if block_size < MIN_BLOCK_SIZE:
+        raise ValueError('Block size must be at least %d bytes' % MIN_BLOCK_SIZE)
+    close_device()
     with open(DISK_NAME, 'w+b') as disk:
-        for i in range(NUM_BLOCKS):
-            block = bytearray([0] * BLOCK_SIZE)
-            disk.write(block)
+        # truncate leaves the image sparse, so large disks are cheap to create.
+        disk.truncate(block_size * num_blocks)
+        disk.write(encode_superblock(dict(
+            block_size=block_size,
+            num_blocks=num_blocks,
+            ptr_size=pointer_size(num_blocks))))
         disk.flush()
 
 def read_block(block_num):
     '''Reads block_num block from the file system.
         Return: a bytearray of BLOCK_SIZE
     '''
-    if block_num >= NUM_BLOCKS:
-        raise IOError('Block number out of range')
-    with open(DISK_NAME, 'rb') as disk:
-        disk.seek(block_num * BLOCK_SIZE)
-        return bytearray(disk.read(BLOCK_SIZE)) #.encode())
+    return get_device().read_block(block_num)
 
 def write_block(block_num, data):
     '''Writes data to the block_num block.'''
-    if block_num >= NUM_BLOCKS:
-        raise IOError('Block number out of range')
-    with open(DISK_NAME, 'r+b') as disk:
-        disk.seek(block_num * BLOCK_SIZE)
-        disk.write(data)
+    get_device().write_block(block_num, data)
+
+def read_blocks(block_nums):
+    '''Reads several blocks from the file system.
+        Return: a bytearray of the blocks, in the order of block_nums.
+    '''
+    return get_device().read_blocks(block_nums)
+
+def write_blocks(blocks):
+    '''Writes a dict of block number -> block data.'''
+    get_device().write_blocks(blocks)
 
 def print_block(block_num):
     '''Prints block_num block data.'''
@@ -64,6 +339,12 @@ def bytes_to_int(bytes):
     return value
         
 if __name__ == '__main__':
-    low_level_format()
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE)
+    parser.add_argument('--num-blocks', type=int, default=NUM_BLOCKS)
+    args = parser.parse_args()
+
+    low_level_format(args.block_size, args.num_blocks)
     os.system('od --address-radix=x -t x1 -a my-disk')
     
\ No newline at end of file
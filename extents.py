@@ -0,0 +1,278 @@
+import struct
+
+from bisect import bisect_right
+
+from compress import COMPRESSED, cluster_blocks, pack_length, unpack_length
+
+"""
+Extent:
+LOGICAL # PTR_SIZE bytes, first block of the run within the file
+PHYSICAL # PTR_SIZE bytes, first block of the run on disk
+LENGTH # 4 bytes, number of blocks in the run, or with the top bit set
+       # a compressed cluster (see compress)
+= 2 * PTR_SIZE + 4 bytes, big-endian.
+
+The first extents of a file are stored in its metadata block after the
+name. Extents that do not fit there go into overflow blocks, which are
+filled with extents and end with a PTR_SIZE pointer to the next one.
+"""
+LENGTH_SIZE = 4
+MAX_LENGTH = COMPRESSED - 1
+EXTENT_FORMATS = {4: '>III', 8: '>QQI'}
+
+_structs = {}
+
+def extent_struct(ptr_size):
+    '''Returns the precompiled Struct of one extent.'''
+    if ptr_size not in _structs:
+        _structs[ptr_size] = struct.Struct(EXTENT_FORMATS[ptr_size])
+    return _structs[ptr_size]
+
+def extent_size(ptr_size):
+    return extent_struct(ptr_size).size
+
+def pack_extents(extents, ptr_size):
+    '''Packs a list of (logical, physical, length) tuples into bytes.'''
+    pack = extent_struct(ptr_size).pack
+    return b''.join([pack(*extent) for extent in extents])
+
+def unpack_extents(data, count, ptr_size):
+    '''Unpacks count (logical, physical, length) tuples from data.'''
+    extent = extent_struct(ptr_size)
+    return list(extent.iter_unpack(memoryview(data)[:count * extent.size]))
+
+
+class ExtentMap(object):
+    '''Maps the logical blocks of a file to physical blocks on disk.
+        Extents are kept sorted by logical block, so the block holding any
+        offset is found with a binary search. Logical blocks that are not
+        covered by an extent are holes.
+        Compressed clusters are kept apart, the logical blocks they cover
+        are holes to the extents. Reading them needs the block_size.
+    '''
+
+    def __init__(self, extents=(), overflow=(), block_size=0):
+        self.logical = []
+        self.physical = []
+        self.length = []
+        # overflow blocks holding the extents that do not fit in the
+        # metadata block.
+        self.overflow = list(overflow)
+        # first logical block -> (physical, length, size in bytes, method)
+        # of each compressed cluster.
+        self.clusters = {}
+        self.block_size = block_size
+        for logical, physical, length in extents:
+            if length & COMPRESSED:
+                self.add_cluster(logical, physical, *unpack_length(length))
+                continue
+            self.logical.append(logical)
+            self.physical.append(physical)
+            self.length.append(length)
+
+    def __len__(self):
+        return len(self.logical)
+
+    def extents(self):
+        '''Returns the (logical, physical, length) extents of plain blocks.'''
+        return list(zip(self.logical, self.physical, self.length))
+
+    def stored(self):
+        '''Returns every extent as it is stored, compressed clusters too.'''
+        extents = self.extents()
+        if self.clusters:
+            extents += [(logical, physical, pack_length(size, method))
+                        for logical, (physical, length, size, method) in self.clusters.items()]
+            extents.sort()
+        return extents
+
+    @property
+    def cluster_blocks(self):
+        return cluster_blocks(self.block_size)
+
+    def add_cluster(self, logical, physical, size, method):
+        '''Maps the cluster from logical block to size bytes of data
+            compressed with method, from physical. Its logical blocks must
+            not be mapped.
+        '''
+        length = (size + self.block_size - 1) // self.block_size
+        self.clusters[logical] = (physical, length, size, method)
+
+    def remove_cluster(self, logical):
+        '''Unmaps the compressed cluster from logical block, if there is one.
+            Return: its (physical, length) run, or None.
+        '''
+        cluster = self.clusters.pop(logical, None)
+        if cluster is None:
+            return None
+        return cluster[0], cluster[1]
+
+    def clusters_in(self, block, count):
+        '''Returns the first logical blocks of the compressed clusters that
+            overlap count logical blocks from block.
+        '''
+        if not self.clusters:
+            return []
+        span = self.cluster_blocks
+        first = block - block % span
+        return [logical for logical in range(first, block + count, span)
+                if logical in self.clusters]
+
+    def find(self, block):
+        '''Returns the index of the extent holding logical block, or -1.'''
+        i = bisect_right(self.logical, block) - 1
+        if i >= 0 and block < self.logical[i] + self.length[i]:
+            return i
+        return -1
+
+    def lookup(self, block):
+        '''Returns the physical block of logical block, or 0 for a hole.'''
+        i = self.find(block)
+        if i == -1:
+            return 0
+        return self.physical[i] + block - self.logical[i]
+
+    def end(self):
+        '''Returns the logical block after the last mapped block.'''
+        end = self.logical[-1] + self.length[-1] if self.logical else 0
+        if self.clusters:
+            end = max(end, max(self.clusters) + self.cluster_blocks)
+        return end
+
+    def last_physical(self):
+        '''Returns the last physical block of the file, or 0 if it is empty.'''
+        if not self.logical:
+            return 0
+        return self.physical[-1] + self.length[-1] - 1
+
+    def add(self, block, physical, length=1):
+        '''Maps length logical blocks from block to physical blocks from
+            physical. The logical blocks must not already be mapped.
+            Neighbouring extents are merged when they are contiguous on disk.
+        '''
+        i = bisect_right(self.logical, block)
+        # merge with the extent before.
+        if (i > 0 and self.logical[i-1] + self.length[i-1] == block
+                and self.physical[i-1] + self.length[i-1] == physical
+                and self.length[i-1] + length <= MAX_LENGTH):
+            self.length[i-1] += length
+            i -= 1
+        else:
+            self.logical.insert(i, block)
+            self.physical.insert(i, physical)
+            self.length.insert(i, length)
+        # merge with the extent after.
+        if (i + 1 < len(self.logical)
+                and self.logical[i] + self.length[i] == self.logical[i+1]
+                and self.physical[i] + self.length[i] == self.physical[i+1]
+                and self.length[i] + self.length[i+1] <= MAX_LENGTH):
+            self.length[i] += self.length.pop(i+1)
+            self.logical.pop(i+1)
+            self.physical.pop(i+1)
+
+    def runs(self, block, count):
+        '''Splits count logical blocks from block into runs.
+            Return: a list of (logical, physical, length) where physical is
+            0 for runs that are holes.
+        '''
+        runs = []
+        end = block + count
+        i = bisect_right(self.logical, block) - 1
+        if i < 0 or block >= self.logical[i] + self.length[i]:
+            i += 1
+        while block < end:
+            if i < len(self.logical) and self.logical[i] <= block:
+                length = min(end, self.logical[i] + self.length[i]) - block
+                runs.append((block, self.physical[i] + block - self.logical[i],
+                             length))
+                i += 1
+            else:
+                hole_end = end
+                if i < len(self.logical):
+                    hole_end = min(end, self.logical[i])
+                runs.append((block, 0, hole_end - block))
+                length = hole_end - block
+            block += length
+        return runs
+
+    def truncate(self, blocks):
+        '''Unmaps every logical block from blocks onwards.
+            Return: the list of (physical, length) runs that were released.
+        '''
+        freed = []
+        while self.logical and self.logical[-1] + self.length[-1] > blocks:
+            logical = self.logical[-1]
+            physical = self.physical[-1]
+            length = self.length[-1]
+            keep = max(0, blocks - logical)
+            freed.append((physical + keep, length - keep))
+            if keep:
+                self.length[-1] = keep
+            else:
+                self.logical.pop()
+                self.physical.pop()
+                self.length.pop()
+        return freed
+
+    def punch(self, block, count):
+        '''Unmaps count logical blocks from block, splitting the extents
+            that reach past either end.
+            Return: the list of (physical, length) runs that were released.
+        '''
+        freed = []
+        end = block + count
+        i = bisect_right(self.logical, block) - 1
+        if i < 0 or block >= self.logical[i] + self.length[i]:
+            i += 1
+        while i < len(self.logical) and self.logical[i] < end:
+            logical = self.logical[i]
+            physical = self.physical[i]
+            length = self.length[i]
+            start = max(block, logical)
+            stop = min(end, logical + length)
+            freed.append((physical + start - logical, stop - start))
+            head = start - logical
+            tail = logical + length - stop
+            if head:
+                self.length[i] = head
+                i += 1
+                if tail:
+                    self.logical.insert(i, stop)
+                    self.physical.insert(i, physical + stop - logical)
+                    self.length.insert(i, tail)
+                    i += 1
+            elif tail:
+                self.logical[i] = stop
+                self.physical[i] = physical + stop - logical
+                self.length[i] = tail
+                i += 1
+            else:
+                self.logical.pop(i)
+                self.physical.pop(i)
+                self.length.pop(i)
+        return freed
+
+    def mapped(self):
+        '''Returns the number of logical blocks in plain extents.'''
+        return sum(self.length)
+
+    def allocated(self):
+        '''Returns the number of data blocks in use, compressed too.'''
+        return self.mapped() + sum(cluster[1] for cluster in self.clusters.values())
+
+    def physical_runs(self):
+        '''Returns the (physical, length) runs of the file, in logical order.'''
+        if not self.clusters:
+            return list(zip(self.physical, self.length))
+        runs = list(zip(self.logical, self.physical, self.length))
+        runs += [(logical, physical, length)
+                 for logical, (physical, length, size, method) in self.clusters.items()]
+        runs.sort()
+        return [(physical, length) for logical, physical, length in runs]
+
+    def physical_blocks(self):
+        '''Returns every physical data block of the file.'''
+        blocks = []
+        for physical, length in self.physical_runs():
+            blocks.extend(range(physical, physical + length))
+        return blocks
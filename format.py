@@ -1,71 +1,137 @@
+import allocator
 import disktools
+import extents
+import inode
+import journal
 import time
+import math
 import os
 
 from stat import S_IFDIR, S_IFLNK, S_IFREG
 
 """
-File metadata:
-MODE # 2 bytes
-UID # 2 bytes
-GID # 2 bytes
+Disk layout:
+block 0 is the superblock (see disktools).
+The next BITMAP_BLOCKS blocks are the free space bitmap (see allocator).
+The next JOURNAL_BLOCKS blocks are the metadata journal (see journal), none
+if JOURNAL_BLOCKS is 0.
+The next INODE_COUNT blocks store metadata, one file per block.
+The remaining blocks from DATA_START store file data.
 
-CTIME # 4 bytes
-MTIME # 4 bytes
-ATIME # 4 bytes
+File metadata: one block per file (see inode).
+Data blocks hold a full BLOCK_SIZE of file data.
+"""
 
-NLINKS # 1 byte
-SIZE # 2 bytes, size of file in bytes
-LOCATION # up to you how you do this
+def layout(block_size, num_blocks, inode_count=None, journal_blocks=None):
+    '''Works out where the metadata and data regions go on a disk.'''
+    if inode_count is None:
+        inode_count = max(1, num_blocks // 4)
+    if journal_blocks is None:
+        journal_blocks = journal.default_size(num_blocks)
+    ptr_size = disktools.pointer_size(num_blocks)
+    if block_size < inode.extent_offset(ptr_size) + extents.extent_size(ptr_size):
+        raise ValueError('Block size is too small for the metadata')
+    bitmap_blocks = int(math.ceil(num_blocks / (8 * block_size)))
+    journal_start = 1 + bitmap_blocks
+    inode_start = journal_start + journal_blocks
+    data_start = inode_start + inode_count
+    if data_start >= num_blocks:
+        raise ValueError('Disk is too small for %d files' % inode_count)
+    return dict(
+        block_size=block_size,
+        num_blocks=num_blocks,
+        ptr_size=ptr_size,
+        bitmap_start=1,
+        bitmap_blocks=bitmap_blocks,
+        journal_start=journal_start,
+        journal_blocks=journal_blocks,
+        inode_start=inode_start,
+        inode_count=inode_count,
+        data_start=data_start,
+        free_blocks=0,
+        free_inodes=0,
+        clean=0)
 
-NAME # can be here or elsewhere, 16 byte length allowed
-= 37 bytes minimum.
-One block = 64 bytes.
-"""
 def write_metadata(block_num, metadata):
+    superblock = disktools.read_superblock()
     block = disktools.read_block(block_num)
-    block[0:2]=disktools.int_to_bytes(metadata['st_mode'], 2)
-    block[2:4]=disktools.int_to_bytes(metadata['st_uid'], 2)
-    block[4:6]=disktools.int_to_bytes(metadata['st_gid'], 2)
-    
-    block[6:10]=disktools.int_to_bytes(int(metadata['st_ctime']), 4)
-    block[10:14]=disktools.int_to_bytes(int(metadata['st_mtime']), 4)
-    block[14:18]=disktools.int_to_bytes(int(metadata['st_atime']), 4)
-
-    block[18:19]=disktools.int_to_bytes(metadata['st_nlink'], 1)
-    block[19:21]=disktools.int_to_bytes(metadata['st_size'], 2)
-    block[21:22]=disktools.int_to_bytes(metadata['st_location'], 1)
+    metadata.pack_into(block, superblock['ptr_size'])
+    disktools.write_block(block_num, block)
 
-    block[22:38]=metadata['st_name'].encode('ascii')
+now = int(time.time())
 
-    disktools.write_block(block_num, block)
+def root_directory(block_num):
+    return inode.Inode(block_num,
+        mode=(S_IFDIR | 0o755),
+        uid=os.getuid(),
+        gid=os.getgid(),
+        ctime=now,
+        mtime=now,
+        atime=now,
+        nlink=2,
+        parent=block_num)
 
-    # for testing
-    print(disktools.read_block(block_num))
-    print(len(disktools.read_block(block_num)))
+def index_file(block_num):
+    return inode.Inode(block_num,
+        mode=(S_IFREG | 0o600),
+        uid=os.getuid(),
+        gid=os.getgid(),
+        ctime=now,
+        mtime=now,
+        atime=now,
+        nlink=1)
 
+def make_filesystem(block_size=None, num_blocks=None, inode_count=None,
+                    journal_blocks=None, dedup=False):
+    '''Writes an empty file system to the disk.
+        If a geometry is given the disk is low level formatted first,
+        otherwise the geometry in the existing superblock is used.
+        With dedup the disk gets an empty dedup index.
+    '''
+    superblock = None
+    if block_size is None and num_blocks is None and os.path.exists(disktools.DISK_NAME):
+        superblock = disktools.read_superblock()
+    if superblock is None:
+        disktools.low_level_format(block_size or disktools.BLOCK_SIZE,
+                                   num_blocks or disktools.NUM_BLOCKS)
+        superblock = disktools.read_superblock()
 
-# True means the block is empty and False means the block is being used.
-# First 5 blocks will store metadata.
-empty_file_block_list = [False, True, True, True, True]
-# The next 11 blocks will contain file data.
-empty_data_block_list = [True, True, True, True, True, True, True, True, True, True, True]
+    superblock = layout(superblock['block_size'], superblock['num_blocks'],
+                        inode_count, journal_blocks)
+    in_use = [(superblock['inode_start'], 1)]
+    if dedup:
+        if superblock['inode_count'] < 2:
+            raise ValueError('Disk is too small for the dedup index')
+        # the metadata block after the root directory.
+        superblock['dedup_index'] = superblock['inode_start'] + 1
+        in_use.append((superblock['dedup_index'], 1))
+    disktools.write_superblock(superblock)
+    for i in range(superblock['bitmap_start'], superblock['data_start']):
+        disktools.write_block(i, bytearray(superblock['block_size']))
+    if superblock['journal_blocks']:
+        journal.format_journal(disktools, superblock)
 
-now = time.time()
+    # only the root directory and the dedup index are in use.
+    free_space = allocator.Allocator(superblock)
+    free_space.rebuild(in_use)
+    free_space.flush(clean=True)
 
-metadata = dict(
-    st_mode=(S_IFDIR | 0o755),
-    st_uid=os.getuid(),
-    st_gid=os.getgid(),
-    st_ctime=now,
-    st_mtime=now,
-    st_atime=now,
-    st_nlink=2,
-    st_size=0,
-    st_location=0,
-    st_name='/')
+    # write metadata of the root directory.
+    write_metadata(superblock['inode_start'],
+                   root_directory(superblock['inode_start']))
+    if dedup:
+        write_metadata(superblock['dedup_index'], index_file(superblock['dedup_index']))
 
 if __name__ == '__main__':
-    # write metadata
-    write_metadata(0, metadata)
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--block-size', type=int)
+    parser.add_argument('--num-blocks', type=int)
+    parser.add_argument('--inode-count', type=int)
+    parser.add_argument('--journal-blocks', type=int)
+    parser.add_argument('--dedup', action='store_true',
+                        help='store identical data blocks once (see dedup)')
+    args = parser.parse_args()
 
+    make_filesystem(args.block_size, args.num_blocks, args.inode_count,
+                    args.journal_blocks, args.dedup)
@@ -0,0 +1,640 @@
+#!/usr/bin/env python
+from __future__ import print_function, absolute_import, division
+
+import json
+import sys
+
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from stat import S_ISDIR, S_ISLNK, S_ISREG
+
+import disktools
+import format
+
+from allocator import Allocator
+from compress import COMPRESSED, cluster_blocks, unpack_length
+from dedup import DedupIndex, bucket_of as digest_bucket, unpack_entries as unpack_index
+from directory import bucket_of, pack_entries, unpack_entries
+from extents import ExtentMap, extent_size, unpack_extents
+from inode import Inode, extent_offset
+from journal import Journal
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+Checker:
+Checks an unmounted image. The bitmap and the metadata region are read
+straight from the mmap of the image, with NumPy when it is installed:
+the bitmap is unpacked to one byte per block, and the metadata blocks in
+use are picked out of the whole region at once. Only the files found
+are then decoded one by one, and the blocks they use are marked a run at
+a time, never a block at a time.
+
+It checks that
+- the superblock geometry matches what format.py would have written,
+- every extent and overflow block lies in the data region, and every
+  compressed cluster starts on a cluster and is shorter than one,
+- no block is used by two files (cross-linked), unless it is in the
+  dedup index, which then has the number of file blocks mapped to it,
+- every directory entry is in its bucket and points to a file, and every
+  file is in exactly one directory (files unlinked while open, with
+  nlink 0, are orphans),
+- link counts, parent pointers and directory sizes are right, and inline
+  files fit in their metadata block,
+- the bitmap marks exactly the blocks in use, with no leaked blocks, and
+  the free counters match it.
+
+With --repair the journal is replayed first. Bad extents and entries are
+dropped, the later file of a cross-link loses the shared blocks, the
+dedup index is written again with the right counts, orphans
+and unreachable files are freed, link counts and parents are fixed, and
+the bitmap and free counters are rebuilt from the blocks in use.
+"""
+# exit status, as fsck(8).
+CLEAN = 0
+CORRECTED = 1
+UNCORRECTED = 4
+FAILED = 8
+
+# block numbers listed in a message.
+SHOW_BLOCKS = 8
+
+# bit i of a bitmap byte as one byte per block.
+BITS = [bytes((value >> i) & 1 for i in range(8)) for value in range(256)]
+
+
+def unpack_bitmap(bitmap, num_blocks):
+    '''Return: one byte per block, 1 where the bitmap has it in use.'''
+    if numpy is not None:
+        bits = numpy.unpackbits(numpy.frombuffer(bytes(bitmap), numpy.uint8),
+                                bitorder='little')
+        return bytearray(bits[:num_blocks].tobytes())
+    return bytearray(b''.join(map(BITS.__getitem__, bitmap))[:num_blocks])
+
+def differences(expected, actual):
+    '''Compares two maps of one byte per block.
+        Return: the blocks only in actual, and the blocks only in expected.
+    '''
+    if numpy is not None:
+        expected = numpy.frombuffer(expected, numpy.uint8)
+        actual = numpy.frombuffer(actual, numpy.uint8)
+        return (numpy.flatnonzero(actual > expected).tolist(),
+                numpy.flatnonzero(expected > actual).tolist())
+    extra, missing = [], []
+    chunk = 4096
+    for start in range(0, len(expected), chunk):
+        if expected[start:start + chunk] == actual[start:start + chunk]:
+            continue
+        for i in range(start, min(start + chunk, len(expected))):
+            if actual[i] > expected[i]:
+                extra.append(i)
+            elif expected[i] > actual[i]:
+                missing.append(i)
+    return extra, missing
+
+def show(block_nums):
+    '''Formats a list of blocks for a message.'''
+    text = ', '.join(str(block_num) for block_num in block_nums[:SHOW_BLOCKS])
+    if len(block_nums) > SHOW_BLOCKS:
+        text += ', ...'
+    return text
+
+
+class Checker(object):
+    '''Checks the file system on a BlockDevice, see the top of the file.
+        check finds the problems, repair fixes them through Small.
+    '''
+
+    def __init__(self, device):
+        self.device = device
+        superblock = disktools.decode_superblock(device.read_block(0))
+        if superblock is None:
+            raise IOError('Disk has no superblock')
+        try:
+            expected = format.layout(superblock['block_size'], superblock['num_blocks'],
+                                     superblock['inode_count'], superblock['journal_blocks'])
+        except ValueError as e:
+            raise IOError('Superblock is damaged: %s' % e)
+        for name in ('ptr_size', 'bitmap_start', 'bitmap_blocks', 'journal_start',
+                     'inode_start', 'data_start'):
+            if superblock[name] != expected[name]:
+                raise IOError('Superblock is damaged: %s is %d, should be %d'
+                              % (name, superblock[name], expected[name]))
+        if superblock['num_blocks'] > device.num_blocks:
+            raise IOError('Superblock is damaged: the image has only %d blocks'
+                          % device.num_blocks)
+        self.superblock = superblock
+        self.block_size = superblock['block_size']
+        self.num_blocks = superblock['num_blocks']
+        self.ptr_size = superblock['ptr_size']
+        self.inode_start = superblock['inode_start']
+        self.data_start = superblock['data_start']
+        self.extent_offset = extent_offset(self.ptr_size)
+        self.inline_extents = (
+            (self.block_size - self.extent_offset) // extent_size(self.ptr_size))
+        self.overflow_extents = (
+            (self.block_size - self.ptr_size) // extent_size(self.ptr_size))
+        self.inline_max = self.block_size - self.extent_offset
+
+        # (kind, message, fixable) of every problem found.
+        self.problems = []
+        # files found, metadata block -> Inode with the extents that are valid.
+        self.files = {}
+        self.paths = {}
+        # files whose metadata block has to be written again.
+        self.rewrite = set()
+        # files to free: orphans and files in no directory.
+        self.free = set()
+        # (directory, bucket) -> indexes of the entries to drop.
+        self.bad_entries = defaultdict(set)
+        # metadata block of the dedup index, and its valid entries,
+        # data block -> [refs, digest].
+        self.index_block = superblock['dedup_index']
+        self.index = None
+        # set when the dedup index has to be written again.
+        self.index_changed = False
+
+    def problem(self, kind, message, fixable=True):
+        self.problems.append((kind, message, fixable))
+
+    def name(self, block_num):
+        return self.paths.get(block_num, 'file %d' % block_num)
+
+    def journal(self):
+        if not self.superblock['journal_blocks']:
+            return None
+        return Journal(self.device, self.superblock)
+
+    def replay_journal(self):
+        '''Return: the number of transactions written in place.'''
+        journal = self.journal()
+        return journal.replay() if journal is not None else 0
+
+    def region(self, start, count):
+        '''Return: count blocks from start, a view of the mmap if there is one.'''
+        if self.device.view is not None:
+            return self.device.view[start * self.block_size:
+                                    (start + count) * self.block_size]
+        return memoryview(self.device.read_blocks(list(range(start, start + count))))
+
+    def metadata_blocks(self, used):
+        '''Return: the metadata blocks that are in use or hold a file.'''
+        start, count = self.inode_start, self.superblock['inode_count']
+        region = self.region(start, count)
+        if numpy is not None:
+            blocks = numpy.frombuffer(region, numpy.uint8).reshape(count, self.block_size)
+            # a file has a mode, the first two bytes.
+            found = (blocks[:, 0] | blocks[:, 1]).astype(bool)
+            found |= numpy.frombuffer(used, numpy.uint8)[start:start + count].astype(bool)
+            return (numpy.flatnonzero(found) + start).tolist()
+        block_size = self.block_size
+        return [start + i for i in range(count)
+                if used[start + i] or region[i * block_size] or region[i * block_size + 1]]
+
+    def load(self, block_num):
+        '''Decodes a metadata block, keeping only the valid extents.'''
+        block = self.device.block(block_num)
+        inode, count, overflow_block = Inode.unpack_from(block, block_num, self.ptr_size)
+        if inode.inline is not None and inode.size > self.inline_max:
+            self.problem('size', 'file %d: inline size %d is more than the %d bytes there is '
+                         'room for' % (block_num, inode.size, self.inline_max))
+            inode.size = len(inode.inline)
+            self.rewrite.add(block_num)
+        extents = unpack_extents(block[self.extent_offset:],
+                                 min(count, self.inline_extents), self.ptr_size)
+        overflow = []
+        while overflow_block != 0 and len(extents) < count:
+            if (not self.data_start <= overflow_block < self.num_blocks
+                    or overflow_block in overflow):
+                self.problem('overflow', 'file %d: bad overflow block %d'
+                             % (block_num, overflow_block))
+                break
+            overflow.append(overflow_block)
+            block = self.device.block(overflow_block)
+            extents += unpack_extents(
+                block, min(count - len(extents), self.overflow_extents), self.ptr_size)
+            overflow_block = disktools.bytes_to_int(block[self.block_size - self.ptr_size:])
+        if len(extents) < count:
+            self.problem('overflow', 'file %d: %d of %d extents found'
+                         % (block_num, len(extents), count))
+            self.rewrite.add(block_num)
+
+        valid = []
+        end = 0
+        span = cluster_blocks(self.block_size)
+        for extent in extents:
+            logical, physical, length = extent
+            covers = length
+            if length & COMPRESSED:
+                # blocks of compressed data and logical blocks covered.
+                size, method = unpack_length(length)
+                length = (size + self.block_size - 1) // self.block_size
+                covers = span
+                if logical % span or length >= span:
+                    length = 0
+            if (length == 0 or logical < end or physical < self.data_start
+                    or physical + length > self.num_blocks):
+                self.problem('extent', 'file %d: bad extent of %d blocks at %d'
+                             % (block_num, length, physical))
+                self.rewrite.add(block_num)
+                continue
+            valid.append(extent)
+            end = logical + covers
+        inode.extents = ExtentMap(valid, overflow, self.block_size)
+        return inode
+
+    def check(self):
+        '''Finds every problem, see the top of the file.
+            Return: the problems, (kind, message, fixable).
+        '''
+        journal = self.journal()
+        if journal is not None:
+            unapplied = journal.unapplied()
+            if unapplied:
+                self.problem('journal', '%d blocks in the journal are not in place yet, '
+                             'the checks below may be out of date' % unapplied)
+
+        bitmap = self.region(self.superblock['bitmap_start'], self.superblock['bitmap_blocks'])
+        used = unpack_bitmap(bitmap, self.num_blocks)
+        for block_num in self.metadata_blocks(used):
+            inode = self.load(block_num)
+            if inode.mode != 0:
+                self.files[block_num] = inode
+        root = self.files.get(self.inode_start)
+        if root is None or not S_ISDIR(root.mode):
+            raise IOError('Root directory is damaged')
+
+        if self.index_block:
+            self.load_index()
+        self.walk(root)
+        self.check_files()
+        self.check_blocks(used)
+        return self.problems
+
+    def load_index(self):
+        '''Reads the dedup index, keeping only the valid entries.'''
+        self.index = {}
+        inode = self.files.get(self.index_block)
+        if inode is None or not S_ISREG(inode.mode):
+            self.problem('index', 'the dedup index in metadata block %d is damaged'
+                         % self.index_block, fixable=False)
+            return
+        buckets = inode.size // self.block_size
+        if inode.size % self.block_size or buckets & (buckets - 1):
+            self.problem('index', 'dedup index size %d is not a power of two buckets'
+                         % inode.size)
+            self.index_changed = True
+            return
+        digests = set()
+        for bucket in range(buckets):
+            physical = inode.extents.lookup(bucket)
+            if physical == 0:
+                self.problem('index', 'bucket %d of the dedup index is missing' % bucket)
+                self.index_changed = True
+                continue
+            for block_num, refs, digest in unpack_index(self.device.block(physical),
+                                                        self.ptr_size):
+                why = None
+                if digest_bucket(digest, buckets) != bucket:
+                    why = 'is in the wrong bucket'
+                elif not self.data_start <= block_num < self.num_blocks:
+                    why = 'is not in the data region'
+                elif block_num in self.index or digest in digests:
+                    why = 'is there twice'
+                if why is not None:
+                    self.problem('index', 'dedup index entry of block %d %s' % (block_num, why))
+                    self.index_changed = True
+                    continue
+                self.index[block_num] = [refs, digest]
+                digests.add(digest)
+
+    def split_shared(self, runs):
+        '''Takes the blocks in the dedup index out of runs.
+            Return: the runs left, and the number of references to each
+            indexed block.
+        '''
+        indexed = sorted(self.index)
+        references = Counter()
+        left = []
+        for physical, length, owner, logical in runs:
+            start = physical
+            i = bisect_left(indexed, physical)
+            while i < len(indexed) and indexed[i] < physical + length:
+                block_num = indexed[i]
+                references[block_num] += 1
+                if start < block_num:
+                    left.append((start, block_num - start, owner,
+                                 None if logical is None else logical + start - physical))
+                start = block_num + 1
+                i += 1
+            if start < physical + length:
+                left.append((start, physical + length - start, owner,
+                             None if logical is None else logical + start - physical))
+        return left, references
+
+    def walk(self, root):
+        '''Follows every directory entry from root.'''
+        self.links = Counter()
+        self.subdirectories = Counter()
+        self.paths[root.block_num] = '/'
+        # set when part of the tree could not be read.
+        self.incomplete = False
+        reachable = set([root.block_num])
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            path = self.paths[directory.block_num].rstrip('/')
+            buckets = directory.size // self.block_size
+            if directory.size % self.block_size or buckets & (buckets - 1):
+                self.problem('size', '%s: directory size %d is not a power of two '
+                             'buckets' % (path or '/', directory.size), fixable=False)
+                self.incomplete = True
+                continue
+
+            for bucket in range(buckets):
+                physical = directory.extents.lookup(bucket)
+                if physical == 0:
+                    self.problem('size', '%s: bucket %d is missing' % (path or '/', bucket),
+                                 fixable=False)
+                    self.incomplete = True
+                    continue
+                names = set()
+                for i, (name, ino) in enumerate(unpack_entries(
+                        self.device.block(physical), self.ptr_size)):
+                    why = None
+                    if bucket_of(name, buckets) != bucket:
+                        why = 'is in the wrong bucket'
+                    elif name in names:
+                        why = 'is there twice'
+                    elif ino not in self.files:
+                        why = 'points to free metadata block %d' % ino
+                    elif ino in reachable and S_ISDIR(self.files[ino].mode):
+                        why = 'links directory %s a second time' % self.name(ino)
+                    else:
+                        try:
+                            name.decode('utf-8')
+                        except UnicodeDecodeError:
+                            why = 'is not utf-8'
+                    if why is not None:
+                        self.problem('entry', '%s: entry %r %s' % (path or '/', name, why))
+                        self.bad_entries[(directory.block_num, bucket)].add(i)
+                        continue
+
+                    names.add(name)
+                    self.links[ino] += 1
+                    child = self.files[ino]
+                    if ino not in reachable:
+                        self.paths[ino] = path + '/' + name.decode('utf-8')
+                    if child.parent != directory.block_num:
+                        self.problem('parent', '%s: parent is %d, should be %d'
+                                     % (self.name(ino), child.parent, directory.block_num))
+                        child.parent = directory.block_num
+                        self.rewrite.add(ino)
+                    if S_ISDIR(child.mode):
+                        self.subdirectories[directory.block_num] += 1
+                        stack.append(child)
+                    reachable.add(ino)
+        self.reachable = reachable
+
+    def check_files(self):
+        '''Checks link counts and sizes, and finds the files in no directory.'''
+        for block_num, inode in sorted(self.files.items()):
+            if block_num == self.index_block:
+                # in no directory on purpose.
+                continue
+            if block_num not in self.reachable:
+                if inode.nlink == 0:
+                    self.problem('orphan', 'file %d was unlinked while open' % block_num)
+                    self.free.add(block_num)
+                elif self.incomplete:
+                    # it may be in the directory that could not be read.
+                    self.problem('unreachable', 'file %d is in no directory that '
+                                 'could be read' % block_num, fixable=False)
+                else:
+                    self.problem('unreachable', 'file %d is in no directory' % block_num)
+                    self.free.add(block_num)
+                continue
+
+            if S_ISDIR(inode.mode):
+                nlink = 2 + self.subdirectories[block_num]
+            else:
+                nlink = self.links[block_num]
+            if inode.nlink != nlink:
+                self.problem('nlink', '%s: link count is %d, should be %d'
+                             % (self.name(block_num), inode.nlink, nlink))
+                inode.nlink = nlink
+                self.rewrite.add(block_num)
+
+            blocks = (inode.size + self.block_size - 1) // self.block_size
+            extent_map = inode.extents
+            end = extent_map.logical[-1] + extent_map.length[-1] if extent_map.logical else 0
+            # a compressed cluster covers a whole cluster, the end of the
+            # file may be anywhere in it.
+            end = max([end] + [logical + extent_map.cluster_blocks
+                               for logical in extent_map.clusters if logical >= blocks])
+            # fallocate --keep-size leaves blocks past the end of a regular
+            # file on purpose, they are checked like any other block.
+            if (S_ISLNK(inode.mode) or inode.inline is not None) and end > blocks:
+                self.problem('size', '%s: %d blocks mapped past the end of the file'
+                             % (self.name(block_num), end - blocks),
+                             fixable=False)
+
+    def runs(self, files):
+        '''Return: (physical, length, file, logical) of every run of blocks
+            files use, logical is None for overflow blocks.
+        '''
+        runs = []
+        for block_num in files:
+            extent_map = self.files[block_num].extents
+            for logical, physical, length in extent_map.extents():
+                runs.append((physical, length, block_num, logical))
+            for logical, (physical, length, size, method) in extent_map.clusters.items():
+                runs.append((physical, length, block_num, logical))
+            for overflow_block in extent_map.overflow:
+                runs.append((overflow_block, 1, block_num, None))
+        return runs
+
+    def check_blocks(self, used):
+        '''Finds cross-linked blocks, then compares the blocks in use with
+            the bitmap.
+        '''
+        keep = [block_num for block_num in self.files if block_num not in self.free]
+        runs = sorted(self.runs(keep), key=lambda run: run[0])
+        unshared = runs
+        if self.index is not None:
+            unshared, references = self.split_shared(runs)
+            for block_num, entry in sorted(self.index.items()):
+                if references[block_num] != entry[0]:
+                    self.problem('refcount', 'block %d is used %d times, the dedup index '
+                                 'says %d' % (block_num, references[block_num], entry[0]))
+                    entry[0] = references[block_num]
+                    self.index_changed = True
+        # where the runs seen so far end, and the file of the last one.
+        end, holder = 0, None
+        self.punches = defaultdict(list)
+        for physical, length, owner, logical in unshared:
+            if physical < end:
+                count = min(end, physical + length) - physical
+                self.problem('cross-link', '%d blocks from %d are used by both %s and %s'
+                             % (count, physical, self.name(holder), self.name(owner)))
+                if logical is not None:
+                    self.punches[owner].append((logical, count))
+                self.rewrite.add(owner)
+            if physical + length > end:
+                end, holder = physical + length, owner
+
+        expected = self.blocks_in_use(self.files, self.runs(self.free) + runs)
+        leaked, missing = differences(expected, used)
+        if leaked:
+            self.problem('leaked', '%d blocks are marked in use but not used: %s'
+                         % (len(leaked), show(leaked)))
+        if missing:
+            self.problem('missing', '%d blocks are used but marked free: %s'
+                         % (len(missing), show(missing)))
+
+        free_blocks = used[self.data_start:].count(0)
+        free_inodes = used[self.inode_start:self.data_start].count(0)
+        if self.superblock['clean'] and (free_blocks, free_inodes) != (
+                self.superblock['free_blocks'], self.superblock['free_inodes']):
+            self.problem('counter', 'free counters are %d blocks and %d files, should be '
+                         '%d and %d' % (self.superblock['free_blocks'],
+                                        self.superblock['free_inodes'],
+                                        free_blocks, free_inodes))
+
+    def blocks_in_use(self, files, runs):
+        '''Return: one byte per block, 1 for the blocks below the metadata
+            region, the metadata blocks of files and the blocks of runs.
+        '''
+        blocks = bytearray(self.num_blocks)
+        blocks[:self.inode_start] = b'\x01' * self.inode_start
+        for block_num in files:
+            blocks[block_num] = 1
+        for physical, length, owner, logical in runs:
+            blocks[physical:physical + length] = b'\x01' * length
+        return blocks
+
+    def repair(self):
+        '''Fixes what check found: the bitmap is rebuilt from the files
+            that are kept, then their metadata is written through Small.
+        '''
+        from small import Small
+
+        keep = [block_num for block_num in self.files if block_num not in self.free]
+        for owner, punches in self.punches.items():
+            for logical, count in punches:
+                # the blocks stay with the other file, a compressed
+                # cluster is dropped whole.
+                if self.files[owner].extents.remove_cluster(logical) is None:
+                    self.files[owner].extents.punch(logical, count)
+        for block_num in self.rewrite:
+            # write_inode gives them new overflow blocks.
+            self.files[block_num].extents.overflow = []
+        runs = [(physical, length) for physical, length, owner, logical in self.runs(keep)]
+        runs.extend((block_num, 1) for block_num in keep)
+
+        # marked clean, so mounting trusts the new bitmap.
+        superblock = dict(self.superblock)
+        allocator = Allocator(superblock, self.device)
+        allocator.rebuild(runs)
+        allocator.flush(clean=True)
+        self.device.flush()
+
+        fs = Small()
+        for block_num in self.rewrite:
+            if block_num in keep:
+                fs.inodes[block_num] = self.files[block_num]
+        fs.root = fs.inodes.get(self.inode_start, fs.root)
+        if self.index_changed and self.index_block in keep:
+            # blocks no file is mapped to any more leave the index.
+            inode = fs.load_inode(self.index_block)
+            fs.dedup = DedupIndex(fs, self.index_block, [
+                (block_num, refs, digest)
+                for block_num, (refs, digest) in self.index.items() if refs > 0])
+            buckets = inode.size // self.block_size
+            fs.dedup.write_table(buckets if buckets and not buckets & (buckets - 1) else 1)
+        for (directory, bucket), bad in self.bad_entries.items():
+            if directory in self.free:
+                continue
+            physical = self.files[directory].extents.lookup(bucket)
+            entries = [entry for i, entry in enumerate(
+                unpack_entries(self.device.block(physical), self.ptr_size)) if i not in bad]
+            fs.disk.write_block(physical, pack_entries(entries, self.block_size, self.ptr_size),
+                                metadata=True)
+        for block_num in self.free:
+            fs.disk.write_block(block_num, bytearray(self.block_size))
+        for block_num in sorted(self.rewrite):
+            if block_num in keep:
+                fs.write_inode(self.files[block_num])
+        fs.destroy('/')
+
+    def summary(self):
+        used = sum(length for physical, length, owner, logical in self.runs(self.files))
+        if self.index:
+            # shared blocks are only used once.
+            used -= sum(entry[0] - 1 for entry in self.index.values() if entry[0] > 1)
+        return dict(
+            files=len(self.files),
+            directories=sum(1 for inode in self.files.values() if S_ISDIR(inode.mode)),
+            blocks_used=used,
+            data_blocks=self.num_blocks - self.data_start,
+            problems=[dict(kind=kind, message=message, fixable=fixable)
+                      for kind, message, fixable in self.problems])
+
+
+def print_report(disk_name, report):
+    for problem in report['problems']:
+        print('%s: %s%s' % (problem['kind'], problem['message'],
+                            '' if problem['fixable'] else ' (not fixable)'))
+    print('%s: %d files, %d directories, %d/%d data blocks, %d problems'
+          % (disk_name, report['files'], report['directories'], report['blocks_used'],
+             report['data_blocks'], len(report['problems'])))
+
+def fsck(disk_name=None, repair=False, output_json=False):
+    '''Checks, and with repair fixes, the image disk_name.
+        Return: the exit status.
+    '''
+    if disk_name is not None:
+        disktools.DISK_NAME = disk_name
+    try:
+        checker = Checker(disktools.get_device())
+        if repair and checker.replay_journal():
+            # the superblock may have been in the log.
+            checker = Checker(disktools.get_device())
+        problems = checker.check()
+        report = checker.summary()
+        status = CLEAN
+        if problems and repair:
+            checker.repair()
+            checker = Checker(disktools.get_device())
+            checker.check()
+            report['remaining'] = checker.summary()['problems']
+            status = UNCORRECTED if report['remaining'] else CORRECTED
+        elif problems:
+            status = UNCORRECTED
+    except IOError as e:
+        print('%s: %s' % (disktools.DISK_NAME, e), file=sys.stderr)
+        return FAILED
+    finally:
+        disktools.close_device()
+
+    if output_json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print_report(disktools.DISK_NAME, report)
+        if 'remaining' in report:
+            for problem in report['remaining']:
+                print('left: %s: %s' % (problem['kind'], problem['message']))
+    return status
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Check a Small disk image.')
+    parser.add_argument('disk', nargs='?', default=disktools.DISK_NAME)
+    parser.add_argument('--repair', action='store_true',
+                        help='replay the journal and fix the problems found')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+    sys.exit(fsck(args.disk, args.repair, args.json))
@@ -0,0 +1,46 @@
+from __future__ import print_function, absolute_import, division
+
+import os
+
+from errno import EFAULT
+
+"""
+FUSE:
+Mounting needs fusepy and libfuse, but the file systems are also used
+without mounting, by image, defrag and the benchmarks. When fusepy
+cannot be loaded, FUSE is None and the parts of it the file systems
+are built on are replaced by the stand-ins below, which behave the same
+way for operations called directly.
+"""
+try:
+    from fuse import FUSE, FuseOSError, LoggingMixIn, Operations
+except (ImportError, OSError):
+    FUSE = None
+
+    class FuseOSError(OSError):
+        def __init__(self, errno):
+            super(FuseOSError, self).__init__(errno, os.strerror(errno))
+
+    class LoggingMixIn(object):
+        pass
+
+    class Operations(object):
+        '''Calls operations by name, those that are not defined and
+            need nothing done succeed.
+        '''
+
+        def __call__(self, op, *args):
+            if not hasattr(self, op):
+                raise FuseOSError(EFAULT)
+            return getattr(self, op)(*args)
+
+        def nothing(self, *args):
+            return 0
+
+        access = flush = fsync = fsyncdir = opendir = release = releasedir = nothing
+
+        def init(self, path):
+            pass
+
+        def destroy(self, path):
+            pass
@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+from __future__ import print_function, absolute_import, division
+
+import os
+import stat
+import sys
+import tarfile
+
+from collections import defaultdict, deque
+from multiprocessing import Pool
+from timeit import default_timer as timer
+
+import disktools
+import format
+import journal
+
+from dedup import DIGEST_SIZE, block_digest
+from fusecompat import FuseOSError
+from inode import extent_offset
+
+"""
+Images:
+build writes a new image holding a copy of a host directory, without
+mounting it. The tree is scanned first, to size the image, then the
+directories, files and symlinks are made in it. The data blocks of all
+the files are allocated in one run, so that every file is contiguous,
+and filled in order in batches of BATCH bytes written straight to the
+device. A pool of processes reads the files, in pieces of PIECE bytes,
+and hashes their blocks when the image is formatted with --dedup, so
+that blocks already stored are shared (see dedup). Blocks of zeros are
+left as holes, files small enough are stored inline. Hard links are
+copied as separate files, other special files are skipped.
+
+export writes the files of an unmounted image to a tar stream, reading
+each file with readahead.
+"""
+# bytes a worker reads at a time.
+PIECE = 4 << 20
+# bytes written to the device at a time.
+BATCH = 8 << 20
+
+
+def read_piece(task):
+    '''Reads length bytes of path from offset, in a worker.
+        Return: the data, and for each block its digest, or True when not
+        hashing, or None if it is all zeros.
+    '''
+    path, offset, length, block_size, hashing = task
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(length)
+    data = data.ljust(-(-len(data) // block_size) * block_size, b'\x00')
+    zeros = bytes(block_size)
+    keys = []
+    for start in range(0, len(data), block_size):
+        block = data[start:start + block_size]
+        if block == zeros:
+            keys.append(None)
+        else:
+            keys.append(block_digest(block) if hashing else True)
+    return data, keys
+
+
+class Builder(object):
+    '''Builds an image from a host directory, see the top of the file.'''
+
+    def __init__(self, source, block_size=disktools.BLOCK_SIZE, jobs=None):
+        self.source = source
+        self.block_size = block_size
+        self.jobs = os.cpu_count() if jobs is None else jobs
+        # (path in the image, host path, lstat) of everything to copy,
+        # parents before children.
+        self.entries = []
+        self.skipped = []
+        self.data_blocks = 0
+        self.bytes = 0
+
+    def scan(self):
+        '''Lists the tree and counts the blocks it needs.'''
+        # the pointer size is not known yet, take the smaller room.
+        inline_max = self.block_size - extent_offset(8)
+        # os.walk lists the subdirectories of a directory before going
+        # into them, so parents always come first.
+        for root, dirs, files in os.walk(self.source):
+            dirs.sort()
+            relative = os.path.relpath(root, self.source)
+            base = '' if relative == '.' else '/' + relative.replace(os.sep, '/')
+            for name in dirs + sorted(files):
+                host = os.path.join(root, name)
+                info = os.lstat(host)
+                path = base + '/' + name
+                if not (stat.S_ISDIR(info.st_mode) or stat.S_ISREG(info.st_mode)
+                        or stat.S_ISLNK(info.st_mode)):
+                    self.skipped.append((path, 'not a regular file, directory or symlink'))
+                    continue
+                if stat.S_ISREG(info.st_mode):
+                    self.bytes += info.st_size
+                    if info.st_size > inline_max:
+                        self.data_blocks += -(-info.st_size // self.block_size)
+                self.entries.append((path, host, info))
+
+    def geometry(self, inode_count=None, journal_blocks=None, dedup=False):
+        '''Return: the number of blocks, metadata blocks and journal
+            blocks of an image with room for the tree and a quarter to
+            spare.
+        '''
+        if inode_count is None:
+            inode_count = 2 * len(self.entries) + 16
+        # directory buckets, with room for the tables to double.
+        names = defaultdict(int)
+        for path, host, info in self.entries:
+            names[path[:path.rfind('/')]] += len(path) - path.rfind('/') + 8
+        needed = (self.data_blocks + 2 * sum(names.values()) // self.block_size
+                  + len(self.entries)) * 5 // 4 + 64
+        if journal_blocks is None:
+            # the whole table of a directory is written in one commit
+            # when it doubles, and small buckets fill unevenly.
+            journal_blocks = max(journal.default_size(inode_count + needed),
+                                 8 * max(names.values() or [0]) // self.block_size + 64)
+            if dedup:
+                # and so is the dedup index, an entry for every block.
+                journal_blocks = max(journal_blocks, 4 * self.data_blocks * (12 + DIGEST_SIZE)
+                                     // self.block_size + 64)
+        layout = format.layout(self.block_size, inode_count + needed, inode_count, journal_blocks)
+        return layout['data_start'] + needed, inode_count, journal_blocks
+
+    def make(self, fs, path, host, info):
+        '''Makes path in the image.
+            Return: its inode, or None if it cannot be made.
+        '''
+        mode = stat.S_IMODE(info.st_mode)
+        try:
+            if stat.S_ISDIR(info.st_mode):
+                fs.mkdir(path, mode)
+            elif stat.S_ISLNK(info.st_mode):
+                fs.symlink(path, os.readlink(host))
+            else:
+                fs.new_file(path, stat.S_IFREG | mode, 1)
+            inode = fs.resolve(path)
+        except (FuseOSError, UnicodeEncodeError) as e:
+            self.skipped.append((path, str(e) or e.__class__.__name__))
+            return None
+        self.copy_attributes(inode, info)
+        return inode
+
+    def copy_attributes(self, inode, info):
+        inode.uid, inode.gid = info.st_uid, info.st_gid
+        inode.atime = int(info.st_atime)
+        inode.mtime = int(info.st_mtime)
+
+    def tasks(self, files, hashing):
+        for path, host, info, inode in files:
+            for offset in range(0, info.st_size, PIECE):
+                yield (host, offset, min(PIECE, info.st_size - offset),
+                       self.block_size, hashing)
+
+    def read_pieces(self, pool, tasks):
+        '''Reads the pieces of tasks in order, with a few per process
+            being read ahead.
+        '''
+        if pool is None:
+            for task in tasks:
+                yield read_piece(task)
+            return
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(read_piece, (task,)))
+            if len(pending) > 2 * self.jobs:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def build(self, inode_count=None, journal_blocks=None, dedup=False, num_blocks=None):
+        '''Formats the image and copies the tree into it.
+            Return: statistics of the build.
+        '''
+        from small import Small
+        start = timer()
+        planned, inode_count, journal_blocks = self.geometry(inode_count, journal_blocks, dedup)
+        format.make_filesystem(self.block_size, num_blocks or planned, inode_count,
+                               journal_blocks, dedup)
+        fs = Small()
+        try:
+            return self.fill(fs, start)
+        finally:
+            fs.destroy('/')
+            disktools.close_device()
+
+    def fill(self, fs, start):
+        '''Copies the tree into the mounted fs.'''
+        # the tree first, so that the directory buckets come before the data.
+        files = []
+        directories = [(fs.root, os.stat(self.source))]
+        for path, host, info in self.entries:
+            inode = self.make(fs, path, host, info)
+            if inode is None:
+                continue
+            if stat.S_ISDIR(info.st_mode):
+                directories.append((inode, info))
+            elif stat.S_ISREG(info.st_mode) and info.st_size:
+                files.append((path, host, info, inode))
+            else:
+                fs.write_inode(inode)
+            fs.end_operation()
+
+        # every file in one run of blocks, as far as there is room.
+        index = fs.dedup
+        total = sum(-(-info.st_size // fs.block_size) for path, host, info, inode in files
+                    if info.st_size > fs.inline_max)
+        runs = fs.allocator.allocate(total, fs.data_start) if total else []
+        # physical blocks left, as a stack of runs.
+        runs.reverse()
+        # digest -> block, and block -> references, of the blocks stored.
+        stored = {}
+        refs = {}
+        batch = {}
+        batch_blocks = max(1, BATCH // fs.block_size)
+
+        def write_batch():
+            fs.disk.device.write_blocks(batch)
+            batch.clear()
+
+        pool = Pool(self.jobs) if self.jobs > 1 else None
+        pieces = self.read_pieces(pool, self.tasks(files, index is not None))
+        try:
+            for path, host, info, inode in files:
+                data = bytearray()
+                for offset in range(0, info.st_size, PIECE):
+                    piece, piece_keys = next(pieces)
+                    if info.st_size <= fs.inline_max:
+                        data += piece
+                        continue
+                    logical = offset // fs.block_size
+                    for i, key in enumerate(piece_keys):
+                        if key is None:
+                            # a hole.
+                            continue
+                        physical = stored.get(key) if index is not None else None
+                        if physical is None:
+                            physical, length = runs.pop()
+                            if length > 1:
+                                runs.append((physical + 1, length - 1))
+                            batch[physical] = memoryview(piece)[i * fs.block_size:
+                                                                (i + 1) * fs.block_size]
+                            if len(batch) >= batch_blocks:
+                                write_batch()
+                            if index is not None:
+                                stored[key] = physical
+                                refs[physical] = 0
+                        if index is not None:
+                            refs[physical] += 1
+                        inode.extents.add(logical + i, physical)
+                if info.st_size <= fs.inline_max:
+                    inode.inline = bytearray(data[:info.st_size])
+                else:
+                    inode.inline = None
+                inode.size = info.st_size
+                fs.write_inode(inode)
+                fs.end_operation()
+            if batch:
+                write_batch()
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        # blocks not needed, shared or holes, go back.
+        for physical, length in runs:
+            fs.allocator.free(physical, length)
+        if index is not None:
+            index.extend([(physical, refs[physical], digest)
+                          for digest, physical in stored.items()])
+        # adding entries changed the times of the directories.
+        for inode, info in directories:
+            self.copy_attributes(inode, info)
+            fs.write_inode(inode)
+        elapsed = timer() - start
+        return dict(
+            files=len(files),
+            entries=len(self.entries),
+            bytes=self.bytes,
+            blocks_written=fs.disk.device.writes,
+            seconds=elapsed,
+            mb_per_second=self.bytes / elapsed / (1 << 20) if elapsed else 0.0,
+            skipped=self.skipped)
+
+
+class Reader(object):
+    '''Reads a file of a Small through an open handle, for tarfile.'''
+
+    def __init__(self, fs, path):
+        self.fs = fs
+        self.path = path
+        self.fh = fs.open(path, os.O_RDONLY)
+        self.offset = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.fs.file(self.path, self.fh).size - self.offset
+        data = self.fs.read(self.path, size, self.offset, self.fh)
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        self.fs.release(self.path, self.fh)
+
+
+def export(output):
+    '''Writes every file of the image to output as a tar stream.
+        Return: the number of files written.
+    '''
+    from small import Small
+    fs = Small()
+    count = 0
+    try:
+        with tarfile.open(fileobj=output, mode='w|') as tar:
+            # file data is read in pieces this large.
+            tar.copybufsize = PIECE
+            stack = [('/', fs.root)]
+            while stack:
+                path, inode = stack.pop()
+                info = tarfile.TarInfo(path.lstrip('/') or '.')
+                info.mode = stat.S_IMODE(inode.mode)
+                info.uid = inode.uid
+                info.gid = inode.gid
+                info.mtime = inode.mtime
+                reader = None
+                if stat.S_ISDIR(inode.mode):
+                    info.type = tarfile.DIRTYPE
+                    children = []
+                    for name, block_num in fs.list_directory(inode):
+                        children.append((path.rstrip('/') + '/' + name, fs.load_inode(block_num)))
+                    # popped in name order.
+                    stack.extend(sorted(children, reverse=True))
+                elif stat.S_ISLNK(inode.mode):
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = fs.readlink(path)
+                else:
+                    info.size = inode.size
+                    reader = Reader(fs, path)
+                try:
+                    tar.addfile(info, reader)
+                finally:
+                    if reader is not None:
+                        reader.close()
+                count += 1
+    finally:
+        fs.destroy('/')
+        disktools.close_device()
+    return count
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Build a Small image from a directory, '
+                                     'or export one as a tar stream.')
+    commands = parser.add_subparsers(dest='command')
+    build_parser = commands.add_parser('build', help='make an image holding a copy of a directory')
+    build_parser.add_argument('source')
+    build_parser.add_argument('disk', nargs='?', default=disktools.DISK_NAME)
+    build_parser.add_argument('--block-size', type=int, default=disktools.BLOCK_SIZE)
+    build_parser.add_argument('--num-blocks', type=int,
+                              help='size of the image, by default what the tree needs and a quarter')
+    build_parser.add_argument('--inode-count', type=int)
+    build_parser.add_argument('--journal-blocks', type=int)
+    build_parser.add_argument('--dedup', action='store_true',
+                              help='store identical blocks once (see dedup)')
+    build_parser.add_argument('--jobs', type=int, help='processes reading the files')
+    export_parser = commands.add_parser('export', help='write the files of an image as a tar stream')
+    export_parser.add_argument('disk', nargs='?', default=disktools.DISK_NAME)
+    export_parser.add_argument('--output', '-o', help='tar file to write, standard output by default')
+    args = parser.parse_args()
+
+    if args.command is None:
+        parser.error('choose build or export')
+    disktools.DISK_NAME = args.disk
+    if args.command == 'build':
+        builder = Builder(args.source, args.block_size, args.jobs)
+        builder.scan()
+        result = builder.build(args.inode_count, args.journal_blocks, args.dedup, args.num_blocks)
+        for path, why in result['skipped']:
+            print('skipped %s: %s' % (path, why), file=sys.stderr)
+        print('%s: %d files, %d bytes in %.2f s, %.1f MB/s'
+              % (args.disk, result['files'], result['bytes'], result['seconds'],
+                 result['mb_per_second']))
+    elif args.output:
+        with open(args.output, 'wb') as output:
+            export(output)
+    else:
+        export(sys.stdout.buffer)
@@ -0,0 +1,116 @@
+import struct
+
+from extents import ExtentMap
+
+"""
+File metadata:
+MODE # 2 bytes
+UID # 4 bytes
+GID # 4 bytes
+
+CTIME # 4 bytes
+MTIME # 4 bytes
+ATIME # 4 bytes
+
+NLINKS # 2 bytes
+SIZE # 8 bytes, size of file in bytes
+EXTENT_COUNT # 4 bytes, number of extents of the file, or INLINE
+EXTENT_BLOCK # PTR_SIZE bytes, first overflow block of extents (see extents)
+PARENT # PTR_SIZE bytes, metadata block of the directory holding the file
+= 36 + 2 * PTR_SIZE bytes.
+
+All fields are big-endian. The rest of the metadata block holds the first
+extents of the file. Names are kept in directory entries (see directory).
+A file is known by the number of its metadata block.
+
+A file or symlink small enough has its data inline instead: EXTENT_COUNT
+is INLINE and the rest of the metadata block holds the SIZE bytes of data,
+so the file is read with its metadata and takes no data block. It is
+moved to data blocks when it grows past the space there.
+"""
+POINTER_FORMATS = {4: 'II', 8: 'QQ'}
+INLINE = 0xffffffff
+
+_structs = {}
+
+def inode_struct(ptr_size):
+    '''Returns the precompiled Struct of the metadata fields.'''
+    if ptr_size not in _structs:
+        _structs[ptr_size] = struct.Struct(
+            '>HIIIIIHQI%s' % POINTER_FORMATS[ptr_size])
+    return _structs[ptr_size]
+
+def extent_offset(ptr_size):
+    '''Where the extents start in the metadata block.'''
+    return inode_struct(ptr_size).size
+
+
+class Inode(object):
+    '''In memory metadata of a file, loaded from its metadata block.'''
+    __slots__ = ('block_num', 'mode', 'uid', 'gid', 'ctime', 'mtime',
+                 'atime', 'nlink', 'size', 'parent', 'extents', 'attrs', 'inline')
+
+    def __init__(self, block_num, mode, uid, gid, ctime, mtime, atime,
+                 nlink, size=0, parent=0, extents=None):
+        self.block_num = block_num
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+        self.ctime = ctime
+        self.mtime = mtime
+        self.atime = atime
+        self.nlink = nlink
+        self.size = size
+        self.parent = parent
+        self.extents = extents if extents is not None else ExtentMap()
+        # extended attributes, only kept in memory.
+        self.attrs = None
+        # the data of an inline file, bytes past its end read as zeros.
+        # None when the data is in data blocks.
+        self.inline = None
+
+    def stat(self, block_size):
+        '''Returns the attributes in the form FUSE expects from getattr.
+            st_blocks counts the data and overflow blocks in use, in 512
+            byte units, so holes take no space.
+        '''
+        blocks = self.extents.allocated() + len(self.extents.overflow)
+        return dict(
+            st_ino=self.block_num,
+            st_mode=self.mode,
+            st_uid=self.uid,
+            st_gid=self.gid,
+            st_ctime=self.ctime,
+            st_mtime=self.mtime,
+            st_atime=self.atime,
+            st_nlink=self.nlink,
+            st_size=self.size,
+            st_blocks=blocks * block_size // 512)
+
+    def pack_into(self, block, ptr_size, extent_count=0, extent_block=0):
+        '''Stores the metadata fields at the start of block, and the data
+            after them if the file is inline.
+        '''
+        if self.inline is not None:
+            extent_count, extent_block = INLINE, 0
+            start = extent_offset(ptr_size)
+            block[start:start + len(self.inline)] = self.inline
+        inode_struct(ptr_size).pack_into(block, 0,
+            self.mode, self.uid, self.gid,
+            int(self.ctime), int(self.mtime), int(self.atime),
+            self.nlink, self.size, extent_count, extent_block, self.parent)
+
+    @classmethod
+    def unpack_from(cls, block, block_num, ptr_size):
+        '''Loads the metadata fields of block.
+            Return: the Inode, its extent count and first overflow block.
+        '''
+        (mode, uid, gid, ctime, mtime, atime, nlink, size,
+         extent_count, extent_block, parent) = inode_struct(ptr_size).unpack_from(block)
+        inode = cls(block_num, mode, uid, gid, ctime, mtime, atime, nlink,
+                    size, parent)
+        if extent_count == INLINE:
+            start = extent_offset(ptr_size)
+            inode.inline = bytearray(block[start:start + size])
+            return inode, 0, 0
+        return inode, extent_count, extent_block
@@ -0,0 +1,157 @@
+from __future__ import print_function, absolute_import, division
+
+import json
+
+from errno import EACCES
+from stat import S_IFREG
+from time import time
+from timeit import default_timer as timer
+
+from fusecompat import FuseOSError, LoggingMixIn, Operations
+
+import disktools
+
+"""
+Instrumentation:
+InstrumentMixIn times every operation FUSE calls and counts its errors,
+the bytes it moved and the blocks it read and wrote on the default
+device. Latencies are kept in histograms with power of two buckets of
+microseconds: bucket i counts the calls that took less than 2 ** i us.
+
+The numbers can be read while mounted from the virtual file STATS_PATH,
+which is not listed by readdir:
+cat mount/.stats
+
+Without instrumentation (or --debug) no statistics are kept and nothing
+is logged, so there is no overhead on the operations.
+"""
+STATS_PATH = '/.stats'
+BUCKETS = 32
+
+
+class OperationStats(object):
+    __slots__ = ('calls', 'errors', 'seconds', 'bytes', 'reads', 'writes',
+                 'histogram')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0
+        self.bytes = 0
+        self.reads = 0
+        self.writes = 0
+        self.histogram = [0] * BUCKETS
+
+    def add(self, seconds):
+        self.calls += 1
+        self.seconds += seconds
+        bucket = min(BUCKETS - 1, int(seconds * 1e6).bit_length())
+        self.histogram[bucket] += 1
+
+    def percentile(self, fraction):
+        '''Returns the upper bound in us of the bucket holding the fraction
+            percentile of the calls.
+        '''
+        wanted = fraction * self.calls
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= wanted:
+                return 2 ** bucket
+        return 0
+
+    def summary(self):
+        return dict(
+            calls=self.calls,
+            errors=self.errors,
+            total_ms=self.seconds * 1e3,
+            p50_us=self.percentile(0.5),
+            p99_us=self.percentile(0.99),
+            bytes=self.bytes,
+            block_reads=self.reads,
+            block_writes=self.writes,
+            histogram=dict((2 ** bucket, count)
+                           for bucket, count in enumerate(self.histogram) if count))
+
+
+class InstrumentMixIn(object):
+    '''Records statistics of every operation of an Operations class.
+        Put it first in the bases so that it wraps the whole call:
+        class InstrumentedSmall(InstrumentMixIn, Small)
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(InstrumentMixIn, self).__init__(*args, **kwargs)
+        self.operation_stats = {}
+        self.stats_text = None
+
+    def __call__(self, op, *args):
+        if args and args[0] == STATS_PATH:
+            return self.stats_file(op, *args)
+
+        stats = self.operation_stats.get(op)
+        if stats is None:
+            stats = self.operation_stats[op] = OperationStats()
+        device = disktools.default_device
+        if device is not None:
+            reads, writes = device.reads, device.writes
+        start = timer()
+        try:
+            result = super(InstrumentMixIn, self).__call__(op, *args)
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            stats.add(timer() - start)
+            if device is not None and device is disktools.default_device:
+                stats.reads += device.reads - reads
+                stats.writes += device.writes - writes
+
+        if op == 'read':
+            stats.bytes += len(result)
+        elif op == 'write':
+            stats.bytes += result
+        return result
+
+    def render_stats(self):
+        report = dict(operations=dict(
+            (op, stats.summary()) for op, stats in self.operation_stats.items()))
+        # the file system can add its own, a dict of name -> dict.
+        if hasattr(self, 'component_stats'):
+            report.update(self.component_stats())
+        if disktools.default_device is not None:
+            report['device'] = disktools.default_device.stats()
+        return (json.dumps(report, indent=2, sort_keys=True) + '\n').encode('utf-8')
+
+    def stats_file(self, op, path, *args):
+        '''Serves the read only STATS_PATH file. The text is taken when
+            getattr is called, so that the size matches what is read.
+        '''
+        if op == 'getattr':
+            self.stats_text = self.render_stats()
+            now = time()
+            return dict(st_mode=(S_IFREG | 0o444), st_nlink=1,
+                        st_size=len(self.stats_text),
+                        st_ctime=now, st_mtime=now, st_atime=now)
+        if op in ('open', 'release', 'flush'):
+            return 0
+        if op == 'read':
+            size, offset = args[0], args[1]
+            if self.stats_text is None:
+                self.stats_text = self.render_stats()
+            return self.stats_text[offset:offset + size]
+        raise FuseOSError(EACCES)
+
+
+def instrumented(cls):
+    '''Returns a subclass of the Operations class cls that records
+        statistics of every operation.
+    '''
+    return type('Instrumented' + cls.__name__, (InstrumentMixIn, cls), {})
+
+def logged(cls):
+    '''Returns a subclass of the Operations class cls that logs every call
+        at DEBUG level. The logging is innermost, so cls.__call__ still
+        runs around each operation.
+    '''
+    return type('Logging' + cls.__name__, (cls, LoggingMixIn, Operations), {})
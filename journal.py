@@ -0,0 +1,202 @@
+import struct
+import zlib
+
+from errno import ENOSPC
+
+from cache import CACHE_BLOCKS
+
+"""
+Journal:
+The JOURNAL_BLOCKS blocks from JOURNAL_START are a write-ahead log of
+metadata blocks. The first block is the header:
+MAGIC # 4 bytes, b'JRNL'
+SEQUENCE # 8 bytes, sequence number of the first transaction in the log
+
+Transactions follow one after the other. Each one is a descriptor:
+MAGIC # 4 bytes, b'JTXN'
+SEQUENCE # 8 bytes
+COUNT # 4 bytes, number of blocks in the transaction
+CHECKSUM # 4 bytes, crc32 of the block numbers and the block copies
+BLOCK_NUMS # COUNT * 8 bytes, where each block goes, continuing over as
+           # many descriptor blocks as needed
+followed by a copy of each of the COUNT blocks.
+
+A transaction only counts as committed if its sequence number follows on
+from the previous one and its checksum matches, so a torn write is
+ignored on replay. All fields are big-endian.
+"""
+HEADER_MAGIC = b'JRNL'
+TRANSACTION_MAGIC = b'JTXN'
+HEADER = struct.Struct('>4sQ')
+DESCRIPTOR = struct.Struct('>4sQII')
+BLOCK_NUM = struct.Struct('>Q')
+
+def default_size(num_blocks):
+    '''Number of journal blocks for a disk of num_blocks. A group is
+        committed once half the journal or half the cache waits on it,
+        on big disks half the journal holds a group of the default cache.
+    '''
+    return min(2 * CACHE_BLOCKS, max(16, num_blocks // 16))
+
+
+class Journal(object):
+    '''Write-ahead journal of metadata blocks on a BlockDevice.
+        commit writes a group of blocks to the log, makes it durable with a
+        single flush of the device, then writes the blocks in place.
+    '''
+
+    def __init__(self, device, superblock):
+        self.device = device
+        self.block_size = superblock['block_size']
+        self.start = superblock['journal_start']
+        self.end = self.start + superblock['journal_blocks']
+        header = device.read_block(self.start)
+        magic, self.sequence = HEADER.unpack_from(header)
+        if magic != HEADER_MAGIC:
+            raise IOError('Journal has no header, run format.py first')
+        # where the next transaction is written.
+        self.head = self.start + 1
+        # blocks with a copy in the log.
+        self.logged = set()
+
+        self.commits = 0
+        self.blocks_logged = 0
+
+    def descriptor_blocks(self, count):
+        size = DESCRIPTOR.size + count * BLOCK_NUM.size
+        return (size + self.block_size - 1) // self.block_size
+
+    def capacity(self):
+        '''Most blocks that fit in one transaction.'''
+        count = self.end - self.start - 1
+        while count and count + self.descriptor_blocks(count) > self.end - self.start - 1:
+            count -= 1
+        return count
+
+    def reset(self, sequence):
+        '''Empties the log. Earlier transactions must already be in place.'''
+        self.sequence = sequence
+        self.head = self.start + 1
+        self.logged.clear()
+        header = bytearray(self.block_size)
+        HEADER.pack_into(header, 0, HEADER_MAGIC, sequence)
+        self.device.write_block(self.start, header)
+
+    def revoke(self, block_nums):
+        '''Called before blocks are written in place outside the journal.
+            If one of them has a copy in the log, replay would write the
+            old copy over it, so the log is emptied first.
+        '''
+        if self.logged.isdisjoint(block_nums):
+            return
+        self.device.flush()
+        self.reset(self.sequence)
+        self.device.flush()
+
+    def commit(self, blocks):
+        '''Writes a dict of block number -> block data atomically, as one
+            transaction. It must hold at most capacity blocks.
+        '''
+        if len(blocks) > self.capacity():
+            raise IOError(ENOSPC, 'A commit of %d blocks does not fit in the journal'
+                          % len(blocks))
+        block_nums = sorted(blocks)
+        numbers = b''.join([BLOCK_NUM.pack(block_num) for block_num in block_nums])
+        checksum = zlib.crc32(numbers)
+        for block_num in block_nums:
+            checksum = zlib.crc32(blocks[block_num], checksum)
+
+        descriptor = bytearray(DESCRIPTOR.pack(TRANSACTION_MAGIC, self.sequence,
+                                               len(block_nums), checksum))
+        descriptor += numbers
+        count = self.descriptor_blocks(len(block_nums))
+        descriptor = descriptor.ljust(count * self.block_size, b'\x00')
+
+        if self.head + count + len(block_nums) > self.end:
+            # make the blocks of earlier transactions durable in place
+            # before their log entries are overwritten.
+            self.device.flush()
+            self.reset(self.sequence)
+
+        log = {}
+        for i in range(count):
+            log[self.head + i] = descriptor[i * self.block_size:(i + 1) * self.block_size]
+        for i, block_num in enumerate(block_nums):
+            log[self.head + count + i] = blocks[block_num]
+        self.device.write_blocks(log)
+        # the single flush that commits the whole group.
+        self.device.flush()
+
+        self.device.write_blocks(dict((block_num, blocks[block_num])
+                                      for block_num in block_nums))
+        self.head += count + len(block_nums)
+        self.sequence += 1
+        self.logged.update(block_nums)
+        self.commits += 1
+        self.blocks_logged += len(block_nums)
+
+    def transactions(self):
+        '''Yields each committed transaction in the log from head, as a
+            dict of block number -> block data, moving head past it.
+        '''
+        while self.head < self.end:
+            descriptor = self.device.read_block(self.head)
+            magic, sequence, count, checksum = DESCRIPTOR.unpack_from(descriptor)
+            if magic != TRANSACTION_MAGIC or sequence != self.sequence:
+                return
+            descriptor_count = self.descriptor_blocks(count)
+            if self.head + descriptor_count + count > self.end:
+                return
+            descriptor = self.device.read_blocks(
+                list(range(self.head, self.head + descriptor_count)))
+            numbers = descriptor[DESCRIPTOR.size:DESCRIPTOR.size + count * BLOCK_NUM.size]
+            copies = self.device.read_blocks(list(range(
+                self.head + descriptor_count, self.head + descriptor_count + count)))
+            if zlib.crc32(copies, zlib.crc32(numbers)) != checksum:
+                return
+
+            blocks = {}
+            for i in range(count):
+                block_num = BLOCK_NUM.unpack_from(numbers, i * BLOCK_NUM.size)[0]
+                blocks[block_num] = copies[i * self.block_size:(i + 1) * self.block_size]
+            yield blocks
+            self.head += descriptor_count + count
+            self.sequence += 1
+
+    def unapplied(self):
+        '''Return: the number of blocks whose last copy in the log differs
+            from the block in place, which replay would change. Nothing is
+            written.
+        '''
+        head, sequence = self.head, self.sequence
+        latest = {}
+        for blocks in self.transactions():
+            latest.update(blocks)
+        self.head, self.sequence = head, sequence
+        return sum(1 for block_num, block in latest.items()
+                   if self.device.read_block(block_num) != block)
+
+    def replay(self):
+        '''Writes the blocks of every committed transaction in the log back
+            in place, then empties the log.
+            Return: the number of transactions replayed.
+        '''
+        replayed = 0
+        for blocks in self.transactions():
+            self.device.write_blocks(blocks)
+            replayed += 1
+
+        self.device.flush()
+        self.reset(self.sequence)
+        self.device.flush()
+        return replayed
+
+    def stats(self):
+        return dict(commits=self.commits, blocks_logged=self.blocks_logged)
+
+
+def format_journal(device, superblock):
+    '''Writes an empty journal header.'''
+    header = bytearray(superblock['block_size'])
+    HEADER.pack_into(header, 0, HEADER_MAGIC, 1)
+    device.write_block(superblock['journal_start'], header)
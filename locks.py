@@ -0,0 +1,168 @@
+from __future__ import print_function, absolute_import, division
+
+import functools
+import threading
+import weakref
+
+from contextlib import contextmanager
+
+"""
+Locking for the threaded mode:
+Every operation holds the transaction lock shared, a commit holds it
+exclusive, so a group commit never sees half an operation.
+Operations that change the directory tree hold the namespace lock
+exclusive. All other operations hold it shared and lock just the file
+they work on, read or write, so operations on different files run at
+the same time.
+Locks are always taken in that order: transaction, namespace, file.
+"""
+# operations that change directories.
+NAMESPACE_OPS = frozenset(('create', 'mkdir', 'mknod', 'rename', 'rmdir',
+                           'symlink', 'link', 'unlink'))
+# operations that only read the file at their path.
+READ_OPS = frozenset(('access', 'getattr', 'getxattr', 'listxattr', 'open',
+                      'opendir', 'read', 'readdir', 'readlink', 'statfs'))
+# operations that change the file at their path.
+WRITE_OPS = frozenset(('chmod', 'chown', 'fallocate', 'removexattr',
+                       'setxattr', 'truncate', 'utimens', 'write'))
+# operations that take the locks they need themselves.
+UNLOCKED_OPS = frozenset(('destroy', 'flush', 'fsync', 'fsyncdir', 'init',
+                          'release', 'releasedir'))
+
+
+def synchronized(method):
+    '''Runs method holding self.lock.'''
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return locked
+
+@contextmanager
+def unlocked():
+    '''Stands in for a lock when not threaded.'''
+    yield
+
+
+class RWLock(object):
+    '''A lock held by any number of readers or by one writer.
+        Waiting writers go before new readers, so writers are not starved.
+    '''
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+
+    def acquire_read(self):
+        with self.condition:
+            while self.writer or self.writers_waiting:
+                self.condition.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.condition:
+            self.readers -= 1
+            if not self.readers:
+                self.condition.notify_all()
+
+    def acquire_write(self):
+        with self.condition:
+            self.writers_waiting += 1
+            while self.writer or self.readers:
+                self.condition.wait()
+            self.writers_waiting -= 1
+            self.writer = True
+
+    def release_write(self):
+        with self.condition:
+            self.writer = False
+            self.condition.notify_all()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+class LockTable(object):
+    '''One RWLock per key, made on first use. A lock is dropped once
+        nothing holds a reference to it.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = weakref.WeakValueDictionary()
+
+    def get(self, key):
+        with self.lock:
+            lock = self.locks.get(key)
+            if lock is None:
+                lock = self.locks[key] = RWLock()
+            return lock
+
+
+class OperationLocks(object):
+    '''Takes the locks an operation needs.
+        file_key maps the path of an operation to the key of its file.
+    '''
+
+    def __init__(self, file_key):
+        self.file_key = file_key
+        self.transaction = RWLock()
+        self.namespace = RWLock()
+        self.files = LockTable()
+
+    @contextmanager
+    def operation(self, op, args):
+        if op in UNLOCKED_OPS:
+            yield
+            return
+        with self.transaction.read():
+            if op in READ_OPS or op in WRITE_OPS:
+                with self.namespace.read():
+                    lock = self.files.get(self.file_key(args[0]))
+                    with (lock.read() if op in READ_OPS else lock.write()):
+                        yield
+            else:
+                with self.namespace.write():
+                    yield
+
+    @contextmanager
+    def tree(self):
+        '''Held to read the directory tree outside of an operation.'''
+        with self.transaction.read():
+            with self.namespace.read():
+                yield
+
+    @contextmanager
+    def file(self, key):
+        '''Held to change the file with key outside of an operation on it,
+            as an operation that writes it would.
+        '''
+        with self.transaction.read():
+            with self.namespace.read():
+                with self.files.get(key).write():
+                    yield
+
+    def idle(self):
+        '''Return: True if no operation is running.'''
+        return not self.transaction.readers and not self.transaction.writer
+
+    @contextmanager
+    def commit(self):
+        '''Held while a group of operations is committed.'''
+        with self.transaction.write():
+            yield
@@ -1,29 +1,102 @@
 #!/usr/bin/env python
 from __future__ import print_function, absolute_import, division
 
+import itertools
 import logging
+import instrument
 
 from collections import defaultdict
 from errno import ENOENT
 from stat import S_IFDIR, S_IFLNK, S_IFREG
 from time import time
 
-from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
+from fusecompat import FUSE, FuseOSError, Operations
 
-if not hasattr(__builtins__, 'bytes'):
+from locks import OperationLocks
+
+# __builtins__ is a dict when this module is imported, so check by name.
+try:
+    bytes
+except NameError:
     bytes = str
 
+# size of the pages file data is kept in.
+PAGE_SIZE = 4096
 
-class Memory(LoggingMixIn, Operations):
-    'Example memory filesystem. Supports only one level of files.'
+
+class Pages(object):
+    '''Data of a file, kept as a sparse map of fixed size pages.
+        Pages that were never written are holes: they read as zeros and
+        use no memory.
+    '''
 
     def __init__(self):
+        # page number -> bytearray of PAGE_SIZE
+        self.pages = {}
+        self.size = 0
+
+    def read(self, offset, size):
+        end = min(offset + size, self.size)
+        if offset >= end:
+            return b''
+        data = bytearray(end - offset)
+        for index in range(offset // PAGE_SIZE, (end - 1) // PAGE_SIZE + 1):
+            page = self.pages.get(index)
+            if page is None:
+                continue
+            page_start = index * PAGE_SIZE
+            start = max(offset, page_start)
+            stop = min(end, page_start + PAGE_SIZE)
+            data[start - offset:stop - offset] = page[start - page_start:stop - page_start]
+        return bytes(data)
+
+    def write(self, offset, data):
+        '''Copies data into the pages it covers, past the end of the file
+            the gap is left as a hole.
+        '''
+        data = memoryview(data)
+        end = offset + len(data)
+        position = offset
+        while position < end:
+            index, start = divmod(position, PAGE_SIZE)
+            stop = min(PAGE_SIZE, start + end - position)
+            page = self.pages.get(index)
+            if page is None:
+                page = self.pages[index] = bytearray(PAGE_SIZE)
+            page[start:stop] = data[position - offset:position - offset + stop - start]
+            position += stop - start
+        self.size = max(self.size, end)
+
+    def truncate(self, length):
+        if length < self.size:
+            last = (length + PAGE_SIZE - 1) // PAGE_SIZE
+            for index in [i for i in self.pages if i >= last]:
+                del self.pages[index]
+            # the rest of the last page reads as zeros if the file grows.
+            page = self.pages.get(length // PAGE_SIZE)
+            if page is not None:
+                start = length % PAGE_SIZE
+                page[start:] = bytearray(PAGE_SIZE - start)
+        self.size = length
+
+    def blocks(self):
+        '''Space in use, in 512 byte units.'''
+        return len(self.pages) * PAGE_SIZE // 512
+
+
+class Memory(Operations):
+    'Example memory filesystem. Supports only one level of files.'
+
+    def __init__(self, threaded=False):
         # contains file attributes.
         self.files = {}
         # contains file data.
-        self.data = defaultdict(bytes)
-        # the id for the file.
-        self.fd = 0
+        self.data = defaultdict(Pages)
+        # the ids for the files, next() is atomic.
+        self.fds = itertools.count(1)
+        # operations lock the files they use when FUSE runs them in threads,
+        # there is one file per path.
+        self.locks = OperationLocks(lambda path: path) if threaded else None
         # current time.
         now = time()
         # attributes of the root.
@@ -37,6 +110,12 @@ class Memory(LoggingMixIn, Operations):
             st_gid=1000)
         
 
+    def __call__(self, op, *args):
+        if self.locks is None:
+            return super(Memory, self).__call__(op, *args)
+        with self.locks.operation(op, args):
+            return super(Memory, self).__call__(op, *args)
+
     def chmod(self, path, mode):
         self.files[path]['st_mode'] &= 0o770000
         self.files[path]['st_mode'] |= mode
@@ -54,15 +133,16 @@ class Memory(LoggingMixIn, Operations):
             st_mode=(S_IFREG | mode),
             st_nlink=1,
             st_size=0,
+            st_blocks=0,
             # set create, modify, access times to the current time.
             st_ctime=time(),
             st_mtime=time(),
             st_atime=time(),
             st_uid=1000,
             st_gid=1000)
+        self.data[path] = Pages()
 
-        self.fd += 1
-        return self.fd
+        return next(self.fds)
 
     # if the file exists, then it will return the attributes of the file.
     def getattr(self, path, fh=None):
@@ -96,18 +176,18 @@ class Memory(LoggingMixIn, Operations):
 
     # passes the file path of the file that you want open and increment the file descriptor.
     def open(self, path, flags):
-        self.fd += 1
-        return self.fd
+        return next(self.fds)
 
     # starts reading from the offset until offset + size.
     def read(self, path, size, offset, fh):
-        return self.data[path][offset:offset + size]
+        return self.data[path].read(offset, size)
 
     def readdir(self, path, fh):
         return ['.', '..'] + [x[1:] for x in self.files if x != '/']
 
     def readlink(self, path):
-        return self.data[path]
+        pages = self.data[path]
+        return pages.read(0, pages.size).decode('utf-8')
 
     def removexattr(self, path, name):
         attrs = self.files[path].get('attrs', {})
@@ -140,13 +220,14 @@ class Memory(LoggingMixIn, Operations):
             st_nlink=1,
             st_size=len(source))
 
-        self.data[target] = source
+        self.data[target].write(0, source.encode('utf-8'))
 
     def truncate(self, path, length, fh=None):
-        # make sure extending the file fills in zero bytes
-        self.data[path] = self.data[path][:length].ljust(
-            length, '\x00'.encode('ascii'))
+        # extending the file leaves a hole that reads as zero bytes.
+        pages = self.data[path]
+        pages.truncate(length)
         self.files[path]['st_size'] = length
+        self.files[path]['st_blocks'] = pages.blocks()
 
     def unlink(self, path):
         self.data.pop(path)
@@ -159,17 +240,14 @@ class Memory(LoggingMixIn, Operations):
         self.files[path]['st_mtime'] = mtime
 
     # receives the file path, data, and offset.
-    # modifies the file data such that it removes everything after the offset
-    # and replaces it with the new data.
+    # only the pages that data covers are changed, a gap between the end of
+    # the file and offset is left as a hole.
     # file size will also be updated.
     def write(self, path, data, offset, fh):
-        self.data[path] = (
-            # make sure the data gets inserted at the right offset
-            self.data[path][:offset].ljust(offset, '\x00'.encode('ascii'))
-            + data
-            # and only overwrites the bytes that data is replacing
-            + self.data[path][offset + len(data):])
-        self.files[path]['st_size'] = len(self.data[path])
+        pages = self.data[path]
+        pages.write(offset, data)
+        self.files[path]['st_size'] = pages.size
+        self.files[path]['st_blocks'] = pages.blocks()
         return len(data)
 
 
@@ -177,7 +255,20 @@ if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('mount')
+    parser.add_argument('--stats', action='store_true',
+                        help='keep statistics, readable from /.stats')
+    parser.add_argument('--debug', action='store_true', help='log every call')
+    parser.add_argument('--threads', action='store_true',
+                        help='run operations on different files at the same time')
     args = parser.parse_args()
-
-    logging.basicConfig(level=logging.DEBUG)
-    fuse = FUSE(Memory(), args.mount, foreground=True)
+    if FUSE is None:
+        parser.error('mounting needs fusepy and libfuse')
+
+    filesystem = Memory
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+        filesystem = instrument.logged(filesystem)
+    if args.stats:
+        filesystem = instrument.instrumented(filesystem)
+    fuse = FUSE(filesystem(args.threads), args.mount, foreground=True,
+                nothreads=not args.threads)
@@ -0,0 +1,115 @@
+import itertools
+import threading
+
+from collections import Counter
+
+from readahead import Readahead
+
+
+class WriteBuffer(object):
+    '''Writes to an open file that have not been written to its blocks
+        yet, one range of data from offset.
+    '''
+    __slots__ = ('offset', 'data')
+
+    def __init__(self, offset, data):
+        self.offset = offset
+        self.data = bytearray(data)
+
+    @property
+    def end(self):
+        return self.offset + len(self.data)
+
+    def write(self, offset, data):
+        '''Adds data at offset, which must be inside or at the end of the
+            buffered range.
+        '''
+        start = offset - self.offset
+        self.data[start:start + len(data)] = data
+
+    def overlay(self, offset, data):
+        '''Return: data read from offset with the buffered range on top.'''
+        start = max(offset, self.offset)
+        stop = min(offset + len(data), self.end)
+        if start >= stop:
+            return data
+        data = bytearray(data)
+        data[start - offset:stop - offset] = self.data[start - self.offset:stop - self.offset]
+        return bytes(data)
+
+
+class OpenFile(object):
+    '''State of one open file handle.
+        The inode holds the block map and size of the file, so reads and
+        writes on the handle need no path lookup.
+    '''
+    __slots__ = ('fh', 'inode', 'flags', 'readahead', 'buffer')
+
+    def __init__(self, fh, inode, flags):
+        self.fh = fh
+        self.inode = inode
+        self.flags = flags
+        self.readahead = Readahead()
+        # writes waiting to be written, a WriteBuffer or None.
+        self.buffer = None
+
+
+class OpenFiles(object):
+    '''The open file table, file handle -> OpenFile.'''
+
+    def __init__(self):
+        self.files = {}
+        # metadata block -> number of handles open on it.
+        self.counts = Counter()
+        # metadata blocks of open files that have been unlinked.
+        self.orphans = set()
+        # metadata block -> the OpenFile holding buffered writes to it,
+        # only one handle of a file buffers at a time.
+        self.buffered = {}
+        # next() is atomic.
+        self.handles = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def open(self, inode, flags=0):
+        '''Return: a new file handle for inode.'''
+        fh = next(self.handles)
+        with self.lock:
+            self.files[fh] = OpenFile(fh, inode, flags)
+            self.counts[inode.block_num] += 1
+        return fh
+
+    def get(self, fh):
+        '''Return: the OpenFile of fh, or None if it is not open.'''
+        return self.files.get(fh)
+
+    def close(self, fh):
+        '''Removes fh from the table.
+            Return: its OpenFile (None if it was not open), and True if it
+            was the last handle of an unlinked file, which can now be freed.
+        '''
+        with self.lock:
+            open_file = self.files.pop(fh, None)
+            if open_file is None:
+                return None, False
+            block_num = open_file.inode.block_num
+            self.counts[block_num] -= 1
+            if self.counts[block_num]:
+                return open_file, False
+            del self.counts[block_num]
+            if block_num in self.orphans:
+                self.orphans.discard(block_num)
+                return open_file, True
+            return open_file, False
+
+    def orphan(self, inode):
+        '''Called when inode is unlinked.
+            Return: True if it is still open, then it is left for close.
+        '''
+        with self.lock:
+            if inode.block_num not in self.counts:
+                return False
+            self.orphans.add(inode.block_num)
+            return True
+
+    def __len__(self):
+        return len(self.files)
@@ -0,0 +1,86 @@
+from __future__ import print_function, absolute_import, division
+
+import queue
+import threading
+
+"""
+Readahead:
+Each open file handle watches its reads. A read that starts where the
+last one ended is sequential, and the blocks after it are fetched into
+the block cache before they are asked for. The window of blocks fetched
+ahead starts small and doubles every time it is used up, up to a limit,
+the next window is fetched once the reader is half way through the
+last one. A read anywhere else switches readahead off until the reads
+are sequential again.
+"""
+# smallest window, in blocks.
+READAHEAD_MIN = 4
+# largest window, in bytes.
+READAHEAD_MAX = 1 << 20
+# windows waiting for the prefetch thread, more are dropped.
+QUEUE_SIZE = 16
+
+
+class Readahead(object):
+    '''Readahead state of one open file handle.'''
+    __slots__ = ('next_offset', 'window', 'ahead')
+
+    def __init__(self):
+        # where a sequential read starts, the first read at 0 counts.
+        self.next_offset = 0
+        # blocks in the last window, 0 when readahead is off.
+        self.window = 0
+        # the block after the last window.
+        self.ahead = 0
+
+    def advance(self, offset, size, first, last, limit):
+        '''Records a read of size bytes from offset, in blocks first to
+            last, with windows of at most limit blocks.
+            Return: the blocks to fetch ahead, from start up to end.
+        '''
+        sequential = offset == self.next_offset
+        self.next_offset = offset + size
+        if not sequential:
+            self.window = 0
+            self.ahead = 0
+            return 0, 0
+        if last + 1 + self.window // 2 < self.ahead:
+            # more than half of the last window is still to be read.
+            return 0, 0
+        self.window = min(limit, max(self.window * 2, READAHEAD_MIN,
+                                     2 * (last - first + 1)))
+        start = max(self.ahead, first)
+        self.ahead = last + 1 + self.window
+        return start, self.ahead
+
+
+class Prefetcher(threading.Thread):
+    '''Fetches windows of blocks into a block cache in the background, so
+        that the reader does not wait for them.
+    '''
+
+    def __init__(self, cache):
+        threading.Thread.__init__(self, name='prefetch')
+        self.daemon = True
+        self.cache = cache
+        self.windows = queue.Queue(QUEUE_SIZE)
+        self.dropped = 0
+
+    def submit(self, block_nums):
+        try:
+            self.windows.put_nowait(block_nums)
+        except queue.Full:
+            # readahead is only a hint.
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            block_nums = self.windows.get()
+            if block_nums is None:
+                return
+            self.cache.prefetch(block_nums)
+
+    def stop(self):
+        '''Waits for the queued windows, then ends the thread.'''
+        self.windows.put(None)
+        self.join()
@@ -2,167 +2,468 @@
 from __future__ import print_function, absolute_import, division
 
 import logging
+import instrument
 import disktools
 
-from collections import defaultdict
-from errno import ENOENT
-from stat import S_IFDIR, S_IFLNK, S_IFREG
+from collections import OrderedDict, defaultdict
+from errno import (EEXIST, EINVAL, ENAMETOOLONG, ENOENT, ENOSPC, ENOTDIR,
+                   ENOTEMPTY, EOPNOTSUPP)
+from stat import S_IFDIR, S_IFLNK, S_IFREG, S_ISDIR, S_ISREG
 from time import time
 
-from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
-
-from format import empty_file_block_list
-from format import empty_data_block_list
+from fusecompat import FUSE, FuseOSError, Operations
+
+from allocator import Allocator
+from cache import BlockCache, CACHE_BLOCKS
+from inode import Inode, extent_offset
+from journal import Journal
+from locks import OperationLocks, unlocked
+from openfile import OpenFiles, WriteBuffer
+from readahead import Prefetcher, READAHEAD_MAX
+from defrag import DefragThread
+from compress import METHODS, compress, decompress
+from dedup import DedupIndex, block_digest
+from extents import ExtentMap, extent_size, pack_extents, unpack_extents
+from directory import bucket_of, name_max, pack_entries, unpack_entries
 import os
 import math
+import threading
+
+# fallocate modes.
+FALLOC_FL_KEEP_SIZE = 1
+FALLOC_FL_PUNCH_HOLE = 2
+
+# seconds between group commits of the metadata journal.
+COMMIT_INTERVAL = 5
+
+# bytes of adjacent writes an open file collects before writing them out.
+WRITE_BUFFER = 1 << 20
 
-if not hasattr(__builtins__, 'bytes'):
+# decompressed clusters kept in memory.
+CLUSTER_CACHE = 16
+
+# __builtins__ is a dict when this module is imported, so check by name.
+try:
+    bytes
+except NameError:
     bytes = str
 
-class Small(LoggingMixIn, Operations):
-    'Example memory filesystem. Supports only one level of files.'
+class Small(Operations):
+    'Example disk filesystem with nested directories.'
 
     """
     The disk will contain the file attributes and the file data.
-    We can store the file attributes in the first 4 blocks.
-    We can store the file data in the other 12 blocks.
+    The geometry of the disk is read from the superblock: the file
+    attributes are stored in the metadata blocks from inode_start and
+    the file data in the blocks from data_start.
+    Directories are files whose data is a hash table of directory entries.
     """
-    def __init__(self):
-        # System wide open file table.
-        self.files = {}
-
-        self.fd = 0
-        # Find out which blocks are empty and which are full.
-        for i in range(len(empty_file_block_list)):
-            if disktools.bytes_to_int(disktools.read_block(i)[18:19]) != 0:
-                empty_file_block_list[i] = False
-                block = disktools.read_block(i)
-                name = ""
-                for char in block[22:38].decode('ascii'):
-                    if char != b'\x00'.decode('ascii'):
-                        name += char
-
-                if name != "/":
-                    path = "/" + name
-                else:
-                    path = name
-
-                # load metadata to memory.
-                self.files[path] = dict(
-                    st_mode=disktools.bytes_to_int(block[0:2]),
-                    st_uid=disktools.bytes_to_int(block[2:4]),
-                    st_gid=disktools.bytes_to_int(block[4:6]),
-                    st_ctime=disktools.bytes_to_int(block[6:10]),
-                    st_mtime=disktools.bytes_to_int(block[10:14]),
-                    st_atime=disktools.bytes_to_int(block[14:18]),
-                    st_nlink=disktools.bytes_to_int(block[18:19]),
-                    st_size=disktools.bytes_to_int(block[19:21]),
-                    st_location=disktools.bytes_to_int(block[21:22]),
-                    block_num=i)
-            
-                if self.files[path]['st_location'] != 0:
-                    empty_data_block_list[self.files[path]['st_location']-5] = False
-                    # Check all the blocks that are linked to this block as well.
-                    block_num = self.files[path]['st_location']
-                    while block_num != 0:
-                        block = disktools.read_block(block_num)
-                        block_num = disktools.bytes_to_int(block[63:64])
-                        empty_data_block_list[block_num-5] = False
-
-        # For testing purposes.
-        """
-        print(self.files)
-        print(empty_file_block_list)
-        print(empty_data_block_list)
-        """
+    def __init__(self, cache_blocks=CACHE_BLOCKS, commit_interval=COMMIT_INTERVAL,
+                 threaded=False, write_buffer=WRITE_BUFFER, defrag_rate=0,
+                 compression=None):
+        # Inodes that have been loaded, keyed by metadata block.
+        self.inodes = {}
+        # Directory entry cache, (directory metadata block, name) -> inode.
+        self.dentries = {}
+
+        # open file handles.
+        self.open_files = OpenFiles()
+        # writes to a handle are collected up to this many bytes, 0 writes
+        # them straight through.
+        self.write_buffer = write_buffer
+        # operations lock the files they use when FUSE runs them in threads,
+        # or when the defragmenter moves files in the background.
+        self.locks = None
+        if threaded or defrag_rate:
+            self.locks = OperationLocks(self.file_key)
+        self.inode_lock = threading.Lock()
+
+        # regular files written with compression on are stored in
+        # compressed clusters, see compress. Clusters already on disk are
+        # read whatever the setting.
+        self.compression = compression
+        # physical block -> data of the clusters read last.
+        self.cluster_cache = OrderedDict()
+        self.cluster_lock = threading.Lock()
+        self.clusters_compressed = 0
+        self.clusters_plain = 0
+        self.clusters_decompressed = 0
+
+        superblock = disktools.read_superblock()
+        if superblock is None:
+            raise IOError('Disk has no superblock, run format.py first')
+        device = disktools.get_device()
+        # Finish the metadata commits that a crash cut short, the
+        # superblock may be one of the blocks.
+        journal = None
+        if superblock['journal_blocks']:
+            journal = Journal(device, superblock)
+            journal.replay()
+            superblock = disktools.read_superblock()
+        self.block_size = superblock['block_size']
+        self.ptr_size = superblock['ptr_size']
+        self.inode_start = superblock['inode_start']
+        self.data_start = superblock['data_start']
+        self.name_max = name_max(self.block_size, self.ptr_size)
+        # where the extents start in a metadata block and how many fit.
+        self.extent_offset = extent_offset(self.ptr_size)
+        self.extent_size = extent_size(self.ptr_size)
+        self.inline_extents = (
+            (self.block_size - self.extent_offset) // self.extent_size)
+        # files up to this size keep their data in the metadata block.
+        self.inline_max = self.block_size - self.extent_offset
+        # overflow blocks end with a pointer to the next overflow block.
+        self.overflow_extents = (
+            (self.block_size - self.ptr_size) // self.extent_size)
+
+        # All block I/O goes through a write-back cache, metadata is
+        # committed through the journal.
+        self.disk = BlockCache(device, cache_blocks, journal, self.data_start)
+        self.commit_interval = commit_interval
+        self.last_commit = time()
+        # Sequential readers get the blocks after their reads fetched
+        # ahead, in windows that fit a quarter of the cache. Threaded,
+        # the windows are fetched in the background.
+        self.readahead_max = max(1, min(READAHEAD_MAX // self.block_size,
+                                        self.disk.capacity // 4))
+        self.prefetcher = None
+        if threaded:
+            self.prefetcher = Prefetcher(self.disk)
+            self.prefetcher.start()
+        # Free space is tracked by the on-disk bitmap.
+        self.allocator = Allocator(superblock, self.disk)
+
+        # The root directory is the first metadata block, other files are
+        # loaded when they are first looked up.
+        self.root = self.load_inode(self.inode_start)
+
+        # On a disk formatted with --dedup, identical blocks of regular
+        # files are stored once, see dedup.
+        self.dedup = None
+        if superblock['dedup_index']:
+            self.dedup = DedupIndex(self, superblock['dedup_index'])
+
+        # After a crash the bitmap may not match the files on disk,
+        # unless the journal kept them in step.
+        if not superblock['clean'] and journal is None:
+            self.recover()
+        # Until destroy, the disk is not clean.
+        self.allocator.flush(clean=False)
+        self.disk.sync()
+
+        # Fragmented files are moved into single runs of blocks, at most
+        # defrag_rate blocks per second.
+        self.defrag = None
+        if defrag_rate:
+            self.defrag = DefragThread(self, defrag_rate)
+            self.defrag.start()
+
+    def recover(self):
+        '''Rebuilds the free space bitmap by walking the directory tree.'''
+        runs = []
+        stack = [self.root]
+        if self.dedup is not None:
+            stack.append(self.dedup.inode)
+        while stack:
+            inode = stack.pop()
+            runs.append((inode.block_num, 1))
+            runs.extend(inode.extents.physical_runs())
+            runs.extend((block_num, 1) for block_num in inode.extents.overflow)
+            if S_ISDIR(inode.mode):
+                for name, block_num in self.list_directory(inode):
+                    stack.append(self.load_inode(block_num))
+        self.allocator.rebuild(runs)
+        # keep only the root and the dedup index loaded.
+        self.inodes = {self.root.block_num: self.root}
+        if self.dedup is not None:
+            self.inodes[self.dedup.inode.block_num] = self.dedup.inode
+
+    def next_block(self, block):
+        '''Returns the pointer to the next overflow block stored in block.'''
+        return disktools.bytes_to_int(
+            block[self.block_size - self.ptr_size:self.block_size])
+
+    def load_inode(self, block_num):
+        '''Returns the inode stored in metadata block block_num.'''
+        inode = self.inodes.get(block_num)
+        if inode is None:
+            with self.inode_lock:
+                inode = self.inodes.get(block_num)
+                if inode is None:
+                    inode = self.read_inode(block_num)
+                    self.inodes[block_num] = inode
+        return inode
+
+    def read_inode(self, block_num):
+        '''Decodes the inode stored in metadata block block_num, without
+            keeping it loaded.
+        '''
+        block = self.disk.get(block_num)
+        inode, extent_count, extent_block = Inode.unpack_from(
+            block, block_num, self.ptr_size)
+        inode.extents = self.load_extents(block, extent_count, extent_block)
+        return inode
+
+    def load_extents(self, block, count, block_num):
+        '''Reads count extents of a file from its metadata block and the
+            overflow blocks from block_num.
+        '''
+        extents = unpack_extents(block[self.extent_offset:],
+                                 min(count, self.inline_extents), self.ptr_size)
+        overflow = []
+        while block_num != 0 and len(extents) < count:
+            overflow.append(block_num)
+            block = self.disk.get(block_num)
+            extents += unpack_extents(
+                block, min(count - len(extents), self.overflow_extents),
+                self.ptr_size)
+            block_num = self.next_block(block)
+        return ExtentMap(extents, overflow, self.block_size)
+
+    def write_inode(self, inode):
+        '''Writes the in memory metadata and extents of inode to its
+            metadata block.
+        '''
+        extent_map = inode.extents
+        extents = extent_map.stored()
+        overflow_extents = extents[self.inline_extents:]
+
+        # make sure there are just enough overflow blocks.
+        blocks_needed = int(math.ceil(
+            len(overflow_extents) / self.overflow_extents))
+        while len(extent_map.overflow) < blocks_needed:
+            extent_map.overflow.append(self.allocator.allocate(
+                1, extent_map.last_physical() + 1)[0][0])
+        while len(extent_map.overflow) > blocks_needed:
+            self.allocator.free(extent_map.overflow.pop())
+
+        for i, overflow_block in enumerate(extent_map.overflow):
+            if i + 1 < len(extent_map.overflow):
+                next_block = extent_map.overflow[i+1]
+            else:
+                next_block = 0
+            chunk = overflow_extents[
+                i*self.overflow_extents:(i+1)*self.overflow_extents]
+            block = pack_extents(chunk, self.ptr_size).ljust(
+                self.block_size - self.ptr_size, b'\x00')
+            self.disk.write_block(overflow_block, block + disktools.int_to_bytes(
+                next_block, self.ptr_size), metadata=True)
+
+        block = bytearray(self.block_size)
+        inode.pack_into(block, self.ptr_size, len(extents),
+            extent_map.overflow[0] if extent_map.overflow else 0)
+        inline = pack_extents(extents[:self.inline_extents], self.ptr_size)
+        block[self.extent_offset:self.extent_offset + len(inline)] = inline
+        self.disk.write_block(inode.block_num, block)
+
+    def allocate_blocks(self, extent_map, block, count):
+        '''Maps count unmapped logical blocks from block to newly allocated
+            data blocks, placed right after the previous block of the file
+            when there is room.
+        '''
+        hint = extent_map.lookup(block - 1) if block > 0 else 0
+        if hint == 0:
+            hint = extent_map.last_physical()
+        for physical, length in self.allocator.allocate(count, hint + 1 if hint else 0):
+            extent_map.add(block, physical, length)
+            block += length
+
+    def resolve(self, path):
+        '''Walks the components of path from the root directory.
+            Return: the inode of path.
+        '''
+        inode = self.root
+        for name in path.split('/'):
+            if not name:
+                continue
+            if not S_ISDIR(inode.mode):
+                raise FuseOSError(ENOTDIR)
+            block_num = self.lookup(inode, name)
+            if block_num == 0:
+                raise FuseOSError(ENOENT)
+            inode = self.load_inode(block_num)
+        return inode
+
+    def resolve_parent(self, path):
+        '''Return: the inode of the directory holding path and the name of
+            path in it.
+        '''
+        parent_path, name = os.path.split(path.rstrip('/'))
+        parent = self.resolve(parent_path)
+        if not S_ISDIR(parent.mode):
+            raise FuseOSError(ENOTDIR)
+        return parent, name
+
+    def bucket_count(self, directory):
+        return directory.size // self.block_size
+
+    def read_bucket(self, directory, bucket):
+        return unpack_entries(
+            self.disk.get(directory.extents.lookup(bucket)), self.ptr_size)
+
+    def lookup(self, directory, name):
+        '''Finds name in directory, through the directory entry cache.
+            Return: the metadata block of the file, or 0.
+        '''
+        key = (directory.block_num, name)
+        block_num = self.dentries.get(key)
+        if block_num is None:
+            block_num = 0
+            buckets = self.bucket_count(directory)
+            if buckets:
+                encoded = name.encode('utf-8')
+                for entry_name, ino in self.read_bucket(
+                        directory, bucket_of(encoded, buckets)):
+                    if entry_name == encoded:
+                        block_num = ino
+                        break
+            if block_num:
+                self.dentries[key] = block_num
+        return block_num
+
+    def list_directory(self, directory):
+        '''Returns every (name, metadata block) entry of directory.'''
+        entries = []
+        for bucket in range(self.bucket_count(directory)):
+            for name, ino in self.read_bucket(directory, bucket):
+                entries.append((name.decode('utf-8'), ino))
+        return entries
+
+    def write_buckets(self, directory, table):
+        '''Writes a hash table of entries as the data of directory.
+            Return: False (and writes nothing) if some bucket does not fit
+            in a block.
+        '''
+        blocks = []
+        for entries in table:
+            block = pack_entries(entries, self.block_size, self.ptr_size)
+            if block is None:
+                return False
+            blocks.append(block)
+
+        extent_map = directory.extents
+        # the buckets, the inode, its overflow blocks and the bitmap blocks
+        # must be committed together.
+        if not self.disk.fits(len(blocks) + len(extent_map.overflow) + 4):
+            raise FuseOSError(ENOSPC)
+        for logical, physical, length in extent_map.runs(0, len(blocks)):
+            if physical == 0:
+                self.allocate_blocks(extent_map, logical, length)
+        for bucket, block in enumerate(blocks):
+            self.disk.write_block(extent_map.lookup(bucket), block, metadata=True)
+        directory.size = len(blocks) * self.block_size
+        self.write_inode(directory)
+        return True
+
+    def add_entry(self, directory, name, block_num):
+        '''Adds name to directory, doubling the hash table when the bucket
+            of name is full.
+        '''
+        encoded = name.encode('utf-8')
+        buckets = self.bucket_count(directory)
+        if buckets:
+            bucket = bucket_of(encoded, buckets)
+            entries = self.read_bucket(directory, bucket) + [(encoded, block_num)]
+            block = pack_entries(entries, self.block_size, self.ptr_size)
+            if block is not None:
+                self.disk.write_block(directory.extents.lookup(bucket), block,
+                                      metadata=True)
+                self.dentries[(directory.block_num, name)] = block_num
+                return
+
+        # rehash every entry into a table twice the size.
+        entries = [(encoded, block_num)]
+        for bucket in range(buckets):
+            entries += self.read_bucket(directory, bucket)
+        buckets = buckets * 2 if buckets else 1
+        while True:
+            table = [[] for i in range(buckets)]
+            for entry in entries:
+                table[bucket_of(entry[0], buckets)].append(entry)
+            if self.write_buckets(directory, table):
+                break
+            buckets *= 2
+            if buckets > self.bucket_count(directory) + self.allocator.free_blocks:
+                raise FuseOSError(ENOSPC)
+        self.dentries[(directory.block_num, name)] = block_num
+
+    def remove_entry(self, directory, name):
+        '''Removes name from directory.'''
+        encoded = name.encode('utf-8')
+        bucket = bucket_of(encoded, self.bucket_count(directory))
+        entries = [entry for entry in self.read_bucket(directory, bucket)
+                   if entry[0] != encoded]
+        self.disk.write_block(directory.extents.lookup(bucket),
+            pack_entries(entries, self.block_size, self.ptr_size), metadata=True)
+        self.dentries.pop((directory.block_num, name), None)
 
     def chmod(self, path, mode):
-        self.files[path]['st_mode'] &= 0o770000
-        self.files[path]['st_mode'] |= mode
-
-        block_num = self.files[path]['st_location']
-        block = disktools.read_block(block_num)
-        block[0:2] = disktools.int_to_bytes(self.files[path]['st_mode'], 2)
-        disktools.write_block(block_num, block)   
+        inode = self.resolve(path)
+        inode.mode &= 0o770000
+        inode.mode |= mode
+        self.write_inode(inode)
 
         return 0
 
     def chown(self, path, uid, gid):
-        self.files[path]['st_uid'] = uid
-        self.files[path]['st_gid'] = gid
-
-        block_num = self.files[path]['st_location']
-        block = disktools.read_block(block_num)
-        block[2:4] = disktools.int_to_bytes(self.files[path]['st_uid'], 2)
-        block[2:4] = disktools.int_to_bytes(self.files[path]['st_mode'], 2)
-        disktools.write_block(block_num, block)  
-        
-
-    # adds a new file by adding file attributes to the files dictionary.
+        inode = self.resolve(path)
+        if not (-1 <= uid < 1 << 32 and -1 <= gid < 1 << 32):
+            raise FuseOSError(EINVAL)
+        # -1 leaves the id as it is.
+        if uid != -1:
+            inode.uid = uid
+        if gid != -1:
+            inode.gid = gid
+        self.write_inode(inode)
+
+    def new_file(self, path, mode, nlink):
+        '''Allocates a metadata block for a new, empty file and adds it to
+            its directory.
+        '''
+        parent, name = self.resolve_parent(path)
+        if len(name.encode('utf-8')) > self.name_max:
+            raise FuseOSError(ENAMETOOLONG)
+        if self.lookup(parent, name):
+            raise FuseOSError(EEXIST)
+
+        now = int(time())
+        inode = Inode(self.allocator.allocate_inode(),
+            mode=mode,
+            uid=os.getuid(),
+            gid=os.getgid(),
+            ctime=now,
+            mtime=now,
+            atime=now,
+            nlink=nlink,
+            parent=parent.block_num,
+            extents=ExtentMap(block_size=self.block_size))
+        if not S_ISDIR(mode):
+            # inline until it grows, see inode.
+            inode.inline = bytearray()
+        self.inodes[inode.block_num] = inode
+        self.write_inode(inode)
+        try:
+            self.add_entry(parent, name, inode.block_num)
+        except FuseOSError:
+            # no room for the entry.
+            self.free_blocks(inode)
+            raise
+        return parent, inode
+
+    # adds a new file to the directory that holds it.
     # whenever a file is created, fd will be incremented and returned (fd is basically the id for the file).
     # mode is the permissions that you want the file to have.
     def create(self, path, mode):
-        file_name = os.path.basename(path)
-        block_num = -1
-        data_location = -1
-
-        # find an empty block for metadata
-        for i in range(len(empty_file_block_list)):
-            if empty_file_block_list[i] == True:
-                block_num = i
-                break
-
-        # find an empty block for data
-        for i in range(len(empty_data_block_list)):
-            if empty_data_block_list[i]:
-                data_location = i + 5
-                empty_file_block_list[block_num] = False
-                empty_data_block_list[i] = False
-                break
+        parent, inode = self.new_file(path, S_IFREG | mode, 1)
 
-        self.files[path] = dict(
-            st_mode=(S_IFREG | mode),
-            st_uid=os.getuid(),
-            st_gid=os.getgid(),
-            st_ctime=int(time()),
-            st_mtime=int(time()),
-            st_atime=int(time()),
-            st_nlink=1,
-            st_size=0,
-            st_location=data_location,
-            block_num=block_num)
-
-        if block_num != -1 and data_location != -1:
-            block = disktools.read_block(block_num)
-            block[0:2]=disktools.int_to_bytes(self.files[path]['st_mode'], 2)
-            block[2:4]=disktools.int_to_bytes(self.files[path]['st_uid'], 2)
-            block[4:6]=disktools.int_to_bytes(self.files[path]['st_gid'], 2)
-            
-            block[6:10]=disktools.int_to_bytes(self.files[path]['st_ctime'], 4)
-            block[10:14]=disktools.int_to_bytes(self.files[path]['st_mtime'], 4)
-            block[14:18]=disktools.int_to_bytes(self.files[path]['st_atime'], 4)
-
-            block[18:19]=disktools.int_to_bytes(self.files[path]['st_nlink'], 1)
-            block[19:21]=disktools.int_to_bytes(self.files[path]['st_size'], 2)
-            block[21:22]=disktools.int_to_bytes(self.files[path]['st_location'], 1)
-
-            block[22:38]=file_name.encode('ascii')
-
-            disktools.write_block(block_num, block)
-
-        self.fd += 1
-        return self.fd
+        return self.open_files.open(inode)
 
     # if the file exists, then it will return the attributes of the file.
     def getattr(self, path, fh=None):
-        
-        if path not in self.files:
-            raise FuseOSError(ENOENT)
-
-        return self.files[path]
+        return self.file(path, fh).stat(self.block_size)
 
     def getxattr(self, path, name, position=0):
-        attrs = self.files[path].get('attrs', {})
+        attrs = self.resolve(path).attrs or {}
 
         try:
             return attrs[name]
@@ -170,113 +471,205 @@ class Small(LoggingMixIn, Operations):
             return ''       # Should return ENOATTR
 
     def listxattr(self, path):
-        attrs = self.files[path].get('attrs', {})
+        attrs = self.resolve(path).attrs or {}
         return attrs.keys()
     # similar to create, however the number of st_nlink is 2 instead of 1.
     def mkdir(self, path, mode):
-        file_name = os.path.basename(path)
-        block_num = -1
-        data_location = -1
-
-        # find an empty block for metadata
-        for i in range(len(empty_file_block_list)):
-            if empty_file_block_list[i] == True:
-                block_num = i
-                break
-
-        # find an empty block for data
-        for i in range(len(empty_data_block_list)):
-            if empty_data_block_list[i] == True:
-                data_location = i + 5
-                empty_file_block_list[block_num] = False
-                empty_data_block_list[i] == False
-                break
+        parent, inode = self.new_file(path, S_IFDIR | mode, 2)
 
-        self.files[path] = dict(
-            st_mode=(S_IFDIR | mode),
-            st_uid=1000,
-            st_gid=1000,
-            st_ctime=int(time()),
-            st_mtime=int(time()),
-            st_atime=int(time()),
-            st_nlink=2,
-            st_size=0,
-            st_location=data_location,
-            block_num=block_num)
-
-        if block_num != -1 and data_location != -1:
-            block = disktools.read_block(block_num)
-            block[0:2]=disktools.int_to_bytes(self.files[path]['st_mode'], 2)
-            block[2:4]=disktools.int_to_bytes(self.files[path]['st_uid'], 2)
-            block[4:6]=disktools.int_to_bytes(self.files[path]['st_gid'], 2)
-            
-            block[6:10]=disktools.int_to_bytes(self.files[path]['st_ctime'], 4)
-            block[10:14]=disktools.int_to_bytes(self.files[path]['st_mtime'], 4)
-            block[14:18]=disktools.int_to_bytes(self.files[path]['st_atime'], 4)
-
-            block[18:19]=disktools.int_to_bytes(self.files[path]['st_nlink'], 1)
-            block[19:21]=disktools.int_to_bytes(self.files[path]['st_size'], 2)
-            block[21:22]=disktools.int_to_bytes(self.files[path]['st_location'], 1)
-
-            block[22:38]=file_name.encode('ascii')
-
-            disktools.write_block(block_num, block)
-
-            self.files['/']['st_nlink'] += 1
-            block = disktools.read_block(0)
-            block[18:19]=disktools.int_to_bytes(self.files['/']['st_nlink'], 1)
-            disktools.write_block(0, block)
+        parent.nlink += 1
+        self.write_inode(parent)
 
     # passes the file path of the file that you want open and increment the file descriptor.
+    # the handle keeps the inode, so reads and writes on it skip the path.
     def open(self, path, flags):
-        self.fd += 1
-        return self.fd
+        return self.open_files.open(self.resolve(path), flags)
+
+    def file(self, path, fh):
+        '''Returns the inode of the open handle fh, or of path if fh is
+            not open.
+        '''
+        open_file = self.open_files.get(fh)
+        if open_file is not None:
+            return open_file.inode
+        return self.resolve(path)
+
+    def read_data(self, inode, offset, size):
+        '''Reads size bytes of file data from offset. Holes read as zeros.'''
+        size = max(0, min(size, inode.size - offset))
+        if size == 0:
+            return b''
+        if inode.inline is not None:
+            return bytes(inode.inline[offset:offset + size]).ljust(size, b'\x00')
+
+        first = offset // self.block_size
+        last = (offset + size - 1) // self.block_size
+        current_data = self.read_blocks(inode.extents, first, last - first + 1)
+        start = offset - first * self.block_size
+        return bytes(current_data[start:start + size])
+
+    def read_blocks(self, extent_map, first, count):
+        '''Reads count logical blocks of a file from first.
+            Return: a bytearray of the blocks, holes read as zeros.
+        '''
+        runs = extent_map.runs(first, count)
+
+        # read every mapped block in one vectored read.
+        block_nums = []
+        for logical, physical, length in runs:
+            if physical != 0:
+                block_nums.extend(range(physical, physical + length))
+        current_data = self.disk.read_blocks(block_nums)
+        if len(block_nums) != count:
+            # put the holes back in as zeros.
+            mapped_data = current_data
+            current_data = bytearray()
+            start = 0
+            for logical, physical, length in runs:
+                if physical == 0:
+                    current_data += bytearray(length * self.block_size)
+                else:
+                    current_data += mapped_data[start:start + length * self.block_size]
+                    start += length * self.block_size
+
+        # compressed clusters are holes to the extents.
+        span = extent_map.cluster_blocks if extent_map.clusters else 0
+        for logical in extent_map.clusters_in(first, count):
+            cluster = self.read_cluster(extent_map, logical)
+            start = max(first, logical)
+            stop = min(first + count, logical + span)
+            current_data[(start - first) * self.block_size:(stop - first) * self.block_size] = \
+                cluster[(start - logical) * self.block_size:(stop - logical) * self.block_size]
+        return current_data
+
+    def read_cluster(self, extent_map, logical):
+        '''Return: the data of the compressed cluster from logical block,
+            the length of a whole cluster.
+        '''
+        physical, length, size, method = extent_map.clusters[logical]
+        with self.cluster_lock:
+            data = self.cluster_cache.get(physical)
+            if data is not None:
+                self.cluster_cache.move_to_end(physical)
+                return data
+        packed = self.disk.read_blocks(list(range(physical, physical + length)))
+        data = decompress(packed[:size], method).ljust(
+            extent_map.cluster_blocks * self.block_size, b'\x00')
+        with self.cluster_lock:
+            self.clusters_decompressed += 1
+            self.cluster_cache[physical] = data
+            if len(self.cluster_cache) > CLUSTER_CACHE:
+                self.cluster_cache.popitem(last=False)
+        return data
+
+    def free_cluster(self, extent_map, logical):
+        '''Unmaps and releases the compressed cluster from logical block,
+            if there is one.
+        '''
+        run = extent_map.remove_cluster(logical)
+        if run is None:
+            return
+        self.allocator.free(*run)
+        with self.cluster_lock:
+            self.cluster_cache.pop(run[0], None)
+
+    def store_cluster(self, extent_map, logical, content, method):
+        '''Replaces the cluster from logical block with content, compressed
+            with method if that saves blocks and fits in one run, else as
+            plain blocks. Zeros at the end of content are left as holes.
+        '''
+        span = extent_map.cluster_blocks
+        self.free_cluster(extent_map, logical)
+        for physical, length in extent_map.punch(logical, span):
+            self.free_data(physical, length)
+        content = bytes(content)
+        used = -(-len(content.rstrip(b'\x00')) // self.block_size)
+        if used == 0:
+            return
+        content = content[:used * self.block_size]
+
+        if method is not None:
+            packed = compress(content, method)
+            length = -(-len(packed) // self.block_size)
+            if length < used:
+                # after the cluster before it, if that is where it was.
+                previous = extent_map.clusters.get(logical - span)
+                hint = previous[0] + previous[1] if previous else \
+                    extent_map.last_physical() + 1
+                runs = self.allocator.allocate(length, hint if hint > 1 else 0)
+                if len(runs) == 1:
+                    physical = runs[0][0]
+                    self.disk.write_blocks(dict(
+                        (physical + i, packed[i * self.block_size:(i + 1) * self.block_size]
+                         .ljust(self.block_size, b'\x00'))
+                        for i in range(length)))
+                    extent_map.add_cluster(logical, physical, len(packed), method)
+                    self.clusters_compressed += 1
+                    return
+                for physical, length in runs:
+                    self.allocator.free(physical, length)
+
+        self.allocate_blocks(extent_map, logical, used)
+        self.disk.write_blocks(dict(
+            (extent_map.lookup(logical + i), content[i * self.block_size:(i + 1) * self.block_size])
+            for i in range(used)))
+        self.clusters_plain += 1
+
+    def read_ahead(self, open_file, offset, size):
+        '''Fetches the blocks after a sequential read on open_file into
+            the cache, see readahead.
+        '''
+        inode = open_file.inode
+        size = min(size, inode.size - offset)
+        if size <= 0:
+            return
+        first = offset // self.block_size
+        last = (offset + size - 1) // self.block_size
+        start, end = open_file.readahead.advance(
+            offset, size, first, last, self.readahead_max)
+        end = min(end, inode.extents.end())
+        if start >= end:
+            return
+        block_nums = []
+        for logical, physical, length in inode.extents.runs(start, end - start):
+            if physical != 0:
+                block_nums.extend(range(physical, physical + length))
+        if not block_nums:
+            return
+        if self.prefetcher is None:
+            self.disk.prefetch(block_nums)
+        elif start > last:
+            self.prefetcher.submit(block_nums)
+        else:
+            # the window starts with this read, which needs it now.
+            self.disk.prefetch(block_nums)
 
     # starts reading from the offset until offset + size.
+    # a sequential read on a handle also fetches the blocks after it.
+    # buffered writes to the file are read from the buffer.
     def read(self, path, size, offset, fh):
-        current_data = b''
-
-        # get the current data.
-        block_num = self.files[path]['st_location']
-        while block_num != 0:
-            block = disktools.read_block(block_num)
-            current_data += block[0:63]
-            block_num = disktools.bytes_to_int(block[63:64])
-
-        # get current metadata.
-        metadata_block_num = self.files[path]['block_num']
-        metadata_block = disktools.read_block(metadata_block_num)
-        file_size = disktools.bytes_to_int(metadata_block[19:21])
-
-        current_data = current_data[0:file_size]
-
-        return current_data[offset:offset + size]
+        open_file = self.open_files.get(fh)
+        if open_file is None:
+            inode = self.resolve(path)
+        else:
+            inode = open_file.inode
+            self.read_ahead(open_file, offset, size)
+        data = self.read_data(inode, offset, size)
+        writer = self.open_files.buffered.get(inode.block_num)
+        if writer is not None:
+            data = writer.buffer.overlay(offset, data)
+        return data
 
     def readdir(self, path, fh):
-        return ['.', '..'] + [x[1:] for x in self.files if x != '/']
+        directory = self.resolve(path)
+        return ['.', '..'] + [name for name, ino in self.list_directory(directory)]
 
     def readlink(self, path):
-        # get the current data.
-        current_data = b''
-
-        # Check all the blocks that are linked to this block as well.
-        block_num = self.files[path]['st_location']
-        while block_num != 0:
-            block = disktools.read_block(block_num)
-            current_data += block[0:63]
-            block_num = disktools.bytes_to_int(block[63:64])
-
-        # get current metadata.
-        metadata_block_num = self.files[path]['block_num']
-        metadata_block = disktools.read_block(metadata_block_num)
-        file_size = disktools.bytes_to_int(metadata_block[19:21])
-
-        current_data = current_data[0:file_size]
-
-        return current_data
+        inode = self.resolve(path)
+        return self.read_data(inode, 0, inode.size).decode('utf-8')
 
     def removexattr(self, path, name):
-        attrs = self.files[path].get('attrs', {})
+        attrs = self.resolve(path).attrs or {}
 
         try:
             del attrs[name]
@@ -284,211 +677,631 @@ class Small(LoggingMixIn, Operations):
             pass        # Should return ENOATTR
 
     def rename(self, old, new):
-        self.files[new] = self.files.pop(old)
-        block = disktools.read_block(self.files[new]['st_location'])
-        block[22:38]=new.encode('ascii')
-        disktools.write_block(self.files[new]['block_num'], block)
+        old_parent, old_name = self.resolve_parent(old)
+        new_parent, new_name = self.resolve_parent(new)
+        if len(new_name.encode('utf-8')) > self.name_max:
+            raise FuseOSError(ENAMETOOLONG)
+        block_num = self.lookup(old_parent, old_name)
+        if block_num == 0:
+            raise FuseOSError(ENOENT)
+        inode = self.load_inode(block_num)
+
+        # a file that is already at new is replaced.
+        replaced = self.lookup(new_parent, new_name)
+        if replaced == block_num:
+            return
+        if replaced:
+            if S_ISDIR(self.load_inode(replaced).mode):
+                self.rmdir(new)
+            else:
+                self.unlink(new)
+
+        self.remove_entry(old_parent, old_name)
+        self.add_entry(new_parent, new_name, block_num)
+        if new_parent is not old_parent:
+            inode.parent = new_parent.block_num
+            self.write_inode(inode)
+            if S_ISDIR(inode.mode):
+                old_parent.nlink -= 1
+                new_parent.nlink += 1
+                self.write_inode(old_parent)
+                self.write_inode(new_parent)
 
     def rmdir(self, path):
-        # with multiple level support, need to raise ENOTEMPTY if contains any files
-        removed_file = self.files.pop(path)
-        self.files['/']['st_nlink'] -= 1
-
-        block_num = removed_file['block_num']
-        empty_file_block_list[block_num] = True
-        disktools.write_block(block_num, bytearray(64))
+        parent, name = self.resolve_parent(path)
+        directory = self.resolve(path)
+        if self.list_directory(directory):
+            raise FuseOSError(ENOTEMPTY)
 
-        block = disktools.read_block(0)
-        block[18:19]=disktools.int_to_bytes(self.files['/']['st_nlink'], 1)
-        disktools.write_block(0, block)
+        self.remove_entry(parent, name)
+        parent.nlink -= 1
+        self.write_inode(parent)
+        self.free_blocks(directory)
 
     def setxattr(self, path, name, value, options, position=0):
         # Ignore options
-        attrs = self.files[path].setdefault('attrs', {})
-        attrs[name] = value
+        inode = self.resolve(path)
+        if inode.attrs is None:
+            inode.attrs = {}
+        inode.attrs[name] = value
 
     def statfs(self, path):
-        return dict(f_bsize=512, f_blocks=4096, f_bavail=2048)
-
+        superblock = self.allocator.superblock
+        return dict(
+            f_bsize=self.block_size,
+            f_frsize=self.block_size,
+            f_blocks=superblock['num_blocks'] - self.data_start,
+            f_bfree=self.allocator.free_blocks,
+            f_bavail=self.allocator.free_blocks,
+            f_files=superblock['inode_count'],
+            f_ffree=self.allocator.free_inodes,
+            f_favail=self.allocator.free_inodes,
+            f_namemax=self.name_max)
+
+    # a symlink is a file holding the path it points to, inline when it
+    # fits in the metadata block.
     def symlink(self, target, source):
-        # Not implemented.
-        """
-        self.files[target] = dict(
-            st_mode=(S_IFLNK | 0o777),
-            st_nlink=1,
-            st_size=len(source))
-
-        self.data[target] = source
-        """
+        parent, inode = self.new_file(target, S_IFLNK | 0o777, 1)
+        if source:
+            self.write_data(inode, source.encode('utf-8'), 0)
+
+    def punch_hole(self, inode, offset, end):
+        '''Zeroes the file data from offset to end. The whole blocks in
+            between are released and become holes again, only the partial
+            blocks at either side are written.
+        '''
+        if inode.inline is not None:
+            inode.inline[offset:end] = bytearray(len(inode.inline[offset:end]))
+            return
+        extent_map = inode.extents
+        if extent_map.clusters and offset < end:
+            # a cluster in the range goes, one partly in it is rewritten.
+            span = extent_map.cluster_blocks
+            first = offset // self.block_size
+            count = (end - 1) // self.block_size - first + 1
+            for logical in extent_map.clusters_in(first, count):
+                start = logical * self.block_size
+                stop = start + span * self.block_size
+                if offset <= start and stop <= end:
+                    self.free_cluster(extent_map, logical)
+                    continue
+                content = self.read_blocks(extent_map, logical, span)
+                content[max(offset, start) - start:min(end, stop) - start] = \
+                    bytearray(min(end, stop) - max(offset, start))
+                self.store_cluster(extent_map, logical, content,
+                                   extent_map.clusters[logical][3])
+
+        first = (offset + self.block_size - 1) // self.block_size
+        last = end // self.block_size
+        if first < last:
+            for physical, length in extent_map.punch(first, last - first):
+                self.free_data(physical, length)
+
+        # (block, start, stop) of the partial blocks.
+        partial = []
+        if offset % self.block_size:
+            partial.append((offset // self.block_size, offset,
+                            min(end, first * self.block_size)))
+        if end % self.block_size and last >= first:
+            partial.append((last, last * self.block_size, end))
+        blocks = {}
+        for block, start, stop in partial:
+            physical = extent_map.lookup(block)
+            if physical == 0 or start >= stop:
+                continue
+            if self.dedup is not None and S_ISREG(inode.mode):
+                # the block may be shared.
+                self.write_deduped(extent_map, bytes(stop - start), start)
+                continue
+            data = self.disk.read_block(physical)
+            block_start = block * self.block_size
+            data[start - block_start:stop - block_start] = bytearray(stop - start)
+            blocks[physical] = data
+        self.disk.write_blocks(blocks)
+
+    def __call__(self, op, *args):
+        try:
+            if self.locks is None:
+                return super(Small, self).__call__(op, *args)
+            with self.locks.operation(op, args):
+                return super(Small, self).__call__(op, *args)
+        finally:
+            self.end_operation()
+
+    def file_key(self, path):
+        '''Files are locked by their metadata block.'''
+        return self.resolve(path).block_num
+
+    def commit_lock(self):
+        '''Held while committing, so that no operation is half done.'''
+        if self.locks is None:
+            return unlocked()
+        return self.locks.commit()
+
+    def end_operation(self):
+        '''Each operation is a transaction: the blocks it changed stay in
+            the cache until a group commit writes the operations since the
+            last commit to the journal with a single flush of the disk.
+            A group is committed once half the cache or half the journal
+            is waiting on it or commit_interval seconds have passed.
+        '''
+        with self.disk.lock:
+            if self.locks is None or self.locks.idle():
+                self.disk.settle()
+        waiting = len(self.disk.dirty)
+        if waiting and (waiting >= self.disk.capacity // 2 or self.disk.group_full() or
+                        time() - self.last_commit >= self.commit_interval):
+            self.sync()
+
+    def component_stats(self):
+        '''Statistics of the block cache, journal, deduplication,
+            compression and defragmenter, see instrument.
+        '''
+        stats = dict(cache=self.disk.stats())
+        if self.disk.journal is not None:
+            stats['journal'] = self.disk.journal.stats()
+        if self.dedup is not None:
+            stats['dedup'] = self.dedup.stats()
+        if self.compression is not None or self.clusters_decompressed:
+            stats['compress'] = dict(method=self.compression,
+                                     compressed=self.clusters_compressed,
+                                     plain=self.clusters_plain,
+                                     decompressed=self.clusters_decompressed)
+        if self.defrag is not None:
+            defragmenter = self.defrag.defragmenter
+            stats['defrag'] = dict(relocated=defragmenter.relocated,
+                                   blocks_moved=defragmenter.moved)
+        return stats
+
+    def sync(self):
+        '''Writes the free counters and every dirty block to the disk.'''
+        with self.commit_lock():
+            self.flush_buffers()
+            self.allocator.flush()
+            self.disk.flush()
+            self.last_commit = time()
+
+    def destroy(self, path):
+        if self.defrag is not None:
+            self.defrag.stop()
+            self.defrag = None
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+        with self.commit_lock():
+            self.flush_buffers()
+            self.allocator.flush(clean=True)
+            self.disk.sync()
+
+    def tree_lock(self):
+        '''Held to read the directory tree outside of an operation.'''
+        if self.locks is None:
+            return unlocked()
+        return self.locks.tree()
+
+    def file_lock(self, inode):
+        '''Held to change inode outside of an operation on its path.'''
+        if self.locks is None:
+            return unlocked()
+        return self.locks.file(inode.block_num)
+
+    def flush_buffer(self, inode):
+        '''Writes out the buffered writes to inode, of whichever handle
+            holds them, with one allocation and one vectored write.
+        '''
+        open_file = self.open_files.buffered.pop(inode.block_num, None)
+        if open_file is None:
+            return
+        buffer, open_file.buffer = open_file.buffer, None
+        self.write_data(inode, buffer.data, buffer.offset)
+        # the size was changed in memory when the data was buffered.
+        self.write_inode(inode)
+
+    def flush_buffers(self):
+        '''Writes out the buffered writes of every open file.'''
+        for open_file in list(self.open_files.buffered.values()):
+            self.flush_buffer(open_file.inode)
+
+    # buffered writes are written out when a handle is flushed, synced or
+    # released, errors such as ENOSPC are then reported by that call.
+    def flush(self, path, fh):
+        open_file = self.open_files.get(fh)
+        if open_file is not None:
+            with self.file_lock(open_file.inode):
+                self.flush_buffer(open_file.inode)
+        return 0
 
-    def truncate(self, path, length, fh=None):
+    def fsync(self, path, datasync, fh):
+        self.flush(path, fh)
+        with self.commit_lock():
+            self.allocator.flush()
+            self.disk.sync()
+            self.last_commit = time()
+        return 0
 
-        # get the current data.
-        blocks_used = []
-        current_data = b''
-
-        # Check all the blocks that are linked to this block as well.
-        block_num = self.files[path]['st_location']
-        blocks_used.append(block_num)
-        while block_num != 0:
-            block = disktools.read_block(block_num)
-            current_data += block[0:63]
-            block_num = disktools.bytes_to_int(block[63:64])
-            if block_num != 0:
-                blocks_used.append(block_num)
-
-        # get current metadata.
-        metadata_block_num = self.files[path]['block_num']
-        metadata_block = disktools.read_block(metadata_block_num)
-        file_size = disktools.bytes_to_int(metadata_block[19:21])
-
-        current_data = current_data[0:file_size]
-
-        # make sure extending the file fills in zero bytes
-        new_data = current_data[:length].ljust(
-            length, '\x00'.encode('ascii'))
-
-        if self.files[path]['st_size'] < length:
-            # assign new blocks to be used.
-            while len(blocks_used) < math.ceil(length/63):
-                # find empty block
-                for i in range(len(empty_data_block_list)):
-                    if empty_data_block_list[i]:
-                        blocks_used.append(i+5)
-                        empty_data_block_list[i] = False
-                        break
-                
-                # write to disk.
-            for i in range(len(blocks_used)):
-                # if last block
-                if i+1 >= len(blocks_used):
-                    disktools.write_block(blocks_used[i], new_data[63*(i):63*(i+1)]+disktools.int_to_bytes(0, 1))
-                else:
-                    disktools.write_block(blocks_used[i], new_data[63*(i):63*(i+1)]+disktools.int_to_bytes(blocks_used[i+1], 1))
+    def release(self, path, fh):
+        '''Closes fh. The blocks of a file that was unlinked while open
+            are released with its last handle.
+        '''
+        try:
+            self.flush(path, fh)
+        finally:
+            open_file, orphan = self.open_files.close(fh)
+        if orphan:
+            with self.commit_lock():
+                self.free_blocks(open_file.inode)
+        return 0
 
-        elif self.files[path]['st_size'] > length:
-            new_blocks = blocks_used[0:math.ceil(length/63)]
-            while len(new_blocks) < len(blocks_used):    
-                last_block = blocks_used.pop()
-                disktools.write_block(last_block, bytearray(64))
-                empty_data_block_list[last_block-5] = True
-        
-        block = disktools.read_block(blocks_used[len(blocks_used)-1])
-        disktools.write_block(blocks_used[len(blocks_used)-1], block[0:63]+'\x00'.encode('ascii'))      
+    # growing a file leaves a hole that reads as zero bytes, shrinking it
+    # releases the blocks past the new end and zeroes the rest of the last
+    # block, so bytes past the end of a file are always zero.
+    def truncate(self, path, length, fh=None):
+        inode = self.file(path, fh)
+        self.flush_buffer(inode)
+        if inode.inline is not None and length > self.inline_max:
+            self.promote(inode)
+        if inode.inline is not None:
+            del inode.inline[length:]
+        mapped_end = inode.extents.end() * self.block_size
+        if mapped_end > length:
+            self.punch_hole(inode, length, mapped_end)
+        inode.size = length
+        inode.mtime = int(time())
+        self.write_inode(inode)
+
+    def fallocate(self, path, mode, offset, length, fh=None):
+        '''Preallocates zeroed blocks from offset, or with
+            FALLOC_FL_PUNCH_HOLE releases them again.
+        '''
+        inode = self.file(path, fh)
+        self.flush_buffer(inode)
+        end = offset + length
+        if mode & FALLOC_FL_PUNCH_HOLE:
+            if mode != FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE:
+                raise FuseOSError(EOPNOTSUPP)
+            self.punch_hole(inode, offset, end)
+            self.write_inode(inode)
+            return 0
+        if mode & ~FALLOC_FL_KEEP_SIZE:
+            raise FuseOSError(EOPNOTSUPP)
+        if inode.inline is not None:
+            self.promote(inode)
+
+        extent_map = inode.extents
+        first = offset // self.block_size
+        last = (end - 1) // self.block_size
+        self.expand_clusters(extent_map, first, last - first + 1)
+        blocks = {}
+        for logical, physical, count in extent_map.runs(first, last - first + 1):
+            if physical == 0:
+                self.allocate_blocks(extent_map, logical, count)
+                for i in range(logical, logical + count):
+                    blocks[extent_map.lookup(i)] = bytearray(self.block_size)
+        self.disk.write_blocks(blocks)
+        if not mode & FALLOC_FL_KEEP_SIZE:
+            inode.size = max(inode.size, end)
+        self.write_inode(inode)
+        return 0
 
-        # Update size.
-        self.files[path]['st_size'] = length
-        metadata_block[19:21] = disktools.int_to_bytes(self.files[path]['st_size'], 2)
-        disktools.write_block(metadata_block_num, metadata_block)
+    def free_data(self, physical, length):
+        '''Releases a run of data blocks, shared blocks only lose a
+            reference.
+        '''
+        if self.dedup is None:
+            self.allocator.free(physical, length)
+            return
+        start = physical
+        for block_num in range(physical, physical + length + 1):
+            if block_num < physical + length and self.dedup.release(block_num):
+                continue
+            # free the blocks released since start.
+            if start < block_num:
+                self.allocator.free(start, block_num - start)
+            start = block_num + 1
+
+    def free_blocks(self, inode):
+        '''Releases the metadata block, data blocks and overflow blocks
+            of a file.
+        '''
+        extent_map = inode.extents
+        for logical in list(extent_map.clusters):
+            self.free_cluster(extent_map, logical)
+        for physical, length in extent_map.physical_runs():
+            self.free_data(physical, length)
+        for overflow_block in extent_map.overflow:
+            self.allocator.free(overflow_block)
 
+        # Delete metadata
+        self.inodes.pop(inode.block_num, None)
+        self.allocator.free(inode.block_num)
+        self.disk.write_block(inode.block_num, bytearray(self.block_size))
 
     def unlink(self, path):
-        # get the current data.
-        blocks_used = []
-
-        # Check all the blocks that are linked to this block as well.
-        block_num = self.files[path]['st_location']
-        blocks_used.append(block_num)
-        while block_num != 0:
-            block = disktools.read_block(block_num)
-            block_num = disktools.bytes_to_int(block[63:64])
-            if block_num != 0:
-                blocks_used.append(block_num)
-
-        print(blocks_used)
-        
-        # Disable these blocks and remove their pointers.
-        for i in range(len(blocks_used)):
-            empty_data_block_list[blocks_used[i]-5] = True
-            disktools.write_block(blocks_used[i], bytearray(64))
-        
-        # Delete metadata
-        block_num = self.files[path]['block_num']
-        empty_file_block_list[block_num] = True
-        disktools.write_block(block_num, bytearray(64))
-        self.files.pop(path)
+        parent, name = self.resolve_parent(path)
+        inode = self.resolve(path)
+        self.remove_entry(parent, name)
+        if self.open_files.orphan(inode):
+            # still in use, release frees it.
+            inode.nlink = 0
+            self.write_inode(inode)
+        else:
+            self.free_blocks(inode)
 
     def utimens(self, path, times=None):
         now = time()
         atime, mtime = times if times else (now, now)
-        self.files[path]['st_atime'] = int(atime)
-        self.files[path]['st_mtime'] = int(mtime)
-
-        block_num = self.files[path]['block_num']
-        block = disktools.read_block(block_num)
-        block[10:14]=disktools.int_to_bytes(self.files[path]['st_mtime'], 4)
-        block[14:18]=disktools.int_to_bytes(self.files[path]['st_atime'], 4)
-        disktools.write_block(block_num, block)
+        inode = self.resolve(path)
+        inode.atime = int(atime)
+        inode.mtime = int(mtime)
+        self.write_inode(inode)
 
     # receives the file path, data, and offset.
-    # modifies the file data such that it removes everything after the offset
-    # and replaces it with the new data.
+    # writes data over the file from offset, only touching the data blocks
+    # that the write covers. Blocks are allocated only when the file grows.
     # file size will also be updated.
+    # writes to an open handle that follow each other are collected in its
+    # buffer and written out together, the size and mtime are changed in
+    # memory straight away so getattr sees them.
     def write(self, path, data, offset, fh):
-        # only the first 63 blocks can have data written into.
-        # the last block is a pointer to the linked block.
-        
-        # get the current data.
-        blocks_used = []
-        current_data = b''
-
-        # Check all the blocks that are linked to this block as well.
-        block_num = self.files[path]['st_location']
-        blocks_used.append(block_num)
-        while block_num != 0:
-            block = disktools.read_block(block_num)
-            current_data += block[0:63]
-            block_num = disktools.bytes_to_int(block[63:64])
-            if block_num != 0:
-                blocks_used.append(block_num)
-
-        # get current metadata.
-        metadata_block_num = self.files[path]['block_num']
-        metadata_block = disktools.read_block(metadata_block_num)
-        file_size = disktools.bytes_to_int(metadata_block[19:21])
-
-        current_data = current_data[0:file_size]
-
-        # create the new data.
-        new_data = (current_data[:offset].ljust(offset, '\x00'.encode('ascii'))
-        + data
-        + current_data[offset + len(data):])
-
-        # update metadata.
-        self.files[path]['st_size'] = len(new_data)
-        metadata_block[19:21] = disktools.int_to_bytes(self.files[path]['st_size'], 2)
-
-        print(empty_data_block_list)
-
-        # assign new blocks to be used.
-        while len(blocks_used) < math.ceil(self.files[path]['st_size']/63):
-            # find empty block
-            for i in range(len(empty_data_block_list)):
-                if empty_data_block_list[i]:
-                    blocks_used.append(i+5)
-                    empty_data_block_list[i] = False
-                    break
-        
-        print(blocks_used)
-
-        # write to disk.
-        for i in range(len(blocks_used)):
-            # if last block
-            if i+1 >= len(blocks_used):
-                disktools.write_block(blocks_used[i], new_data[63*(i):63*(i+1)]+disktools.int_to_bytes(0, 1))
+        if len(data) == 0:
+            return 0
+
+        open_file = self.open_files.get(fh)
+        if open_file is None:
+            inode = self.resolve(path)
+        else:
+            inode = open_file.inode
+        buffer = open_file.buffer if open_file is not None else None
+        if buffer is not None and buffer.offset <= offset <= buffer.end:
+            buffer.write(offset, data)
+        else:
+            # another range, or another handle's writes, go out first.
+            self.flush_buffer(inode)
+            if open_file is None or len(data) >= self.write_buffer:
+                return self.write_data(inode, data, offset)
+            buffer = open_file.buffer = WriteBuffer(offset, data)
+            self.open_files.buffered[inode.block_num] = open_file
+
+        inode.size = max(inode.size, offset + len(data))
+        inode.mtime = int(time())
+        if len(buffer.data) >= self.write_buffer:
+            self.flush_buffer(inode)
+        return len(data)
+
+    def write_data(self, inode, data, offset):
+        '''Writes data to the blocks of inode from offset, allocating the
+            blocks that are missing. An inline file is written in its
+            metadata block until it outgrows it. With compression on, the
+            data of a regular file is written a cluster at a time.
+            Return: the number of bytes written.
+        '''
+        end = offset + len(data)
+        if inode.inline is not None:
+            if max(inode.size, end) <= self.inline_max:
+                return self.write_inline(inode, data, offset)
+            self.promote(inode)
+        extent_map = inode.extents
+        if self.compression is not None and S_ISREG(inode.mode):
+            self.write_clusters(extent_map, data, offset)
+            new_blocks = True
+        else:
+            first = offset // self.block_size
+            self.expand_clusters(extent_map, first, (end - 1) // self.block_size - first + 1)
+            if self.dedup is not None and S_ISREG(inode.mode):
+                new_blocks = self.write_deduped(extent_map, data, offset)
             else:
-                disktools.write_block(blocks_used[i], new_data[63*(i):63*(i+1)]+disktools.int_to_bytes(blocks_used[i+1], 1))
+                new_blocks = self.write_blocks(extent_map, data, offset)
 
-        disktools.write_block(metadata_block_num, metadata_block)
+        # update metadata only if it changed.
+        now = int(time())
+        if new_blocks or end > inode.size or now != inode.mtime:
+            inode.size = max(inode.size, end)
+            inode.mtime = now
+            self.write_inode(inode)
 
         return len(data)
 
+    def write_blocks(self, extent_map, data, offset):
+        '''Writes data over the plain blocks of a file from offset.
+            Return: whether blocks were allocated.
+        '''
+        end = offset + len(data)
+        first = offset // self.block_size
+        last = (end - 1) // self.block_size
+
+        # allocate the missing blocks in as few runs as possible.
+        new_blocks = set()
+        for logical, physical, length in extent_map.runs(first, last - first + 1):
+            if physical == 0:
+                self.allocate_blocks(extent_map, logical, length)
+                new_blocks.update(range(logical, logical + length))
+
+        # only the first and last blocks can be partly covered, read the
+        # old contents of those that already existed.
+        partial = [i for i in sorted(set((first, last)))
+                   if i not in new_blocks and (
+                       i * self.block_size < offset
+                       or (i + 1) * self.block_size > end)]
+        old_data = self.disk.read_blocks(
+            [extent_map.lookup(i) for i in partial])
+
+        data = memoryview(data)
+        blocks = {}
+        for i in range(first, last + 1):
+            block_start = i * self.block_size
+            # the part of data that goes into this block.
+            start = max(offset, block_start)
+            stop = min(end, block_start + self.block_size)
+            chunk = data[start - offset:stop - offset]
+
+            if len(chunk) == self.block_size:
+                block = chunk
+            else:
+                if i in partial:
+                    j = partial.index(i)
+                    block = old_data[j * self.block_size:(j + 1) * self.block_size]
+                else:
+                    block = bytearray(self.block_size)
+                block[start - block_start:stop - block_start] = chunk
+            blocks[extent_map.lookup(i)] = block
+        self.disk.write_blocks(blocks)
+
+        return bool(new_blocks)
+
+    def write_inline(self, inode, data, offset):
+        '''Writes data into the metadata block of an inline file.'''
+        inline = inode.inline
+        if len(inline) < offset:
+            inline.extend(bytearray(offset - len(inline)))
+        inline[offset:offset + len(data)] = data
+        inode.size = max(inode.size, offset + len(data))
+        inode.mtime = int(time())
+        self.write_inode(inode)
+        return len(data)
+
+    def promote(self, inode):
+        '''Moves the data of an inline file to data blocks, zeros at the
+            end are left as holes.
+        '''
+        data = bytes(inode.inline).rstrip(b'\x00')
+        inode.inline = None
+        if data:
+            self.write_data(inode, data, 0)
+        else:
+            self.write_inode(inode)
+
+    def write_deduped(self, extent_map, data, offset):
+        '''Writes data over the blocks of a file from offset, mapping each
+            block whose contents are already stored to the stored copy.
+            Shared blocks are copied on write, see dedup.
+            Return: whether the block map changed.
+        '''
+        end = offset + len(data)
+        first = offset // self.block_size
+        count = (end - 1) // self.block_size - first + 1
+        contents = bytearray(count * self.block_size)
+        # only the first and last blocks can be partly covered.
+        if offset % self.block_size:
+            contents[:self.block_size] = self.read_blocks(extent_map, first, 1)
+        if end % self.block_size and (count > 1 or not offset % self.block_size):
+            contents[-self.block_size:] = self.read_blocks(extent_map, first + count - 1, 1)
+        contents[offset - first * self.block_size:end - first * self.block_size] = data
+
+        index = self.dedup
+        with index.lock:
+            blocks = {}
+            # logical block -> stored copy it is mapped to.
+            shared = {}
+            # logical block -> digest, of the blocks that need a new block
+            # and of the blocks with the same contents as one of them.
+            new = {}
+            copies = {}
+            first_copy = {}
+            for logical in range(first, first + count):
+                start = (logical - first) * self.block_size
+                block = contents[start:start + self.block_size]
+                digest = block_digest(block)
+                old = extent_map.lookup(logical)
+                if old and index.digest_of(old) == digest:
+                    # unchanged.
+                    continue
+                if digest in first_copy:
+                    copies[logical] = digest
+                    continue
+                physical = index.share(digest)
+                if physical:
+                    shared[logical] = physical
+                elif old and index.claim(old):
+                    # the only file block mapped to it.
+                    blocks[old] = block
+                    index.add(digest, old)
+                else:
+                    new[logical] = digest
+                    first_copy[digest] = logical
+
+            # the references to the blocks they were mapped to go.
+            for logical in sorted(shared) + sorted(new) + sorted(copies):
+                for physical, length in extent_map.punch(logical, 1):
+                    self.free_data(physical, length)
+            for logical, positions in disktools.block_runs(sorted(new)):
+                self.allocate_blocks(extent_map, logical, len(positions))
+            for logical, digest in new.items():
+                physical = extent_map.lookup(logical)
+                start = (logical - first) * self.block_size
+                blocks[physical] = contents[start:start + self.block_size]
+                index.add(digest, physical)
+            # a first copy may have left a full index again.
+            unindexed = []
+            for logical, digest in copies.items():
+                physical = index.share(digest)
+                if physical:
+                    shared[logical] = physical
+                else:
+                    unindexed.append(logical)
+            for logical, positions in disktools.block_runs(unindexed):
+                self.allocate_blocks(extent_map, logical, len(positions))
+            for logical in unindexed:
+                start = (logical - first) * self.block_size
+                blocks[extent_map.lookup(logical)] = contents[start:start + self.block_size]
+            for logical, physical in shared.items():
+                extent_map.add(logical, physical)
+            self.disk.write_blocks(blocks)
+        return bool(shared or new or unindexed)
+
+    def write_clusters(self, extent_map, data, offset):
+        '''Writes data over the clusters of a file from offset, compressing
+            each one again.
+        '''
+        span = extent_map.cluster_blocks
+        cluster_size = span * self.block_size
+        end = offset + len(data)
+        data = memoryview(data)
+        for start in range(offset - offset % cluster_size, end, cluster_size):
+            stop = start + cluster_size
+            if offset <= start and stop <= end:
+                content = data[start - offset:stop - offset]
+            else:
+                content = self.read_blocks(extent_map, start // self.block_size, span)
+                content[max(offset, start) - start:min(end, stop) - start] = \
+                    data[max(offset, start) - offset:min(end, stop) - offset]
+            self.store_cluster(extent_map, start // self.block_size, content, self.compression)
+
+    def expand_clusters(self, extent_map, first, count):
+        '''Stores the compressed clusters that overlap count logical blocks
+            from first as plain blocks.
+        '''
+        for logical in extent_map.clusters_in(first, count):
+            self.store_cluster(extent_map, logical,
+                               self.read_blocks(extent_map, logical, extent_map.cluster_blocks), None)
+
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('mount')
+    parser.add_argument('--cache-blocks', type=int, default=CACHE_BLOCKS)
+    parser.add_argument('--commit-interval', type=float, default=COMMIT_INTERVAL)
+    parser.add_argument('--write-buffer', type=int, default=WRITE_BUFFER,
+                        help='bytes of writes collected per open file, 0 to write through')
+    parser.add_argument('--stats', action='store_true',
+                        help='keep statistics, readable from /.stats')
+    parser.add_argument('--debug', action='store_true', help='log every call')
+    parser.add_argument('--threads', action='store_true',
+                        help='run operations on different files at the same time')
+    parser.add_argument('--defrag', type=int, default=0, metavar='RATE',
+                        help='defragment in the background, moving RATE blocks a second')
+    parser.add_argument('--compress', choices=METHODS,
+                        help='store the data of files written from now on compressed')
     args = parser.parse_args()
-
-    logging.basicConfig(level=logging.DEBUG)
-    fuse = FUSE(Small(), args.mount, foreground=True)
+    if FUSE is None:
+        parser.error('mounting needs fusepy and libfuse')
+
+    filesystem = Small
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+        filesystem = instrument.logged(filesystem)
+    if args.stats:
+        filesystem = instrument.instrumented(filesystem)
+    fuse = FUSE(filesystem(args.cache_blocks, args.commit_interval, args.threads,
+                           args.write_buffer, args.defrag, args.compress),
+                args.mount, foreground=True, nothreads=not args.threads)